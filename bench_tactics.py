@@ -0,0 +1,1210 @@
+"""
+Benchmarks for the tactics hot paths.
+
+Run from the repository root:
+
+    python bench_tactics.py [name ...] [--quick] [--json PATH]
+    python bench_tactics.py --compare OLD.json NEW.json [--threshold 0.1]
+
+Names select benchmarks (comparison tables printed to stdout) or suite
+cases (one hot path timed while a single parameter is scaled); "suite"
+selects every suite case. With no names everything is run. Suite results
+can be saved as JSON with --json, and --compare flags the cases that got
+slower between two saved runs, exiting with status 1 if any did.
+"""
+import argparse
+import asyncore
+import copy
+import gc
+import json
+import platform
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import timeit
+from StringIO import StringIO
+
+import numpy as np
+
+import tactics as t
+import tactics_server as ts
+
+
+BENCHMARKS = []
+
+
+def benchmark(func):
+    """
+    Registers func as a benchmark runnable from the command line
+    """
+    BENCHMARKS.append(func)
+    return func
+
+
+def current_rss():
+    """
+    Returns the resident set size of this process in bytes.
+
+    Reads /proc where it exists and falls back to the peak RSS reported
+    by getrusage elsewhere.
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            return peak
+        return peak * 1024
+
+
+def _measure_child(conn, factory, args):
+    gc.collect()
+    before = current_rss()
+    start = timeit.default_timer()
+    result = factory(*args)
+    elapsed = timeit.default_timer() - start
+    after = current_rss()
+    conn.send((elapsed, after - before))
+    conn.close()
+    del result
+
+
+def measure_in_child(factory, *args):
+    """
+    Calls factory(*args) in a fresh process and returns
+    (seconds, bytes of RSS growth) for that call.
+    """
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=_measure_child,
+                                   args=(child, factory, args))
+    proc.start()
+    result = parent.recv()
+    proc.join()
+    return result
+
+
+@benchmark
+def grid_build(sizes=(100, 500, 1000, 2000)):
+    """
+    Build time and memory of Grid against ArrayGrid
+    """
+    print "%-10s %6s %10s %12s" % ("backend", "size", "seconds", "RSS (MB)")
+    for size in sizes:
+        for grid_class in (t.Grid, t.ArrayGrid):
+            elapsed, rss = measure_in_child(grid_class, size, size)
+            print "%-10s %6d %10.4f %12.1f" % (
+                grid_class.__name__, size, elapsed, rss / 1048576.0)
+
+
+def legacy_neighbors(grid, node, dist):
+    """
+    The original per-delta membership-test implementation of
+    Grid.neighbors, kept as a baseline.
+    """
+    neighbors = []
+    deltas = range(-dist, dist + 1)
+    for delta in deltas:
+        new_x = node.x + delta
+        for delta in deltas:
+            new_y = node.y + delta
+            if (new_x in range(len(grid.nodes)) and
+                    new_y in range(len(grid.nodes[0]))):
+                new_node = grid.get_node(new_x, new_y)
+                if new_node != node:
+                    neighbors.append(new_node)
+    return neighbors
+
+
+@benchmark
+def neighbors(size=500, ranges=(1, 2, 5, 10, 20), repeat=200):
+    """
+    Grid.neighbors query time as the move range grows
+    """
+    grid = t.Grid(size, size)
+    node = grid.get_node(size / 2, size / 2)
+    print "%6s %14s %14s %14s" % ("range", "legacy (us)", "nodes (us)",
+                                  "packed (us)")
+    for dist in ranges:
+        timings = []
+        for query in (lambda: legacy_neighbors(grid, node, dist),
+                      lambda: grid.neighbors(node, dist),
+                      lambda: grid.neighbors(node, dist, packed=True)):
+            seconds = min(timeit.repeat(query, number=repeat, repeat=3))
+            timings.append(seconds / repeat * 1e6)
+        print "%6d %14.1f %14.1f %14.1f" % ((dist,) + tuple(timings))
+
+
+class PlainUnit(object):
+    """
+    Bare speed/ct record for the tick-loop baseline
+    """
+    __slots__ = ('speed', 'ct')
+
+    def __init__(self, speed):
+        self.speed = speed
+        self.ct = 0
+
+
+def legacy_turn_order(units, turns):
+    """
+    The original Battle.tick/advance loop, kept as a baseline
+    """
+    for _ in xrange(turns):
+        active = False
+        while not active:
+            for unit in units:
+                unit.ct += unit.speed
+                if unit.ct >= 100:
+                    active = unit
+        active.ct = 0
+
+
+def scheduled_turn_order(battle, turns):
+    for _ in xrange(turns):
+        battle.advance()
+        battle.active_unit.ct = 0
+        battle.active_unit = False
+
+
+@benchmark
+def turn_order(counts=(10, 100, 1000, 10000), turns=500, seed=0):
+    """
+    Cost of finding the next active unit as the unit count grows
+    """
+    print "%7s %16s %16s" % ("units", "tick loop (us)", "scheduler (us)")
+    for count in counts:
+        rng = random.Random(seed)
+        speeds = [rng.randint(1, 10) for _ in xrange(count)]
+
+        plain = [PlainUnit(speed) for speed in speeds]
+        start = timeit.default_timer()
+        legacy_turn_order(plain, turns)
+        legacy = timeit.default_timer() - start
+
+        battle = t.Battle(t.ArrayGrid(1, 1))
+        for speed in speeds:
+            unit = t.Unit()
+            unit.speed = speed
+            battle.units.append(unit)
+        start = timeit.default_timer()
+        scheduled_turn_order(battle, turns)
+        scheduled = timeit.default_timer() - start
+
+        print "%7d %16.1f %16.1f" % (count, legacy / turns * 1e6,
+                                     scheduled / turns * 1e6)
+
+
+@benchmark
+def turn_forecast(counts=(10, 100, 1000, 10000), lengths=(10, 50), repeat=200):
+    """
+    Forecasting the next activations from CT and speed, against playing
+    them out on a clone, and the forecast right after a speed change
+    """
+    print "%7s %7s %14s %14s %16s" % ("units", "turns", "forecast (us)",
+                                      "clone (us)", "retimed (us)")
+    for count in counts:
+        battle = speed_battle(count)
+        scheduled_turn_order(battle, 50)
+        unit = battle.units[0]
+        for length in lengths:
+            forecast = min(timeit.repeat(lambda: battle.forecast(length),
+                                         number=repeat, repeat=3)) / repeat
+
+            def cloned():
+                scheduled_turn_order(battle.clone(), length)
+            clone = time_call(cloned)[0]
+
+            def retimed():
+                unit.speed = 11 - unit.speed
+                battle.forecast(length)
+            retime = min(timeit.repeat(retimed, number=repeat,
+                                       repeat=3)) / repeat
+            print "%7d %7d %14.1f %14.1f %16.1f" % (
+                count, length, forecast * 1e6, clone * 1e6, retime * 1e6)
+
+
+def scattered_battle(count, size, seed=0):
+    """
+    A Battle with count units on random cells of a size x size ArrayGrid,
+    split between two Teams
+    """
+    rng = random.Random(seed)
+    battle = t.Battle(t.ArrayGrid(size, size))
+    battle.teams = [t.Team(), t.Team()]
+    cells = rng.sample(xrange(size * size), count)
+    for i, cell in enumerate(cells):
+        unit = t.Unit()
+        battle.teams[i % 2].add_unit(unit)
+        unit.join_battle(battle, cell % size, cell // size)
+    return battle
+
+
+@benchmark
+def spatial_queries(counts=(100, 500, 2000), size=200, dist=3, repeat=200):
+    """
+    Enemies-in-range lookups: linear scan against the occupancy index
+    """
+    print "%7s %16s %16s" % ("units", "scan (us)", "index (us)")
+    for count in counts:
+        battle = scattered_battle(count, size)
+        unit = battle.units[0]
+
+        def scan():
+            return [other for other in battle.units
+                    if unit.is_enemy(other) and
+                    max(abs(other.location.x - unit.location.x),
+                        abs(other.location.y - unit.location.y)) <= dist]
+
+        timings = [min(timeit.repeat(query, number=repeat, repeat=3)) / repeat * 1e6
+                   for query in (scan, lambda: unit.enemies_within(dist))]
+        print "%7d %16.1f %16.1f" % ((count,) + tuple(timings))
+
+
+class LegacyTeam(object):
+    """
+    The original list-based Team, kept as a baseline
+    """
+
+    def __init__(self, units):
+        self.all_units = list(units)
+        self.live_units = []
+        self.dead_units = []
+
+    def live_update(self):
+        for unit in self.all_units:
+            if unit.alive:
+                if unit not in self.live_units:
+                    self.live_units.append(unit)
+                if unit in self.dead_units:
+                    self.dead_units.remove(unit)
+            elif not unit.alive:
+                if unit in self.live_units:
+                    self.live_units.remove(unit)
+                if unit not in self.dead_units:
+                    self.dead_units.append(unit)
+
+    def is_defeated(self):
+        self.live_update()
+        return len(self.live_units) == 0
+
+
+@benchmark
+def team_defeat(sizes=(10, 100, 1000, 5000), repeat=20):
+    """
+    Team.is_defeated with half of a large army dead
+    """
+    print "%7s %16s %16s" % ("units", "rescan (us)", "tracked (us)")
+    for size in sizes:
+        units = [t.Unit() for _ in xrange(size)]
+        legacy = LegacyTeam(units)
+        team = t.Team()
+        for unit in units:
+            team.add_unit(unit)
+        for unit in units[::2]:
+            unit.die()
+        legacy_number = max(1, repeat * 100 / size)
+        timings = [
+            min(timeit.repeat(legacy.is_defeated, number=legacy_number,
+                              repeat=3)) / legacy_number * 1e6,
+            min(timeit.repeat(team.is_defeated, number=1000,
+                              repeat=3)) / 1000 * 1e6,
+        ]
+        print "%7d %16.1f %16.3f" % ((size,) + tuple(timings))
+
+
+@benchmark
+def area_attack(counts=(10, 100, 1000, 10000), repeat=5, seed=0):
+    """
+    Resolving one attack against many targets: melee_atk loop against
+    melee_atk_many
+    """
+    print "%7s %14s %14s" % ("targets", "loop (us)", "batched (us)")
+    for count in counts:
+        timings = []
+        for batched in (False, True):
+            best = None
+            for _ in xrange(repeat):
+                team = t.Team()
+                targets = []
+                for _ in xrange(count):
+                    unit = t.Unit()
+                    team.add_unit(unit)
+                    targets.append(unit)
+                attacker = t.Unit()
+                roll = t.HitRoll(0.7, np.random.RandomState(seed))
+                gc.disable()
+                start = timeit.default_timer()
+                if batched:
+                    attacker.melee_atk_many(targets, roll.many)
+                else:
+                    for target in targets:
+                        attacker.melee_atk(target, roll, attacker.melee_dmg)
+                elapsed = timeit.default_timer() - start
+                gc.enable()
+                best = elapsed if best is None else min(best, elapsed)
+            timings.append(best * 1e6)
+        print "%7d %14.1f %14.1f" % ((count,) + tuple(timings))
+
+
+class LegacyUnit(object):
+    """
+    A Unit with the original per-instance __dict__, kept as a baseline
+    """
+
+    def __init__(self):
+        self.speed = 5
+        self.ct = 0
+        self.move_speed = 2
+        self.name = "A"
+        self.max_hp = 100
+        self.current_hp = 100
+        self.alive = True
+        self.moved = False
+        self.acted = False
+        self.turn_finished = False
+        self.location = False
+        self.battle = False
+        self.team = False
+        self.damage_dealt = 0
+
+
+def make_units(kind, count):
+    if kind == "dict":
+        return [LegacyUnit() for _ in xrange(count)]
+    if kind == "slots":
+        return [t.Unit() for _ in xrange(count)]
+    battle = t.Battle(t.ArrayGrid(1, 1), use_table=True)
+    return [battle.new_unit() for _ in xrange(count)]
+
+
+@benchmark
+def unit_storage(counts=(10000, 100000), repeat=3):
+    """
+    Memory and throughput of dict-based, slotted and table-backed Units
+    """
+    print "%7s %7s %12s %12s %16s" % ("kind", "units", "build (s)",
+                                      "bytes/unit", "hp update (ms)")
+    for count in counts:
+        for kind in ("dict", "slots", "table"):
+            elapsed, rss = measure_in_child(make_units, kind, count)
+            units = make_units(kind, count)
+            if kind == "table":
+                hp = units[0].table.column("current_hp")
+
+                def damage():
+                    hp[:] -= 1
+            else:
+                def damage():
+                    for unit in units:
+                        unit.current_hp -= 1
+            hit = min(timeit.repeat(damage, number=1, repeat=repeat))
+            print "%7s %7d %12.3f %12.1f %16.2f" % (
+                kind, count, elapsed, rss / float(count), hit * 1e3)
+
+
+def skirmish_spec(per_team=8, size=20):
+    units = []
+    for i in xrange(per_team):
+        units.append({"team": 0, "x": 0, "y": i * 2 % size, "speed": 4 + i % 5})
+        units.append({"team": 1, "x": size - 1, "y": i * 2 % size,
+                      "speed": 4 + (i + 2) % 5})
+    return t.BattleSpec(size, size, units,
+                        [t.aggressive_policy, t.random_policy], max_turns=2000)
+
+
+@benchmark
+def batch(battles=100, process_counts=(1, 2, 4)):
+    """
+    Headless battle throughput as worker processes are added
+    """
+    spec = skirmish_spec()
+    print "%10s %10s %14s" % ("processes", "seconds", "battles/s")
+    for processes in process_counts:
+        start = timeit.default_timer()
+        t.run_batch(spec, battles, processes)
+        elapsed = timeit.default_timer() - start
+        print "%10d %10.2f %14.1f" % (processes, elapsed, battles / elapsed)
+
+
+def scripted_commands(spec, turns):
+    """
+    Records the commands of a battle played by moving to the first
+    destination, attacking the first target and ending the turn. Returns
+    them with the number of turns played.
+    """
+    cycle = ["Move", "0", "Action", "0", "End Turn"]
+    source = t.CommandSource(cycle[i % len(cycle)] for i in xrange(10 ** 7))
+    log = StringIO()
+    played = spec.build().run_commands(t.CommandRecorder(source, log), turns)
+    return log.getvalue().splitlines(), played
+
+
+@benchmark
+def command_script(turns=2000, repeat=3):
+    """
+    Replaying a recorded command script through the turn menus, quietly
+    and with the menus printed (to /dev/null)
+    """
+    spec = skirmish_spec()
+    commands, turns = scripted_commands(spec, turns)
+    print "%10s %10s %14s %14s" % ("commands", "turns", "quiet (ms)",
+                                   "printed (ms)")
+    timings = []
+    for quiet in (True, False):
+        def replay():
+            spec.build().run_commands(t.CommandSource(commands, quiet))
+        with open(os.devnull, "w") as devnull:
+            stdout, sys.stdout = sys.stdout, devnull
+            try:
+                timings.append(min(timeit.repeat(replay, number=1,
+                                                 repeat=repeat)))
+            finally:
+                sys.stdout = stdout
+    print "%10d %10d %14.1f %14.1f" % (len(commands), turns,
+                                       timings[0] * 1e3, timings[1] * 1e3)
+
+
+def _serve(spec, conn, workers):
+    server = ts.Server(spec, workers=workers, turn_timeout=5.0)
+    conn.send(server.address)
+    server.serve()
+
+
+@benchmark
+def server_load(counts=(10, 50, 200), games=2, workers=2):
+    """
+    Battle server capacity on one core: concurrent Bot clients, each
+    playing games back to back against a policy-played team, with the
+    server in a separate process
+    """
+    spec = skirmish_spec(per_team=4, size=12)
+    spec.max_turns = 100
+    print "%8s %10s %10s %12s %14s %14s" % (
+        "clients", "seconds", "games/s", "commands/s", "median (ms)",
+        "p95 (ms)")
+    for count in counts:
+        parent, child = multiprocessing.Pipe()
+        proc = multiprocessing.Process(target=_serve,
+                                       args=(spec, child, workers))
+        proc.start()
+        address = parent.recv()
+        socket_map = {}
+        start = timeit.default_timer()
+        bots = [ts.Bot(address, games, socket_map) for _ in xrange(count)]
+        while socket_map:
+            asyncore.loop(0.1, map=socket_map, count=1)
+        elapsed = timeit.default_timer() - start
+        proc.terminate()
+        proc.join()
+        latencies = sorted(latency for bot in bots for latency in bot.latencies)
+        played = sum(len(bot.winners) for bot in bots)
+        print "%8d %10.2f %10.1f %12.0f %14.2f %14.2f" % (
+            count, elapsed, played / elapsed, len(latencies) / elapsed,
+            latencies[len(latencies) // 2] * 1e3,
+            latencies[int(len(latencies) * 0.95)] * 1e3)
+
+
+@benchmark
+def action_cache(counts=(50, 200, 1000), size=100, battles=20, mcts_turns=20,
+                 repeat=1000):
+    """
+    Memoized legal moves and adjacent enemies against recomputing them,
+    and the ActionCache hit rates over skirmishes played by the headless
+    policies and by MCTSController through the turn menus
+    """
+    print "%7s %12s %14s %12s %14s" % ("units", "moves (us)", "uncached (us)",
+                                       "enemies (us)", "uncached (us)")
+    for count in counts:
+        battle = scattered_battle(count, size)
+        unit = battle.units[0]
+        unit.move_speed = 4
+        grid = battle.grid
+
+        def uncached_moves():
+            field = grid.reachable(unit.location, unit.move_speed)
+            return grid.nodes_at(field.destinations())
+        timings = [min(timeit.repeat(query, number=repeat, repeat=3)) / repeat
+                   for query in (unit.legal_moves, uncached_moves,
+                                 unit.adjacent_enemies,
+                                 lambda: unit.enemies_within(1))]
+        print "%7d %12.2f %14.2f %12.2f %14.2f" % (
+            (count,) + tuple(timing * 1e6 for timing in timings))
+    print
+    spec = skirmish_spec()
+    policy_battles = []
+    for seed in xrange(battles):
+        rng = random.Random(seed)
+        battle = spec.build()
+        policies = dict(zip(battle.teams, spec.policies))
+        while not battle.defeat_check():
+            battle.policy_turn(policies, rng)
+        policy_battles.append(battle)
+    battle = spec.build()
+    controller = t.MCTSController(battle, iterations=50)
+    for _ in xrange(mcts_turns):
+        battle.next_turn(controller)
+    print "%10s %10s %10s %10s %10s" % ("driver", "kind", "hits", "misses",
+                                        "hit rate")
+    for driver, played in (("policies", policy_battles), ("mcts", [battle])):
+        for kind in t.ActionCache.KINDS:
+            hits = sum(battle.actions.hits[kind] for battle in played)
+            misses = sum(battle.actions.misses[kind] for battle in played)
+            print "%10s %10s %10d %10d %10.2f" % (
+                driver, kind, hits, misses, hits / float(hits + misses or 1))
+
+
+def naive_threat(battle):
+    """
+    Per-cell threat counts rebuilt from legal_moves and Grid.neighbors,
+    kept as a baseline
+    """
+    counts = {}
+    for unit in battle.units:
+        cells = set()
+        for node in unit.legal_moves() + [unit.location]:
+            cells.add((node.x, node.y))
+            for near in battle.grid.neighbors(node, 1):
+                cells.add((near.x, near.y))
+        for cell in cells:
+            counts[cell] = counts.get(cell, 0) + 1
+    return counts
+
+
+@benchmark
+def threat_map(counts=(200, 500, 1000), size=200, moves=50, seed=0):
+    """
+    Threat map upkeep: naive rebuild against ThreatMap.rebuild and the
+    incremental update after one move
+    """
+    print "%7s %14s %14s %16s %14s" % ("units", "naive (ms)", "rebuild (ms)",
+                                       "per move (us)", "safest (us)")
+    for count in counts:
+        battle = scattered_battle(count, size, seed)
+        naive = min(timeit.repeat(lambda: naive_threat(battle), number=1,
+                                  repeat=3))
+        threats = battle.threat_map()
+        rebuild = min(timeit.repeat(threats.rebuild, number=1, repeat=3))
+        rng = random.Random(seed)
+        units = rng.sample(battle.units, moves)
+        steps = []
+        for unit in units:
+            legal = unit.legal_moves()
+            if legal:
+                steps.append((unit, rng.choice(legal)))
+        start = timeit.default_timer()
+        for unit, node in steps:
+            unit.move(node)
+        per_move = (timeit.default_timer() - start) / max(len(steps), 1)
+        unit = battle.units[0]
+        safest = min(timeit.repeat(lambda: threats.safest_cell(unit),
+                                   number=100, repeat=3)) / 100
+        print "%7d %14.1f %14.1f %16.1f %14.1f" % (
+            count, naive * 1e3, rebuild * 1e3, per_move * 1e6, safest * 1e6)
+
+
+def pairwise_sight(battle, radius):
+    """
+    Who-sees-whom from a Bresenham check on every pair in range, kept as
+    a baseline
+    """
+    seen = set()
+    grid = battle.grid
+    for viewer in battle.units:
+        a = viewer.location
+        for target in battle.units:
+            b = target.location
+            if (target is not viewer and
+                    (a.x - b.x) ** 2 + (a.y - b.y) ** 2 <= radius ** 2 and
+                    grid.line_of_sight(a.x, a.y, b.x, b.y)):
+                seen.add((viewer, target))
+    return seen
+
+
+@benchmark
+def visibility(counts=(50, 200, 500), size=100, radius=t.SIGHT_RADIUS,
+               seed=0):
+    """
+    Who-sees-whom per turn: pairwise LOS against sight_matrix with cold
+    and warm field-of-view caches
+    """
+    print "%7s %14s %12s %12s %14s" % ("units", "pairwise (ms)", "cold (ms)",
+                                       "warm (ms)", "fog mask (ms)")
+    for count in counts:
+        battle = scattered_battle(count, size, seed)
+        rng = random.Random(seed)
+        for _ in xrange(size * size // 10):
+            battle.grid.set_terrain(rng.randrange(size), rng.randrange(size),
+                                    t.WALL)
+        pairwise = min(timeit.repeat(lambda: pairwise_sight(battle, radius),
+                                     number=1, repeat=3))
+        start = timeit.default_timer()
+        battle.sight_matrix(radius)
+        cold = timeit.default_timer() - start
+        warm = min(timeit.repeat(lambda: battle.sight_matrix(radius),
+                                 number=5, repeat=3)) / 5
+        fog = min(timeit.repeat(
+            lambda: battle.visible_mask(battle.teams[0], radius),
+            number=5, repeat=3)) / 5
+        print "%7d %14.1f %12.1f %12.1f %14.1f" % (
+            count, pairwise * 1e3, cold * 1e3, warm * 1e3, fog * 1e3)
+
+
+def endless_spec(per_team=8, size=20):
+    """
+    A skirmish whose units cannot hurt each other, so it runs as long as
+    asked
+    """
+    spec = skirmish_spec(per_team, size)
+    for info in spec.units:
+        info["max_hp"] = 10 ** 9
+    spec.policies = [t.random_policy, t.random_policy]
+    return spec
+
+
+@benchmark
+def replay(turns=5000, intervals=(10, 50, 250), seed=0):
+    """
+    Replay log size, recording overhead and seek latency by keyframe
+    interval
+    """
+    from StringIO import StringIO
+    spec = endless_spec()
+    spec.max_turns = turns
+    start = timeit.default_timer()
+    t.simulate(spec, seed)
+    plain = timeit.default_timer() - start
+    print "%d turns, %.2f s unrecorded" % (turns, plain)
+    print "%9s %12s %12s %14s %14s" % ("interval", "bytes/turn", "overhead",
+                                       "seek mid (ms)", "seek end (ms)")
+    for interval in intervals:
+        battle = spec.build()
+        policies = dict(zip(battle.teams, spec.policies))
+        rng = random.Random(seed)
+        log = StringIO()
+        start = timeit.default_timer()
+        battle.record(log, interval)
+        for _ in xrange(turns):
+            battle.policy_turn(policies, rng)
+        battle.stop_recording()
+        recorded = timeit.default_timer() - start
+        data = log.getvalue()
+        log_replay = t.Replay(data)
+        seeks = [min(timeit.repeat(lambda: log_replay.battle_at(turn),
+                                   number=3, repeat=3)) / 3 * 1e3
+                 for turn in (turns // 2 + interval // 2 - 1, turns)]
+        print "%9d %12.1f %11.0f%% %14.2f %14.2f" % (
+            interval, len(data) / float(turns),
+            (recorded / plain - 1) * 100, seeks[0], seeks[1])
+
+
+@benchmark
+def profiler(battles=20, repeat=3):
+    """
+    Headless battle time with the Profiler never enabled, enabled, and
+    enabled then disabled again
+    """
+    spec = skirmish_spec()
+
+    def run():
+        for seed in xrange(battles):
+            t.simulate(spec, seed)
+    baseline = min(timeit.repeat(run, number=1, repeat=repeat))
+    profiled = t.Profiler()
+    with profiled:
+        enabled = min(timeit.repeat(run, number=1, repeat=repeat))
+    disabled = min(timeit.repeat(run, number=1, repeat=repeat))
+    print "%14s %14s %14s" % ("off (s)", "enabled (s)", "disabled (s)")
+    print "%14.3f %14.3f %14.3f" % (baseline, enabled, disabled)
+
+
+@benchmark
+def snapshot(cases=((20, 16), (100, 200), (500, 2000)), repeat=5):
+    """
+    Snapshot size and save, load and clone latency against deepcopy
+    """
+    print "%6s %7s %12s %10s %10s %10s %12s" % (
+        "size", "units", "bytes", "save (ms)", "load (ms)", "clone (ms)",
+        "deepcopy (ms)")
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        for size, count in cases:
+            battle = scattered_battle(count, size)
+            data = battle.snapshot()
+            timings = [
+                min(timeit.repeat(query, number=1, repeat=repeat)) * 1e3
+                for query in (lambda: battle.save(path),
+                              lambda: t.Battle.load(path),
+                              battle.clone,
+                              lambda: copy.deepcopy(battle))]
+            print "%6d %7d %12d %10.2f %10.2f %10.2f %12.2f" % (
+                (size, count, len(data)) + tuple(timings))
+    finally:
+        os.remove(path)
+
+
+@benchmark
+def mcts(cases=((10, 6), (50, 40), (200, 200)), iterations=100,
+         time_limit=0.1):
+    """
+    MCTS decision cost as the map grows: a fixed rollout budget, and the
+    iterations completed within a fixed time budget
+    """
+    print "%6s %7s %18s %14s %14s" % ("size", "units", "100 iters (ms)",
+                                      "budget (ms)", "iterations")
+    for size, count in cases:
+        battle = scattered_battle(count, size)
+        battle.advance()
+        start = timeit.default_timer()
+        t.mcts_search(battle, iterations, rng=random.Random(0))
+        fixed = timeit.default_timer() - start
+        start = timeit.default_timer()
+        stats = t.mcts_search(battle, deadline=time.time() + time_limit,
+                              rng=random.Random(0))
+        budget = timeit.default_timer() - start
+        done = sum(visits for visits, _ in stats.values())
+        print "%6d %7d %18.1f %14.1f %14d" % (size, count, fixed * 1e3,
+                                              budget * 1e3, done)
+
+
+@benchmark
+def live_simulation(seed=0, slow_frame=0.05, lockstep_turns=60, per_team=24):
+    """
+    Battle throughput while a renderer that takes slow_frame seconds per
+    frame watches it: drawing after every turn on one thread, against a
+    Simulation process sampled by the renderer at its own rate
+    """
+    spec = skirmish_spec(per_team, 2 * per_team)
+    surface = t.pygame.Surface((t.Visualizer.WINDOWWIDTH,
+                                t.Visualizer.WINDOWHEIGHT), 0, 32)
+    print "%10s %8s %10s %8s %9s" % ("mode", "turns", "turns/s", "frames",
+                                     "skipped")
+    start = timeit.default_timer()
+    turns = t.simulate(spec, seed)["turns"]
+    elapsed = timeit.default_timer() - start
+    print "%10s %8d %10.0f %8s %9s" % ("headless", turns, turns / elapsed,
+                                       "-", "-")
+
+    battle = spec.build()
+    policies = dict(zip(battle.teams, spec.policies))
+    rng = random.Random(seed)
+    visualizer = t.Visualizer(battle, screen=surface)
+    visualizer.draw()
+    start = timeit.default_timer()
+    for _ in xrange(lockstep_turns):
+        battle.policy_turn(policies, rng)
+        visualizer.draw_dirty()
+        time.sleep(slow_frame)
+    elapsed = timeit.default_timer() - start
+    print "%10s %8d %10.0f %8d %9d" % ("lockstep", lockstep_turns,
+                                       lockstep_turns / elapsed,
+                                       lockstep_turns, 0)
+
+    visualizer = t.Visualizer(spec.build(), screen=surface)
+    visualizer.draw()
+    start = timeit.default_timer()
+    simulation = t.Simulation(spec, seed).start()
+    frames = 0
+    frame = None
+    while frame is None or not frame.finished:
+        newest = simulation.frames.latest()
+        if newest is not None:
+            frame = newest
+            visualizer.show_frame(frame)
+            frames += 1
+        visualizer.draw_dirty()
+        time.sleep(slow_frame)
+    elapsed = timeit.default_timer() - start
+    simulation.stop()
+    print "%10s %8d %10.0f %8d %9d" % ("process", frame.turn,
+                                       frame.turn / elapsed, frames,
+                                       simulation.frames.skipped)
+
+
+def loaded_array_grid(size):
+    """
+    A size x size ArrayGrid with every cell written, as after loading a map
+    """
+    grid = t.ArrayGrid(size, size)
+    grid.terrain.fill(t.ROUGH)
+    grid.heights.fill(1)
+    return grid
+
+
+def opened_chunked_grid(path, window=256):
+    """
+    The ChunkedGrid map file at path with a window x window corner read in
+    """
+    grid = t.ChunkedGrid.open(path)
+    for y in xrange(0, window, grid.tile_size):
+        for x in xrange(0, window, grid.tile_size):
+            grid.terrain_at(x, y)
+    return grid
+
+
+@benchmark
+def chunked_grid(sizes=(1000, 4000, 10000), queries=20000, seed=0):
+    """
+    Load time and memory of a fully written ArrayGrid against a ChunkedGrid
+    map file with one corner in use, and ChunkedGrid lookup and neighbors
+    latency as the working set outgrows the tile cap
+    """
+    print "%-12s %6s %10s %12s" % ("backend", "size", "seconds", "RSS (MB)")
+    handle, path = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        for size in sizes:
+            t.ChunkedGrid.create_map(path, size, size)
+            for name, factory, arg in (
+                    ("ArrayGrid", loaded_array_grid, size),
+                    ("ChunkedGrid", opened_chunked_grid, path)):
+                elapsed, rss = measure_in_child(factory, arg)
+                print "%-12s %6d %10.4f %12.1f" % (name, size, elapsed,
+                                                   rss / 1048576.0)
+    finally:
+        os.remove(path)
+    print
+    print "%8s %10s %14s %16s %10s" % ("spread", "tiles", "lookup (us)",
+                                       "neighbors (us)", "evictions")
+    size = sizes[-1]
+    for spread in (256, 1024, 4096, size):
+        rng = random.Random(seed)
+        grid = t.ChunkedGrid(size, size)
+        cells = [(rng.randrange(spread), rng.randrange(spread))
+                 for _ in xrange(queries)]
+        start = timeit.default_timer()
+        for x, y in cells:
+            grid.step_cost(x, y)
+        lookup = (timeit.default_timer() - start) / queries
+        start = timeit.default_timer()
+        for x, y in cells[:queries // 10]:
+            grid.neighbors(grid.get_node(x, y), 2)
+        near = (timeit.default_timer() - start) / (queries // 10)
+        print "%8d %10d %14.2f %16.2f %10d" % (spread, len(grid.tiles),
+                                               lookup * 1e6, near * 1e6,
+                                               grid.evictions)
+
+
+SUITE = []
+
+
+def per_cell_frame(visualizer):
+    """
+    The original drawing loop, kept as a baseline: a Rect and a
+    draw.rect call per cell, a line per row and column, and separate
+    draw calls for each unit's body and HP bar
+    """
+    screen = visualizer.screen
+    camera = visualizer.camera
+    grid = visualizer.grid
+    x0, y0, x1, y1 = camera.view()
+    size = camera.cell_size
+    screen.fill(visualizer.BLACK)
+    for y in xrange(y0, y1):
+        for x in xrange(x0, x1):
+            color = visualizer.TERRAIN_COLORS.get(grid.terrain_at(x, y),
+                                                  visualizer.WHITE)
+            rect = t.pygame.Rect((x - x0) * size, (y - y0) * size,
+                                        size, size)
+            t.pygame.draw.rect(screen, color, rect)
+    for x in xrange(x1 - x0):
+        t.pygame.draw.line(screen, visualizer.DK_GREY, (x * size, 0),
+                           (x * size, (y1 - y0) * size))
+    for y in xrange(y1 - y0):
+        t.pygame.draw.line(screen, visualizer.DK_GREY, (0, y * size),
+                           ((x1 - x0) * size, y * size))
+    for unit in visualizer.units_in_view():
+        rect = camera.cell_rect(unit.location.x, unit.location.y)
+        color = visualizer.BLACK if unit.alive else visualizer.GREY
+        t.pygame.draw.circle(screen, color, rect.center, int(.45 * size))
+        bar = t.pygame.Rect(rect.left + 1, rect.bottom - 4, size - 2, 3)
+        t.pygame.draw.rect(screen, visualizer.RED, bar)
+        bar.width = int(bar.width * unit.current_hp / float(unit.max_hp))
+        t.pygame.draw.rect(screen, visualizer.GREEN, bar)
+
+
+@benchmark
+def board_draw(sizes=(50, 100, 200), units=400):
+    """
+    Headless frames on an offscreen surface: the original per-cell draw
+    calls against the board built from a colour array with units stamped
+    from the sprite atlas, and a whole Visualizer frame from the cached
+    background
+    """
+    print "%8s %14s %11s %9s %11s" % ("grid", "per cell (ms)", "array (ms)",
+                                      "speedup", "frame (ms)")
+    for size in sizes:
+        battle = scattered_battle(min(units, size * size // 4), size)
+        rng = random.Random(size)
+        for x, y in rng.sample([(x, y) for x in xrange(size)
+                                for y in xrange(size)], size * size // 10):
+            if not battle.grid.get_node(x, y).occupied:
+                battle.grid.set_terrain(x, y, rng.choice((t.ROUGH, t.WATER,
+                                                          t.WALL)))
+        surface = t.pygame.Surface((t.Visualizer.WINDOWWIDTH,
+                                    t.Visualizer.WINDOWHEIGHT), 0, 32)
+        visualizer = t.Visualizer(battle, screen=surface)
+
+        def array_frame():
+            surface.fill(visualizer.BLACK)
+            visualizer.fill_grid()
+            visualizer.place_units()
+        per_cell = time_call(lambda: per_cell_frame(visualizer))[0]
+        array = time_call(array_frame)[0]
+        frame = time_call(visualizer.draw)[0]
+        print "%8s %14.2f %11.2f %8.1fx %11.2f" % (
+            "%dx%d" % (size, size), per_cell * 1e3, array * 1e3,
+            per_cell / array, frame * 1e3)
+
+
+def case(axis, values, quick=None):
+    """
+    Registers a suite case. The decorated setup(value) builds whatever is
+    needed and returns the callable to time; it is called once for each
+    value of axis (only the quick values under --quick).
+    """
+    def register(setup):
+        SUITE.append((setup.__name__, axis, values, quick or values[:2], setup))
+        return setup
+    return register
+
+
+def time_call(func, min_time=0.05, repeat=3):
+    """
+    Returns (best seconds per call, calls per timing run). The number of
+    calls is raised until one run takes at least min_time.
+    """
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed * 10 > min_time else 10
+    runs = [elapsed] + timeit.repeat(func, number=number, repeat=repeat - 1)
+    return min(runs) / number, number
+
+
+@case("size", (50, 100, 200, 400))
+def grid_init(size):
+    return lambda: t.Grid(size, size)
+
+
+@case("size", (50, 100, 200, 400, 1000))
+def array_grid_init(size):
+    return lambda: t.ArrayGrid(size, size)
+
+
+@case("size", (1000, 10000, 100000))
+def chunked_grid_lookup(size):
+    rng = random.Random(0)
+    grid = t.ChunkedGrid(size, size)
+    cells = [(rng.randrange(size), rng.randrange(size)) for _ in xrange(100)]
+
+    def run():
+        for x, y in cells:
+            grid.step_cost(x, y)
+    return run
+
+
+@case("range", (1, 2, 5, 10, 20))
+def grid_neighbors(dist):
+    grid = t.Grid(200, 200)
+    node = grid.get_node(100, 100)
+    return lambda: grid.neighbors(node, dist)
+
+
+@case("range", (1, 2, 4, 8))
+def legal_moves(move_speed):
+    battle = scattered_battle(200, 100)
+    unit = battle.units[0]
+    unit.move_speed = move_speed
+
+    def run():
+        battle.grid.reach_cache.clear()
+        return unit.legal_moves()
+    return run
+
+
+def speed_battle(count, seed=0):
+    rng = random.Random(seed)
+    battle = t.Battle(t.ArrayGrid(1, 1))
+    for _ in xrange(count):
+        unit = t.Unit()
+        unit.speed = rng.randint(1, 10)
+        battle.units.append(unit)
+    return battle
+
+
+@case("units", (10, 100, 1000, 10000))
+def battle_advance(count):
+    battle = speed_battle(count)
+
+    def run():
+        battle.advance()
+        battle.active_unit.ct = 0
+        battle.active_unit = False
+    return run
+
+
+@case("units", (10, 100, 1000, 10000))
+def battle_tick(count):
+    battle = speed_battle(count)
+
+    def run():
+        battle.tick()
+        battle.active_unit = False
+    return run
+
+
+@case("units", (10, 100, 1000, 10000))
+def battle_forecast(count):
+    battle = speed_battle(count)
+    return lambda: battle.forecast(10)
+
+
+@case("units", (10, 100, 1000, 10000))
+def team_is_defeated(count):
+    team = t.Team()
+    units = [t.Unit() for _ in xrange(count)]
+    for unit in units:
+        team.add_unit(unit)
+    for unit in units[::2]:
+        unit.die()
+    return team.is_defeated
+
+
+@case("units", (2, 50, 200))
+def visualizer_draw(count):
+    battle = scattered_battle(count, 20)
+    surface = t.pygame.Surface((t.Visualizer.WINDOWWIDTH,
+                                t.Visualizer.WINDOWHEIGHT), 0, 32)
+    return t.Visualizer(battle, screen=surface).draw
+
+
+@case("size", (100, 1000, 3000), quick=(100, 1000))
+def camera_draw(size):
+    battle = scattered_battle(size // 2, size)
+    surface = t.pygame.Surface((t.Visualizer.WINDOWWIDTH,
+                                t.Visualizer.WINDOWHEIGHT), 0, 32)
+    visualizer = t.Visualizer(battle, screen=surface)
+    visualizer.camera.center_on(size // 2, size // 2)
+    return visualizer.draw
+
+
+@case("battles", (2, 5, 20))
+def headless_batch(battles):
+    spec = skirmish_spec()
+    return lambda: t.run_batch(spec, battles, processes=1)
+
+
+def run_suite(selected, quick=False):
+    """
+    Times the selected suite cases and returns one result dict per case
+    and value
+    """
+    results = []
+    print "%-20s %8s %8s %14s %10s" % ("case", "axis", "value", "per call (us)",
+                                        "calls")
+    for name, axis, values, quick_values, setup in SUITE:
+        if selected is not None and name not in selected:
+            continue
+        for value in (quick_values if quick else values):
+            seconds, number = time_call(setup(value))
+            print "%-20s %8s %8s %14.2f %10d" % (name, axis, value,
+                                                 seconds * 1e6, number)
+            results.append({"case": name, "axis": axis, "value": value,
+                            "seconds": seconds, "number": number})
+    return results
+
+
+def save_results(path, results):
+    info = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(path, "w") as out:
+        json.dump({"info": info, "results": results}, out, indent=1,
+                  sort_keys=True)
+
+
+def compare(old_path, new_path, threshold=0.1):
+    """
+    Prints the per-call time of every case in both runs and returns the
+    (case, value, ratio) of those more than threshold slower in new
+    """
+    def load(path):
+        with open(path) as results_file:
+            results = json.load(results_file)["results"]
+        return dict(((result["case"], result["value"]), result["seconds"])
+                    for result in results)
+    old, new = load(old_path), load(new_path)
+    regressions = []
+    print "%-20s %8s %12s %12s %8s" % ("case", "value", "old (us)",
+                                       "new (us)", "ratio")
+    for key in sorted(set(old) & set(new)):
+        ratio = new[key] / old[key]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "REGRESSION"
+            regressions.append(key + (ratio,))
+        elif ratio < 1 - threshold:
+            flag = "faster"
+        line = "%-20s %8s %12.2f %12.2f %8.2f %s" % (
+            key[0], key[1], old[key] * 1e6, new[key] * 1e6, ratio, flag)
+        print line.rstrip()
+    for key in sorted(set(old) ^ set(new)):
+        print "%-20s %8s only in %s" % (key[0], key[1],
+                                        old_path if key in old else new_path)
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmarks for the tactics hot paths")
+    parser.add_argument("names", nargs="*",
+                        help="benchmarks or suite cases to run ('suite' for "
+                             "every suite case); all when omitted")
+    parser.add_argument("--quick", action="store_true",
+                        help="only the smallest values of each suite axis")
+    parser.add_argument("--json", metavar="PATH",
+                        help="write the suite results to PATH")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                        help="compare two saved suite runs")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown ratio above 1 flagged as a regression")
+    args = parser.parse_args(argv[1:])
+
+    if args.compare:
+        regressions = compare(args.compare[0], args.compare[1], args.threshold)
+        print "%d regression(s)" % len(regressions)
+        return 1 if regressions else 0
+
+    selected = set(args.names)
+    for func in BENCHMARKS:
+        if selected and func.__name__ not in selected:
+            continue
+        print "== %s: %s" % (func.__name__, func.__doc__.strip())
+        func()
+        print
+    suite_names = set(name for name, _, _, _, _ in SUITE)
+    cases = None
+    if "suite" not in selected and selected:
+        cases = selected & suite_names
+    if cases is None or cases:
+        print "== suite"
+        results = run_suite(cases, args.quick)
+        if args.json:
+            save_results(args.json, results)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -3,18 +3,98 @@ Created on Aug 11, 2014
 
 @author: rwill127
 """
+import argparse
+import bisect
+import collections
+import heapq
+import json
+import math
+import mmap
+import multiprocessing
+import numpy as np
+import os
 import pygame
+import Queue
+import random
+import struct
 import sys
+import threading
+import time
+import timeit
+import weakref
+import zlib
+
+
+CHEBYSHEV = "chebyshev"
+MANHATTAN = "manhattan"
+EUCLIDEAN = "euclidean"
+
+PLAIN, ROUGH, WATER, WALL = range(4)
+
+# Move points needed to enter each terrain type. None is impassable.
+TERRAIN_COSTS = {
+    PLAIN: 1,
+    ROUGH: 2,
+    WATER: None,
+    WALL: None,
+}
+
+# Terrain that blocks line of sight
+SIGHT_BLOCKERS = frozenset([WALL])
+
+# How far units see, in squares (Euclidean)
+SIGHT_RADIUS = 8
+
+# Multipliers mapping shadowcasting's first octant onto all eight
+_OCTANTS = ((1, 0, 0, 1), (0, 1, 1, 0), (0, -1, 1, 0), (-1, 0, 0, 1),
+            (-1, 0, 0, -1), (0, -1, -1, 0), (0, 1, -1, 0), (1, 0, 0, -1))
+
+_stencils = {}
+
+
+def offset_stencil(dist, metric=CHEBYSHEV):
+    """
+    Returns a read-only (n, 2) array of the (dx, dy) offsets within dist
+    of the origin under metric, excluding the origin itself.
+
+    Offsets are ordered by dx, then dy. Stencils are built once per
+    (dist, metric) and cached.
+    """
+    key = (dist, metric)
+    try:
+        return _stencils[key]
+    except KeyError:
+        pass
+    deltas = np.arange(-dist, dist + 1)
+    dx = np.repeat(deltas, len(deltas))
+    dy = np.tile(deltas, len(deltas))
+    if metric == CHEBYSHEV:
+        inside = np.ones(len(dx), dtype=np.bool_)
+    elif metric == MANHATTAN:
+        inside = np.abs(dx) + np.abs(dy) <= dist
+    elif metric == EUCLIDEAN:
+        inside = dx * dx + dy * dy <= dist * dist
+    else:
+        raise ValueError("Unknown metric %r" % (metric,))
+    inside &= (dx != 0) | (dy != 0)
+    stencil = np.column_stack((dx[inside], dy[inside]))
+    stencil.flags.writeable = False
+    _stencils[key] = stencil
+    return stencil
 
 
 class Node(object):
     """
     A single location on a map grid.
     """
+    __slots__ = ('x', 'y', 'terrain', 'height', 'occupied')
 
     def __init__(self, x, y):
         self.x = x
         self.y = y
+        self.terrain = 0
+        self.height = 0
+        self.occupied = False
 
     def __str__(self):
         return "Node(%s, %s)" % (
@@ -25,11 +105,241 @@ class Node(object):
     def __repr__(self):
         return "Node(%r, %r)" % (self.x, self.y)
 
+    def __eq__(self, other):
+        """
+        Nodes are equal when they refer to the same coordinates, so that
+        views created on demand compare equal to each other.
+        """
+        if not isinstance(other, Node):
+            return NotImplemented
+        return self.x == other.x and self.y == other.y
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash((self.x, self.y))
+
+    def copy(self):
+        node = Node(self.x, self.y)
+        node.terrain = self.terrain
+        node.height = self.height
+        node.occupied = self.occupied
+        return node
+
+
+class NodeView(Node):
+    """
+    A Node backed by one cell of an ArrayGrid.
+
+    Views are created on demand by ArrayGrid.get_node(); terrain, height
+    and occupied read and write straight through to the grid's arrays.
+    """
+    __slots__ = ('grid',)
+
+    def __init__(self, grid, x, y):
+        self.grid = grid
+        self.x = x
+        self.y = y
+
+    def __reduce__(self):
+        # The inherited slot state would write the cell properties before
+        # grid is set
+        return NodeView, (self.grid, self.x, self.y)
+
+    @property
+    def terrain(self):
+        return self.grid.terrain_at(self.x, self.y)
+
+    @terrain.setter
+    def terrain(self, value):
+        self.grid.set_terrain(self.x, self.y, value)
+
+    @property
+    def height(self):
+        return self.grid.height_at(self.x, self.y)
+
+    @height.setter
+    def height(self, value):
+        self.grid.set_height(self.x, self.y, value)
+
+    @property
+    def occupied(self):
+        return self.grid.is_occupied(self.x, self.y)
+
+    @occupied.setter
+    def occupied(self, value):
+        self.grid.set_occupied(self.x, self.y, value)
+
+
+class ReachField(object):
+    """
+    The result of a move-point flood fill from one cell.
+
+    costs maps each reachable (x, y) to the cheapest cost of reaching it.
+    explored holds every cell whose terrain or occupancy was looked at,
+    i.e. every cell the result depends on.
+    """
+    __slots__ = ('origin', 'budget', 'costs', 'explored', '_destinations')
+
+    def __init__(self, origin, budget, costs, explored):
+        self.origin = origin
+        self.budget = budget
+        self.costs = costs
+        self.explored = explored
+        self._destinations = None
+
+    def destinations(self):
+        """
+        Returns the reachable cells other than the origin as an (n, 2)
+        array, ordered by x, then y.
+        """
+        if self._destinations is None:
+            cells = sorted(cell for cell in self.costs if cell != self.origin)
+            self._destinations = np.array(cells, dtype=np.intp).reshape(-1, 2)
+        return self._destinations
+
+
+class FieldOfView(object):
+    """
+    The cells visible from one cell out to a Euclidean radius.
+
+    visible is the set of visible (x, y), including the origin and any
+    blocking cells whose faces can be seen.
+    """
+    __slots__ = ('origin', 'radius', 'visible', '_cells')
+
+    def __init__(self, origin, radius, visible):
+        self.origin = origin
+        self.radius = radius
+        self.visible = visible
+        self._cells = None
+
+    def __contains__(self, cell):
+        return cell in self.visible
+
+    def cells(self):
+        """
+        Returns the visible cells as an (n, 2) array, ordered by x, then y
+        """
+        if self._cells is None:
+            self._cells = np.array(sorted(self.visible),
+                                   dtype=np.intp).reshape(-1, 2)
+        return self._cells
+
+
+class FieldCache(object):
+    """
+    A least recently used cache of fields keyed by (x, y, r), holding at
+    most size of them.
+
+    depends names the field attribute holding the cells a field was worked
+    out from, all within r + pad squares of (x, y). Keys are also filed
+    under the BUCKET x BUCKET blocks of cells they reach, so drop_cell()
+    only looks at fields near an edit.
+    """
+    BUCKET = 8
+
+    def __init__(self, size, depends, pad=0):
+        self.size = size
+        self.depends = depends
+        self.pad = pad
+        self.fields = {}
+        self.used = {}
+        self.buckets = {}
+        self.clock = 0
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __contains__(self, key):
+        return key in self.fields
+
+    def get(self, key):
+        field = self.fields.get(key)
+        if field is not None:
+            self.clock += 1
+            self.used[key] = self.clock
+        return field
+
+    def put(self, key, field):
+        if key in self.fields:
+            self.discard(key)
+        self.clock += 1
+        self.fields[key] = field
+        self.used[key] = self.clock
+        buckets = self.buckets
+        for bucket in self.buckets_of(key):
+            keys = buckets.get(bucket)
+            if keys is None:
+                buckets[bucket] = set([key])
+            else:
+                keys.add(key)
+        if len(self.fields) > self.size:
+            self.evict()
+
+    def buckets_of(self, key):
+        x, y, r = key[:3]
+        reach = r + self.pad
+        size = self.BUCKET
+        columns = xrange((x - reach) // size, (x + reach) // size + 1)
+        return [(column, row)
+                for row in xrange((y - reach) // size, (y + reach) // size + 1)
+                for column in columns]
+
+    def evict(self):
+        """
+        Drops least recently used fields down to a tenth below the cap, so
+        that evictions come in batches, as ChunkedGrid does with tiles
+        """
+        target = self.size - max(1, self.size // 10)
+        oldest = sorted(self.used, key=self.used.get)
+        for key in oldest[:len(self.fields) - target]:
+            self.discard(key)
+
+    def discard(self, key):
+        if self.fields.pop(key, None) is None:
+            return
+        del self.used[key]
+        buckets = self.buckets
+        for bucket in self.buckets_of(key):
+            keys = buckets.get(bucket)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del buckets[bucket]
+
+    def drop_cell(self, x, y):
+        """
+        Drops every field that depends on the cell at (x,y)
+        """
+        keys = self.buckets.get((x // self.BUCKET, y // self.BUCKET))
+        if not keys:
+            return
+        cell = (x, y)
+        fields = self.fields
+        depends = self.depends
+        stale = [key for key in keys if cell in getattr(fields[key], depends)]
+        for key in stale:
+            self.discard(key)
+
+    def clear(self):
+        self.fields.clear()
+        self.used.clear()
+        self.buckets.clear()
+
 
 class Grid(object):
     """
     A cartesian grid of nodes, stored as a list of lists
     """
+    # Most ReachFields kept by reachable() and FieldOfViews by
+    # field_of_view()
+    REACH_CACHE_SIZE = 2048
+    FOV_CACHE_SIZE = 2048
 
     def __init__(self, x, y):
         """
@@ -40,6 +350,9 @@ class Grid(object):
         To avoid confusion, use get_node(x, y) instead of
         raw indexing.
         """
+        self.width = x
+        self.height = y
+        self._new_caches()
         self.nodes = []
         for j in range(y):
             self.nodes.append([])
@@ -47,309 +360,4164 @@ class Grid(object):
                 new_node = Node(i, j)
                 self.nodes[j].append(new_node)
 
+    def _new_caches(self):
+        """
+        Gives the grid empty reach and field of view caches. Every grid
+        class sets them up here, from its constructor and copy().
+        """
+        self.reach_cache = FieldCache(self.REACH_CACHE_SIZE, "explored", 1)
+        self.fov_cache = FieldCache(self.FOV_CACHE_SIZE, "visible")
+
     def get_node(self, x, y):
         """
         Returns the Node at (x,y). Use to avoid x/y coordinate confusion
         """
         return self.nodes[y][x]
 
-    def neighbors(self, node, dist):
+    def iter_nodes(self):
         """
-        Returns a list of Nodes that are within dist squares of the original Node.
+        Yields every Node in the grid, row by row.
         """
-        neighbors = []
-        deltas = range(-dist, dist + 1)
-        for delta in deltas:
-            new_x = node.x + delta
-            for delta in deltas:
-                new_y = node.y + delta
-                if (new_x in range(len(self.nodes)) and
-                            new_y in range(len(self.nodes[0]))
-                ):
-                    new_node = self.get_node(new_x, new_y)
-                    if new_node != node:
-                        neighbors.append(new_node)
-        return neighbors
+        for row in self.nodes:
+            for node in row:
+                yield node
 
+    def copy(self):
+        """
+        Returns a copy of the grid's cells. Cached ReachFields are not
+        copied.
+        """
+        grid = type(self).__new__(type(self))
+        grid.width = self.width
+        grid.height = self.height
+        grid._new_caches()
+        grid.nodes = [[node.copy() for node in row] for row in self.nodes]
+        return grid
 
-class Unit(object):
-    def __init__(self):
-        self.speed = 5
-        self.ct = 0
-        self.move_speed = 2
-        self.name = "A"
-        self.max_hp = 100
-        self.current_hp = 100
-        self.alive = True
+    def cell_arrays(self):
+        """
+        Returns the terrain, height and occupancy of every cell as flat
+        arrays in row order, the layout ArrayGrid uses
+        """
+        nodes = list(self.iter_nodes())
+        return (np.array([node.terrain for node in nodes], dtype=np.uint8),
+                np.array([node.height for node in nodes], dtype=np.int16),
+                np.array([node.occupied for node in nodes], dtype=np.bool_))
 
-        self.moved = False
-        self.acted = False
-        self.turn_finished = False
+    def load_cell_arrays(self, terrain, heights, occupancy):
+        """
+        Overwrites every cell from flat arrays in row order
+        """
+        cells = zip(self.iter_nodes(), terrain.tolist(), heights.tolist(),
+                    occupancy.tolist())
+        for node, node_terrain, node_height, node_occupied in cells:
+            node.terrain = node_terrain
+            node.height = node_height
+            node.occupied = node_occupied
+        self.reach_cache.clear()
+        self.fov_cache.clear()
 
-        self.location = False
-        self.battle = False
+    def terrain_at(self, x, y):
+        return self.nodes[y][x].terrain
 
+    def terrain_in(self, x0, y0, x1, y1):
+        """
+        Returns the terrain of the cells from (x0, y0) up to but excluding
+        (x1, y1) as a (height, width) array, which may be a view
+        """
+        return np.array([[node.terrain for node in row[x0:x1]]
+                         for row in self.nodes[y0:y1]],
+                        dtype=np.uint8).reshape(y1 - y0, x1 - x0)
 
-    def move(self, node):
+    def set_terrain(self, x, y, terrain):
+        node = self.nodes[y][x]
+        if node.terrain != terrain:
+            blocked = node.terrain in SIGHT_BLOCKERS
+            node.terrain = terrain
+            self.cell_changed(x, y)
+            if blocked != (terrain in SIGHT_BLOCKERS):
+                self.sight_changed(x, y)
+
+    def height_at(self, x, y):
+        return self.nodes[y][x].height
+
+    def set_height(self, x, y, height):
+        self.nodes[y][x].height = height
+
+    def is_occupied(self, x, y):
+        return self.nodes[y][x].occupied
+
+    def set_occupied(self, x, y, occupied):
+        node = self.nodes[y][x]
+        if node.occupied != occupied:
+            node.occupied = occupied
+            self.cell_changed(x, y)
+
+    def cell_changed(self, x, y):
         """
-        Sets the Unit's location to the specified Node
+        Drops every cached ReachField that depends on the cell at (x,y).
+
+        Called whenever a cell's terrain or occupancy changes. Change cells
+        through set_terrain() and set_occupied() so that this happens.
         """
-        self.location = node
-        self.moved = True
+        self.reach_cache.drop_cell(x, y)
 
-    def join_battle(self, battle, x, y):
+    def sight_changed(self, x, y):
         """
-        Attaches the Unit to a Battle in an initial position (x,y)
+        Drops every cached FieldOfView that sees (x,y). Called when the
+        cell starts or stops blocking sight; cells in shadow cannot change
+        what is seen.
         """
-        self.battle = battle
-        self.battle.units.append(self)
-        self.move(battle.grid.get_node(x, y))
+        self.fov_cache.drop_cell(x, y)
 
-    def legal_moves(self):
+    def blocks_sight(self, x, y):
+        return self.terrain_at(x, y) in SIGHT_BLOCKERS
+
+    def line_of_sight(self, x0, y0, x1, y1):
         """
-        Returns a list of Nodes it is legal to move to.
-        Currently checks only for move range.
+        Returns True if no cell strictly between (x0,y0) and (x1,y1) on a
+        Bresenham line blocks sight
         """
-        in_range = self.battle.grid.neighbors(self.location, self.move_speed)
-        return in_range
+        dx = abs(x1 - x0)
+        dy = -abs(y1 - y0)
+        step_x = 1 if x0 < x1 else -1
+        step_y = 1 if y0 < y1 else -1
+        error = dx + dy
+        x, y = x0, y0
+        while (x, y) != (x1, y1):
+            twice = 2 * error
+            if twice >= dy:
+                error += dy
+                x += step_x
+            if twice <= dx:
+                error += dx
+                y += step_y
+            if (x, y) != (x1, y1) and self.blocks_sight(x, y):
+                return False
+        return True
 
-    def possible_actions(self):
-        options = []
-        if not self.moved:
-            options.append("Move")
-        if not self.acted:
-            options.append("Action")
-        always = ["End Turn"]
-        for item in always:
-            options.append(item)
-        return options
+    def field_of_view(self, x, y, radius=SIGHT_RADIUS):
+        """
+        Returns the FieldOfView from (x,y), computed by recursive
+        shadowcasting. Fields are cached and dropped only when a cell
+        they see starts or stops blocking sight, or when more than
+        FOV_CACHE_SIZE are held and they are the least recently used.
+        """
+        key = (x, y, radius)
+        field = self.fov_cache.get(key)
+        if field is None:
+            visible = set([(x, y)])
+            for octant in _OCTANTS:
+                self._cast(visible, x, y, 1, 1.0, 0.0, radius, octant)
+            field = FieldOfView((x, y), radius, visible)
+            self.fov_cache.put(key, field)
+        return field
 
-    def make_move_menu(self):
+    def _cast(self, visible, cx, cy, row, start, end, radius, octant):
         """
-        Create and print an indexed list of possible moves
+        Scans one octant outwards from row, between slopes start and end
         """
-        move_menu = dict(zip(range(len(self.legal_moves())), self.legal_moves()))
-        return move_menu
+        if start < end:
+            return
+        xx, xy, yx, yy = octant
+        radius_sq = radius * radius
+        width, height = self.width, self.height
+        new_start = start
+        for distance in xrange(row, radius + 1):
+            dx = -distance - 1
+            dy = -distance
+            blocked = False
+            while dx <= 0:
+                dx += 1
+                x = cx + dx * xx + dy * xy
+                y = cy + dx * yx + dy * yy
+                left = (dx - 0.5) / (dy + 0.5)
+                right = (dx + 0.5) / (dy - 0.5)
+                if start < right:
+                    continue
+                if end > left:
+                    break
+                inside = 0 <= x < width and 0 <= y < height
+                if inside and dx * dx + dy * dy <= radius_sq:
+                    visible.add((x, y))
+                opaque = not inside or self.blocks_sight(x, y)
+                if blocked:
+                    if opaque:
+                        new_start = right
+                    else:
+                        blocked = False
+                        start = new_start
+                elif opaque and distance < radius:
+                    blocked = True
+                    self._cast(visible, cx, cy, distance + 1, start, left,
+                               radius, octant)
+                    new_start = right
+            if blocked:
+                break
 
-    def print_menu(self, menu, title):
+    def step_cost(self, x, y):
         """
-        Prints a dictionary as a menu, preceded by title.
+        Returns the move points needed to enter (x,y), or None if the cell
+        is impassable or occupied.
         """
-        print "%s :\n" % title
-        for number, item in menu.iteritems():
-            print "%s: %s" % (number, item)
+        if self.is_occupied(x, y):
+            return None
+        return TERRAIN_COSTS.get(self.terrain_at(x, y), 1)
 
-    def prompt_for_input(self):
+    def reachable(self, node, budget):
         """
-        Prompt user for selection from list
-        Just a wrapper for raw_input for testing purposes
+        Returns a ReachField of every cell reachable from node within
+        budget move points.
+
+        Moves may be made to any of the eight surrounding cells, paying the
+        step_cost() of the cell entered. Occupied cells block movement.
+        Fields are cached and dropped only when a cell they depend on
+        changes, or when more than REACH_CACHE_SIZE are held and they are
+        the least recently used.
         """
-        return raw_input("Enter a number: ")
+        key = (node.x, node.y, budget)
+        field = self.reach_cache.get(key)
+        if field is None:
+            field = self._flood(node, budget)
+            self.reach_cache.put(key, field)
+        return field
 
-    def pull_from_menu(self, command, menu):
+    def _flood(self, start, budget):
         """
-        Returns an item selected from a numerically indexed menu prompt
+        Dijkstra flood fill out to budget move points
         """
-        try:
-            command = int(command)
-        except:
-            return False
-        if command in menu.keys():
-            result = menu[int(command)]
-            return result
-        else:
-            return False
+        steps = offset_stencil(1).tolist()
+        width = self.width
+        height = self.height
+        step_cost = self.step_cost
+        origin = (start.x, start.y)
+        costs = {origin: 0}
+        explored = set([origin])
+        frontier = [(0, origin)]
+        while frontier:
+            cost, cell = heapq.heappop(frontier)
+            if cost > costs[cell]:
+                continue
+            x, y = cell
+            for dx, dy in steps:
+                new_x = x + dx
+                new_y = y + dy
+                if not (0 <= new_x < width and 0 <= new_y < height):
+                    continue
+                new_cell = (new_x, new_y)
+                explored.add(new_cell)
+                step = step_cost(new_x, new_y)
+                if step is None:
+                    continue
+                new_cost = cost + step
+                if new_cost <= budget and new_cost < costs.get(new_cell, budget + 1):
+                    costs[new_cell] = new_cost
+                    heapq.heappush(frontier, (new_cost, new_cell))
+        return ReachField(origin, budget, costs, explored)
 
-    def get_move_command(self, input_func):
-        menu = self.make_move_menu()
-        self.print_menu(menu, "Possible moves")
-        finished = False
-        while not finished:
-            command = input_func()
-            dest = self.pull_from_menu(command, menu)
-            if dest:
-                self.move(dest)
-                finished = True
-            else:
-                print("Please select a number from the menu.")
+    def find_path(self, start, goal):
+        """
+        A* search from start to goal.
 
-    def turn(self, input_func):
+        Returns the list of Nodes stepped through, ending with goal and
+        excluding start, or None if goal cannot be reached. Uses the same
+        movement rules as reachable().
         """
-        Run when a unit becomes active. Steps through turn sequence, then resets CT
+        steps = offset_stencil(1).tolist()
+        origin = (start.x, start.y)
+        target = (goal.x, goal.y)
+        if origin == target:
+            return []
+        costs = {origin: 0}
+        came_from = {}
+        counter = 0
+        frontier = [(0, counter, origin)]
+        while frontier:
+            priority, _, cell = heapq.heappop(frontier)
+            if cell == target:
+                path = []
+                while cell != origin:
+                    path.append(cell)
+                    cell = came_from[cell]
+                path.reverse()
+                return self.nodes_at(np.array(path, dtype=np.intp))
+            x, y = cell
+            cost = costs[cell]
+            for dx, dy in steps:
+                new_x = x + dx
+                new_y = y + dy
+                if not (0 <= new_x < self.width and 0 <= new_y < self.height):
+                    continue
+                step = self.step_cost(new_x, new_y)
+                if step is None:
+                    continue
+                new_cell = (new_x, new_y)
+                new_cost = cost + step
+                if new_cost < costs.get(new_cell, new_cost + 1):
+                    costs[new_cell] = new_cost
+                    came_from[new_cell] = cell
+                    estimate = max(abs(target[0] - new_x), abs(target[1] - new_y))
+                    counter += 1
+                    heapq.heappush(frontier, (new_cost + estimate, counter, new_cell))
+        return None
 
-        input_func = The function that returns the next action command
+    def neighbor_coords(self, node, dist, metric=CHEBYSHEV):
         """
-        # Reset moved and acted counters
-        self.moved = False
-        self.acted = False
-        self.turn_finished = False
+        Returns an (n, 2) array of the (x, y) coordinates within dist of
+        node under metric, clipped to the grid. node itself is excluded.
+        """
+        coords = offset_stencil(dist, metric) + (node.x, node.y)
+        if (dist <= node.x < self.width - dist and
+                dist <= node.y < self.height - dist):
+            return coords
+        xs = coords[:, 0]
+        ys = coords[:, 1]
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        return coords[inside]
 
-        # Set up loop
-        while not self.turn_finished:
-            action = input_func()
-            self.action_parse(action)
-        self.ct = 0
+    def nodes_at(self, coords):
+        """
+        Returns the Nodes for an (n, 2) array of in-bounds coordinates.
+        """
+        nodes = self.nodes
+        return [nodes[y][x] for x, y in coords.tolist()]
 
-    def action_parse(self, action):
-        if action == "Move":
-            self.execute_move_command()
-        elif action == "End Turn":
-            self.execute_end_turn_command()
+    def neighbors(self, node, dist, metric=CHEBYSHEV, packed=False):
+        """
+        Returns a list of Nodes that are within dist squares of the original Node.
 
-    def execute_move_command(self):
-        move_menu = Menu(self.legal_moves(), "Move to")
-        dest = move_menu.text_get_result()
-        self.move(dest)
-        self.moved = True
+        metric is one of CHEBYSHEV (the default square), MANHATTAN or
+        EUCLIDEAN. With packed=True the coordinates are returned as an
+        (n, 2) array instead of Nodes.
+        """
+        coords = self.neighbor_coords(node, dist, metric)
+        if packed:
+            return coords
+        return self.nodes_at(coords)
 
-    def execute_end_turn_command(self):
-        self.turn_finished = True
 
-    def update_hp(self, amount):
+class ArrayGrid(Grid):
+    """
+    A cartesian grid that keeps its cell data (terrain, height and
+    occupancy) in flat NumPy arrays instead of one Node per cell.
+
+    Cells are stored row by row, so (x, y) lives at index y * width + x.
+    get_node() hands out NodeView objects on demand.
+    """
+
+    def __init__(self, x, y):
+        self.width = x
+        self.height = y
+        self._new_caches()
+        size = x * y
+        self.terrain = np.zeros(size, dtype=np.uint8)
+        self.heights = np.zeros(size, dtype=np.int16)
+        self.occupancy = np.zeros(size, dtype=np.bool_)
+
+    def index(self, x, y):
         """
-        Changes the Unit's HP by amount. Handles cases over max and under 0.
+        Returns the flat array index of (x,y)
         """
-        new_hp = self.current_hp + amount
-        if new_hp <= 0:
-            self.die()
-        elif new_hp >= self.max_hp:
-            self.current_hp = self.max_hp
-        else:
-            self.current_hp = new_hp
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError("(%s, %s) is outside the grid" % (x, y))
+        return y * self.width + x
 
-    def die(self):
+    def get_node(self, x, y):
         """
-        Kills a Unit
+        Returns a NodeView of the cell at (x,y)
         """
-        self.current_hp = 0
-        self.alive = False
+        self.index(x, y)
+        return NodeView(self, x, y)
 
-    def melee_atk(self, target, hit_func, dmg_func):
+    def iter_nodes(self):
+        for y in xrange(self.height):
+            for x in xrange(self.width):
+                yield NodeView(self, x, y)
+
+    def nodes_at(self, coords):
+        return [NodeView(self, x, y) for x, y in coords.tolist()]
+
+    def copy(self):
+        grid = type(self).__new__(type(self))
+        grid.width = self.width
+        grid.height = self.height
+        grid._new_caches()
+        grid.terrain = self.terrain.copy()
+        grid.heights = self.heights.copy()
+        grid.occupancy = self.occupancy.copy()
+        return grid
+
+    def cell_arrays(self):
+        return self.terrain, self.heights, self.occupancy
+
+    def load_cell_arrays(self, terrain, heights, occupancy):
+        self.terrain[:] = terrain
+        self.heights[:] = heights
+        self.occupancy[:] = occupancy
+        self.reach_cache.clear()
+        self.fov_cache.clear()
+
+    def terrain_at(self, x, y):
+        return int(self.terrain[self.index(x, y)])
+
+    def terrain_in(self, x0, y0, x1, y1):
+        return self.terrain.reshape(self.height, self.width)[y0:y1, x0:x1]
+
+    def set_terrain(self, x, y, terrain):
+        index = self.index(x, y)
+        if self.terrain[index] != terrain:
+            blocked = self.terrain[index] in SIGHT_BLOCKERS
+            self.terrain[index] = terrain
+            self.cell_changed(x, y)
+            if blocked != (terrain in SIGHT_BLOCKERS):
+                self.sight_changed(x, y)
+
+    def height_at(self, x, y):
+        return int(self.heights[self.index(x, y)])
+
+    def set_height(self, x, y, height):
+        self.heights[self.index(x, y)] = height
+
+    def is_occupied(self, x, y):
+        return bool(self.occupancy[self.index(x, y)])
+
+    def blocks_sight(self, x, y):
+        return self.terrain[y * self.width + x] in SIGHT_BLOCKERS
+
+    def step_cost(self, x, y):
+        index = y * self.width + x
+        if self.occupancy[index]:
+            return None
+        return TERRAIN_COSTS.get(self.terrain[index], 1)
+
+    def set_occupied(self, x, y, occupied):
+        index = self.index(x, y)
+        if self.occupancy[index] != occupied:
+            self.occupancy[index] = occupied
+            self.cell_changed(x, y)
+
+
+class Tile(object):
+    """
+    One square block of a ChunkedGrid's cells, stored like ArrayGrid's
+    arrays. occupied counts the occupied cells; dirty marks terrain or
+    height edits not yet written to the map file.
+    """
+    __slots__ = ('terrain', 'heights', 'occupancy', 'occupied', 'dirty',
+                 'used')
+
+    def __init__(self, terrain, heights):
+        self.terrain = terrain
+        self.heights = heights
+        self.occupancy = np.zeros(len(terrain), dtype=np.bool_)
+        self.occupied = 0
+        self.dirty = False
+        self.used = 0
+
+    def copy(self):
+        tile = Tile(self.terrain.copy(), self.heights.copy())
+        tile.occupancy = self.occupancy.copy()
+        tile.occupied = self.occupied
+        tile.dirty = self.dirty
+        return tile
+
+
+MAP_MAGIC = "TMAP"
+MAP_VERSION = 1
+# magic, version, width, height, tile size
+MAP_HEADER = struct.Struct("<4sHIII")
+MAP_HEADER_SIZE = 32
+
+
+class ChunkedGrid(Grid):
+    """
+    A cartesian grid split into tile_size x tile_size Tiles that are only
+    created when a cell in them is first read or written, so very large
+    maps cost memory only where they are used.
+
+    Tiles come from a map file when the grid was opened with open(),
+    otherwise they start as flat PLAIN ground. At most max_tiles are kept
+    in memory: the least recently used are evicted once the cap is
+    passed. Tiles with units on them are never evicted. Edited tiles are
+    written back when the map file is writable, and otherwise spilled:
+    kept zlib-compressed in spilled until they are needed again.
+
+    get_node() and neighbors() hand out NodeView objects, as ArrayGrid
+    does.
+    """
+    TILE_SIZE = 64
+    MAX_TILES = 256
+
+    def __init__(self, x, y, tile_size=TILE_SIZE, max_tiles=MAX_TILES,
+                 map_file=None, writable=False):
+        self.width = x
+        self.height = y
+        self._new_caches()
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.tiles_x = -(-x // tile_size)
+        self.tiles_y = -(-y // tile_size)
+        self.tiles = {}
+        self.clock = 0
+        self.loads = 0
+        self.evictions = 0
+        self.map_file = map_file
+        self.writable = writable
+        if writable and map_file is None:
+            raise ValueError("A writable grid needs a map file")
+        self.spilled = {}
+        # Copies reading the same map file, see write_back()
+        self.readers = weakref.WeakSet()
+
+    @classmethod
+    def open(cls, path, max_tiles=MAX_TILES, writable=False):
         """
-        Perform a melee attack against target.
+        Opens a map file written by save() or create_map(). Tiles are read
+        through a memory map as they are needed. With writable=True,
+        edited tiles are written back when evicted and by flush().
+        """
+        with open(path, "rb") as map_file:
+            header = map_file.read(MAP_HEADER.size)
+        if len(header) < MAP_HEADER.size:
+            raise ValueError("Not a map file")
+        magic, version, width, height, tile_size = MAP_HEADER.unpack(header)
+        if magic != MAP_MAGIC:
+            raise ValueError("Not a map file")
+        if version != MAP_VERSION:
+            raise ValueError("Unsupported map version %d" % version)
+        data = np.memmap(path, dtype=np.uint8, mode="r+" if writable else "r")
+        return cls(width, height, tile_size, max_tiles, data, writable)
 
-        hit_func is the function used to calculate hit.
-        Should return bool
-        dmg_func is the function used to calculate dmg
-        Should return int
+    @staticmethod
+    def create_map(path, width, height, tile_size=TILE_SIZE):
+        """
+        Writes an all-PLAIN map file without holding it in memory. The file
+        is created sparse where the filesystem allows.
+        """
+        tiles = -(-width // tile_size) * -(-height // tile_size)
+        size = MAP_HEADER_SIZE + tiles * 3 * tile_size * tile_size
+        with open(path, "wb") as map_file:
+            header = MAP_HEADER.pack(MAP_MAGIC, MAP_VERSION, width, height,
+                                     tile_size)
+            map_file.write(header + "\0" * (MAP_HEADER_SIZE - len(header)))
+            map_file.seek(size - 1)
+            map_file.write("\0")
+
+    def save(self, path):
+        """
+        Writes the whole grid as a map file, tile by tile. Occupancy is not
+        saved.
+        """
+        ChunkedGrid.create_map(path, self.width, self.height, self.tile_size)
+        data = np.memmap(path, dtype=np.uint8, mode="r+")
+        for ty in xrange(self.tiles_y):
+            for tx in xrange(self.tiles_x):
+                if self.is_blank((tx, ty)):
+                    continue
+                tile = self.tiles.get((tx, ty)) or self.read_tile((tx, ty))
+                self.write_tile(data, (tx, ty), tile)
+        data.flush()
+        del data
+
+    def tile_span(self, key):
+        """
+        Returns the byte offsets of a tile's terrain and heights in a map
+        file
+        """
+        area = self.tile_size * self.tile_size
+        start = MAP_HEADER_SIZE + (key[1] * self.tiles_x + key[0]) * 3 * area
+        return start, start + area, start + 3 * area
+
+    def is_blank(self, key):
+        """
+        True if a tile was never created, edited or mapped, so is all PLAIN
+        """
+        return (key not in self.tiles and key not in self.spilled and
+                self.map_file is None)
+
+    def read_tile(self, key):
+        """
+        Loads a tile that is not resident, from the spilled edits first
+        """
+        packed = self.spilled.get(key)
+        if packed is not None:
+            tile = self.unpack_tile(packed)
+            tile.dirty = True
+            return tile
+        return self.read_map_tile(key)
+
+    def read_map_tile(self, key):
+        area = self.tile_size * self.tile_size
+        if self.map_file is None:
+            return Tile(np.zeros(area, dtype=np.uint8),
+                        np.zeros(area, dtype=np.int16))
+        start, middle, end = self.tile_span(key)
+        terrain = np.array(self.map_file[start:middle])
+        heights = np.array(self.map_file[middle:end]).view("<i2").astype(np.int16)
+        return Tile(terrain, heights)
+
+    def write_tile(self, data, key, tile):
+        start, middle, end = self.tile_span(key)
+        data[start:middle] = tile.terrain
+        data[middle:end] = tile.heights.astype("<i2").view(np.uint8)
+
+    def write_back(self, key, tile):
+        """
+        Writes an edited tile to the writable map file. Copies still reading
+        that tile from the file keep its old cells first, so they never see
+        edits made after they were taken.
+        """
+        old = None
+        for reader in self.readers:
+            resident = reader.tiles.get(key)
+            if resident is not None:
+                resident.dirty = True
+            elif key not in reader.spilled:
+                old = old or self.pack_tile(self.read_map_tile(key))
+                reader.spilled[key] = old
+        self.write_tile(self.map_file, key, tile)
+
+    @staticmethod
+    def pack_tile(tile):
+        return zlib.compress(tile.terrain.tostring() +
+                             tile.heights.astype("<i2").tostring())
+
+    def unpack_tile(self, packed):
+        area = self.tile_size * self.tile_size
+        data = np.frombuffer(zlib.decompress(packed), dtype=np.uint8)
+        return Tile(data[:area].copy(),
+                    data[area:].view("<i2").astype(np.int16))
+
+    def tile(self, key):
+        """
+        Returns the Tile at tile coordinates key, creating or loading it if
+        needed
+        """
+        self.clock += 1
+        tile = self.tiles.get(key)
+        if tile is None:
+            tile = self.read_tile(key)
+            self.spilled.pop(key, None)
+            self.loads += 1
+            self.tiles[key] = tile
+            tile.used = self.clock
+            if len(self.tiles) > self.max_tiles:
+                self.evict()
+        tile.used = self.clock
+        return tile
+
+    def evict(self):
+        """
+        Drops least recently used tiles until the cap is met, or a tenth
+        below it so that evictions come in batches. Edited tiles are written
+        back or spilled. The tile being fetched is kept even if everything
+        else is pinned.
+        """
+        target = self.max_tiles - max(1, self.max_tiles // 10)
+        candidates = []
+        for key, tile in self.tiles.iteritems():
+            if tile.occupied or tile.used == self.clock:
+                continue
+            candidates.append((tile.used, key))
+        candidates.sort()
+        for _, key in candidates[:max(0, len(self.tiles) - target)]:
+            tile = self.tiles.pop(key)
+            if tile.dirty:
+                if self.writable:
+                    self.write_back(key, tile)
+                else:
+                    self.spilled[key] = self.pack_tile(tile)
+            self.evictions += 1
+
+    def flush(self):
+        """
+        Writes every edited tile back to a writable map file
+        """
+        if not self.writable:
+            raise ValueError("The grid has no writable map file")
+        for key, tile in self.tiles.iteritems():
+            if tile.dirty:
+                self.write_back(key, tile)
+                tile.dirty = False
+        self.map_file.flush()
+
+    def memory_usage(self):
+        """
+        Bytes held by resident tiles and spilled edits
+        """
+        return (len(self.tiles) * 4 * self.tile_size * self.tile_size +
+                sum(len(packed) for packed in self.spilled.itervalues()))
+
+    def cell(self, x, y):
+        """
+        Returns the Tile holding (x,y) and the cell's index in it
+        """
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError("(%s, %s) is outside the grid" % (x, y))
+        size = self.tile_size
+        return (self.tile((x // size, y // size)),
+                (y % size) * size + (x % size))
+
+    def get_node(self, x, y):
+        """
+        Returns a NodeView of the cell at (x,y). Its tile is only touched
+        when the view's data is read or written.
+        """
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError("(%s, %s) is outside the grid" % (x, y))
+        return NodeView(self, x, y)
+
+    def iter_nodes(self):
+        for y in xrange(self.height):
+            for x in xrange(self.width):
+                yield NodeView(self, x, y)
+
+    def nodes_at(self, coords):
+        return [NodeView(self, x, y) for x, y in coords.tolist()]
+
+    def copy(self):
+        """
+        Returns a copy reading the same map file, never writing to it, with
+        the same cap. Only tiles that differ from the file are copied;
+        later write-backs by this grid do not show through (see
+        write_back()).
+        """
+        grid = ChunkedGrid(self.width, self.height, self.tile_size,
+                           self.max_tiles, self.map_file)
+        grid.tiles = dict((key, tile.copy())
+                          for key, tile in self.tiles.iteritems()
+                          if tile.dirty or tile.occupied)
+        grid.spilled = dict(self.spilled)
+        grid.readers = self.readers
+        self.readers.add(grid)
+        return grid
+
+    def cell_arrays(self):
+        size = self.width * self.height
+        terrain = np.zeros(size, dtype=np.uint8)
+        heights = np.zeros(size, dtype=np.int16)
+        occupancy = np.zeros(size, dtype=np.bool_)
+        for ty in xrange(self.tiles_y):
+            for tx in xrange(self.tiles_x):
+                if self.is_blank((tx, ty)):
+                    continue
+                tile = self.tiles.get((tx, ty)) or self.read_tile((tx, ty))
+                self.copy_tile(tile, (tx, ty), terrain, heights, occupancy)
+        return terrain, heights, occupancy
+
+    def pack_tiles(self):
+        """
+        Returns the keys, edit flags and cells of the tiles that differ from
+        the map file, spilled ones included, for write_snapshot()
+        """
+        keys = []
+        cells = []
+        for key in sorted(set(self.tiles) | set(self.spilled)):
+            tile = self.tiles.get(key) or self.read_tile(key)
+            if not (tile.dirty or tile.occupied):
+                continue
+            keys.append((key[0], key[1], tile.dirty))
+            cells.append(tile.terrain.tostring() +
+                         tile.heights.astype("<i2").tostring() +
+                         tile.occupancy.astype("<u1").tostring())
+        return np.array(keys, dtype=SNAPSHOT_TILE), "".join(cells)
+
+    def load_tiles(self, keys, cells):
+        """
+        Adds tiles packed by pack_tiles(), evicting as usual
+        """
+        area = self.tile_size * self.tile_size
+        cells = np.asarray(cells, dtype=np.uint8).reshape(len(keys), 4 * area)
+        for (x, y, dirty), data in zip(keys.tolist(), cells):
+            tile = Tile(data[:area].copy(),
+                        data[area:3 * area].view("<i2").astype(np.int16))
+            tile.occupancy = data[3 * area:].astype(np.bool_)
+            tile.occupied = int(tile.occupancy.sum())
+            tile.dirty = bool(dirty)
+            self.clock += 1
+            tile.used = self.clock
+            self.tiles[(x, y)] = tile
+            if len(self.tiles) > self.max_tiles:
+                self.evict()
+        self.reach_cache.clear()
+        self.fov_cache.clear()
+
+    def tile_window(self, key):
+        """
+        Returns the row and column slices of a tile in a (height, width)
+        array, and the tile cells that fall inside the grid
+        """
+        size = self.tile_size
+        x0, y0 = key[0] * size, key[1] * size
+        x1, y1 = min(x0 + size, self.width), min(y0 + size, self.height)
+        return (slice(y0, y1), slice(x0, x1),
+                (slice(0, y1 - y0), slice(0, x1 - x0)))
+
+    def copy_tile(self, tile, key, terrain, heights, occupancy):
+        size = self.tile_size
+        rows, columns, inside = self.tile_window(key)
+        shape = (self.height, self.width)
+        for flat, data in ((terrain, tile.terrain), (heights, tile.heights),
+                           (occupancy, tile.occupancy)):
+            flat.reshape(shape)[rows, columns] = data.reshape(size, size)[inside]
+
+    def load_cell_arrays(self, terrain, heights, occupancy):
+        size = self.tile_size
+        shape = (self.height, self.width)
+        self.tiles = {}
+        self.spilled = {}
+        for ty in xrange(self.tiles_y):
+            for tx in xrange(self.tiles_x):
+                rows, columns, inside = self.tile_window((tx, ty))
+                tile = self.read_tile((tx, ty))
+                for data, flat in ((tile.terrain, terrain),
+                                   (tile.heights, heights),
+                                   (tile.occupancy, occupancy)):
+                    data.reshape(size, size)[inside] = \
+                        np.asarray(flat).reshape(shape)[rows, columns]
+                tile.occupied = int(tile.occupancy.sum())
+                if (self.map_file is None and not tile.occupied and
+                        not tile.terrain.any() and not tile.heights.any()):
+                    continue
+                tile.dirty = True
+                self.tiles[(tx, ty)] = tile
+        self.reach_cache.clear()
+        self.fov_cache.clear()
+
+    def terrain_at(self, x, y):
+        tile, index = self.cell(x, y)
+        return int(tile.terrain[index])
+
+    def terrain_in(self, x0, y0, x1, y1):
+        """
+        Copies the window out of each tile it covers, loading them as
+        needed. Blank tiles that were never created are left as PLAIN.
+        """
+        terrain = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+        size = self.tile_size
+        for ty in xrange(y0 // size, -(-y1 // size)):
+            for tx in xrange(x0 // size, -(-x1 // size)):
+                if self.is_blank((tx, ty)):
+                    continue
+                cells = self.tile((tx, ty)).terrain.reshape(size, size)
+                left, top = tx * size, ty * size
+                cx0, cx1 = max(x0, left), min(x1, left + size)
+                cy0, cy1 = max(y0, top), min(y1, top + size)
+                terrain[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0] = \
+                    cells[cy0 - top:cy1 - top, cx0 - left:cx1 - left]
+        return terrain
+
+    def set_terrain(self, x, y, terrain):
+        tile, index = self.cell(x, y)
+        if tile.terrain[index] != terrain:
+            blocked = tile.terrain[index] in SIGHT_BLOCKERS
+            tile.terrain[index] = terrain
+            tile.dirty = True
+            self.cell_changed(x, y)
+            if blocked != (terrain in SIGHT_BLOCKERS):
+                self.sight_changed(x, y)
+
+    def height_at(self, x, y):
+        tile, index = self.cell(x, y)
+        return int(tile.heights[index])
+
+    def set_height(self, x, y, height):
+        tile, index = self.cell(x, y)
+        tile.heights[index] = height
+        tile.dirty = True
+
+    def is_occupied(self, x, y):
+        tile, index = self.cell(x, y)
+        return bool(tile.occupancy[index])
+
+    def set_occupied(self, x, y, occupied):
+        tile, index = self.cell(x, y)
+        if tile.occupancy[index] != occupied:
+            tile.occupancy[index] = occupied
+            tile.occupied += 1 if occupied else -1
+            self.cell_changed(x, y)
+
+    def blocks_sight(self, x, y):
+        tile, index = self.cell(x, y)
+        return tile.terrain[index] in SIGHT_BLOCKERS
+
+    def step_cost(self, x, y):
+        tile, index = self.cell(x, y)
+        if tile.occupancy[index]:
+            return None
+        return TERRAIN_COSTS.get(tile.terrain[index], 1)
+
+
+class Unit(object):
+    # Plain per-unit state copied by Battle.clone(); ct and location are
+    # handled separately
+    STATE_FIELDS = ('name', 'speed', 'move_speed', 'max_hp', 'current_hp',
+                    'alive', 'moved', 'acted', 'turn_finished', 'damage_dealt')
+
+    __slots__ = ('scheduler', '_ct_clock', '_speed', '_ct', 'move_speed',
+                 'name', 'max_hp', 'current_hp', 'alive',
+                 'moved', 'acted', 'turn_finished',
+                 'location', 'battle', 'team', 'damage_dealt')
+
+    def __init__(self):
+        self.scheduler = False
+        self._ct_clock = 0
+        self.speed = 5
+        self.ct = 0
+        self.move_speed = 2
+        self.name = "A"
+        self.max_hp = 100
+        self.current_hp = 100
+        self.alive = True
+
+        self.moved = False
+        self.acted = False
+        self.turn_finished = False
+
+        self.location = False
+        self.battle = False
+        self.team = False
+
+        self.damage_dealt = 0
+
+    @property
+    def ct(self):
+        """
+        Charge time. The Unit takes a turn once this reaches 100.
+
+        While the Unit is held by a CTScheduler, ct is worked out from the
+        scheduler's clock rather than being incremented every tick.
+        """
+        if self.scheduler:
+            return self._ct + (self.scheduler.clock - self._ct_clock) * self._speed
+        return self._ct
+
+    @ct.setter
+    def ct(self, value):
+        self._ct = value
+        if self.scheduler:
+            self._ct_clock = self.scheduler.clock
+            self.scheduler.reschedule(self)
+
+    @property
+    def speed(self):
+        return self._speed
+
+    @speed.setter
+    def speed(self, value):
+        if self.scheduler:
+            self._ct = self.ct
+            self._ct_clock = self.scheduler.clock
+            self._speed = value
+            self.scheduler.reschedule(self)
+        else:
+            self._speed = value
+
+    def move(self, node):
+        """
+        Sets the Unit's location to the specified Node
+        """
+        old = self.location
+        self.location = node
+        self.moved = True
+        if self.battle:
+            self.battle.place_unit(self, old, node)
+            if self.battle.recorder:
+                self.battle.recorder.record(EVENT_MOVE, self, node.x, node.y)
+
+    def join_battle(self, battle, x, y):
+        """
+        Attaches the Unit to a Battle in an initial position (x,y)
+        """
+        self.battle = battle
+        self.battle.units.append(self)
+        self.move(battle.grid.get_node(x, y))
+
+    def legal_moves(self):
+        """
+        Returns a list of Nodes it is legal to move to: every cell reachable
+        within move_speed move points without crossing impassable terrain
+        or other units.
+
+        The list is memoized by the Battle's ActionCache and shared between
+        callers, so it must not be modified.
+        """
+        return self.battle.actions.legal_moves(self)
+
+    def adjacent_enemies(self):
+        """
+        Returns the living enemies within melee reach. Memoized and shared
+        like legal_moves().
+        """
+        return self.battle.actions.adjacent_enemies(self)
+
+    def possible_actions(self):
+        """
+        Returns the turn commands open to the Unit. Memoized and shared like
+        legal_moves().
+        """
+        if self.battle:
+            return self.battle.actions.possible_actions(self)
+        return self.list_actions()
+
+    def list_actions(self):
+        options = []
+        if not self.moved:
+            options.append("Move")
+        if not self.acted:
+            options.append("Action")
+        always = ["End Turn"]
+        for item in always:
+            options.append(item)
+        return options
+
+    def make_move_menu(self):
+        """
+        Create an indexed dict of possible moves
+        """
+        return dict(enumerate(self.legal_moves()))
+
+    def print_menu(self, menu, title):
+        """
+        Prints a dictionary as a menu, preceded by title.
+        """
+        print "%s :\n" % title
+        for number, item in menu.iteritems():
+            print "%s: %s" % (number, item)
+
+    def prompt_for_input(self):
+        """
+        Prompt user for selection from list
+        Just a wrapper for raw_input for testing purposes
+        """
+        return raw_input("Enter a number: ")
+
+    def pull_from_menu(self, command, menu):
+        """
+        Returns an item selected from a numerically indexed menu prompt
+        """
+        try:
+            command = int(command)
+        except (TypeError, ValueError):
+            return False
+        return menu.get(command, False)
+
+    def get_move_command(self, input_func):
+        menu = self.make_move_menu()
+        loud = not is_quiet(input_func)
+        if loud:
+            self.print_menu(menu, "Possible moves")
+        while True:
+            dest = self.pull_from_menu(input_func(), menu)
+            if dest:
+                self.move(dest)
+                return
+            if loud:
+                print("Please select a number from the menu.")
+
+    def turn(self, input_func):
+        """
+        Run when a unit becomes active. Steps through turn sequence, then resets CT
+
+        input_func = The function that returns the next action command
+        """
+        # Reset moved and acted counters
+        self.moved = False
+        self.acted = False
+        self.turn_finished = False
+
+        # Set up loop
+        while not self.turn_finished:
+            action = input_func()
+            self.action_parse(action, input_func)
+        self.ct = 0
+
+    def action_parse(self, action, input_func=None):
+        """
+        Carries out one turn command. input_func answers any menu the
+        command brings up; by default the menu prompts on the terminal.
+        """
+        if action == "Move":
+            self.execute_move_command(input_func)
+        elif action == "Action":
+            self.execute_action_command(input_func)
+        elif action == "End Turn":
+            self.execute_end_turn_command()
+
+    def choose_from(self, menu, input_func=None):
+        if input_func is None:
+            return menu.text_get_result()
+        if is_quiet(input_func):
+            return menu.get_result(menu.no_display, input_func, menu.no_display)
+        return menu.get_result(menu.text_display, input_func, menu.text_fail)
+
+    def turn_steps(self):
+        """
+        Resumable counterpart of turn() for callers that cannot block on
+        an input_func, such as a network server.
+
+        A generator: it yields None when it wants an action command, or the
+        Menu to choose from when a command needs a choice, and is sent each
+        command in reply. The same Menu yielded twice means the reply was
+        not a valid choice. Sending None ends the turn wherever it is.
+        """
+        self.moved = False
+        self.acted = False
+        self.turn_finished = False
+        while not self.turn_finished:
+            action = yield None
+            menu = None
+            if action is None or action == "End Turn":
+                self.execute_end_turn_command()
+            elif action == "Move":
+                menu, apply_choice = self.move_menu(), self.apply_move
+            elif action == "Action":
+                menu, apply_choice = self.attack_menu(), self.apply_attack
+            while menu is not None:
+                command = yield menu
+                if command is None:
+                    self.execute_end_turn_command()
+                    break
+                choice = menu.pull(command)
+                if choice:
+                    apply_choice(choice)
+                    break
+        self.ct = 0
+
+    def move_menu(self):
+        """
+        Returns the Menu of legal moves, or None if there are none
+        """
+        moves = self.legal_moves()
+        if not moves:
+            return None
+        return Menu(moves, "Move to")
+
+    def apply_move(self, dest):
+        self.move(dest)
+        self.moved = True
+
+    def execute_move_command(self, input_func=None):
+        menu = self.move_menu()
+        if menu is None:
+            if not is_quiet(input_func):
+                print "Nowhere to move."
+            return
+        self.apply_move(self.choose_from(menu, input_func))
+
+    def attack_menu(self):
+        """
+        Returns the Menu of adjacent enemies, or None if there are none
+        """
+        targets = self.adjacent_enemies()
+        if not targets:
+            return None
+        return Menu(targets, "Attack")
+
+    def apply_attack(self, target):
+        self.melee_atk(target, self.melee_hit_check, self.melee_dmg)
+        self.acted = True
+
+    def execute_action_command(self, input_func=None):
+        """
+        Melee attack on an adjacent enemy chosen from a menu
+        """
+        menu = self.attack_menu()
+        if menu is None:
+            if not is_quiet(input_func):
+                print "No enemies in reach."
+            return
+        self.apply_attack(self.choose_from(menu, input_func))
+
+    def execute_end_turn_command(self):
+        self.turn_finished = True
+
+    def update_hp(self, amount):
+        """
+        Changes the Unit's HP by amount. Handles cases over max and under 0.
+        """
+        if self.battle and self.battle.recorder:
+            self.battle.recorder.record(EVENT_HP, self, amount)
+        new_hp = self.current_hp + amount
+        if new_hp <= 0:
+            self.die()
+        elif new_hp >= self.max_hp:
+            self.current_hp = self.max_hp
+        else:
+            self.current_hp = new_hp
+
+    def die(self):
+        """
+        Kills a Unit
+        """
+        if self.battle and self.battle.recorder:
+            self.battle.recorder.record(EVENT_DIE, self)
+        self.current_hp = 0
+        self.alive = False
+        if self.team:
+            self.team.unit_status_changed(self)
+        if self.scheduler:
+            self.scheduler.remove(self)
+        if self.battle and self.location:
+            self.battle.remove_unit(self, self.location)
+
+    def melee_atk(self, target, hit_func, dmg_func):
+        """
+        Perform a melee attack against target.
+
+        hit_func is the function used to calculate hit.
+        Should return bool
+        dmg_func is the function used to calculate dmg
+        Should return int
+
+        (Loosely coupled for testing, can pass in dummy hit/dmg calcs)
+        """
+        if hit_func(target):
+            damage = dmg_func(target)
+            self.damage_dealt += damage
+            if self.battle and self.battle.recorder:
+                self.battle.recorder.record(EVENT_DEALT, self, damage)
+            target.update_hp(-damage)
+
+    def melee_atk_many(self, targets, hit_func=None, dmg_func=None):
+        """
+        Perform a melee attack against every Unit in targets at once.
+
+        hit_func(targets) returns one bool per target and is called once,
+        then dmg_func is called once with just the targets that were hit and
+        returns one damage amount each; both default to the batched
+        placeholders below. Damage is summed per target over an HP array, so
+        the outcome matches calling melee_atk() on each target in turn with
+        the equivalent per-target functions, as long as the two draw from
+        separate random streams. A HitRoll and a DamageRoll sharing one
+        RandomState may be passed themselves instead of their many()
+        methods, and are then drawn in the interleaved order of the loop
+        (see HitRoll.rolls). Damage is assumed to be non-negative.
+
+        Returns the arrays of hits and damage dealt, one entry per target.
+        """
+        targets = list(targets)
+        count = len(targets)
+        if not count:
+            return np.zeros(0, dtype=np.bool_), np.zeros(0, dtype=np.int64)
+        hit_func = hit_func or self.melee_hit_check_many
+        dmg_func = dmg_func or self.melee_dmg_many
+        if (isinstance(hit_func, HitRoll) and isinstance(dmg_func, DamageRoll)
+                and hit_func.rng is dmg_func.rng):
+            hits, dealt = hit_func.rolls(targets, dmg_func)
+        else:
+            if isinstance(hit_func, HitRoll):
+                hit_func = hit_func.many
+            if isinstance(dmg_func, DamageRoll):
+                dmg_func = dmg_func.many
+            hits = np.asarray(hit_func(targets), dtype=np.bool_)
+            hit_targets = [targets[i] for i in np.flatnonzero(hits).tolist()]
+            dealt = dmg_func(hit_targets) if hit_targets else []
+        damage = np.zeros(count, dtype=np.int64)
+        damage[hits] = dealt
+
+        ids = np.array(map(id, targets), dtype=np.intp)
+        _, first, inverse = np.unique(ids, return_index=True, return_inverse=True)
+        if len(first) == count:
+            unique = targets
+            inverse = np.arange(count)
+            total = damage
+            struck = hits
+        else:
+            # Keep the targets in order of first appearance
+            order = np.argsort(first)
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+            inverse = rank[inverse]
+            unique = [targets[i] for i in first[order].tolist()]
+            total = np.zeros(len(unique), dtype=damage.dtype)
+            np.add.at(total, inverse, damage)
+            struck = np.zeros(len(unique), dtype=np.bool_)
+            struck[inverse[hits]] = True
+        table, rows = UnitTable.rows_of(unique)
+        if table is not None:
+            hp_column = table.columns['current_hp']
+            old_hp = hp_column[rows]
+            new_hp = old_hp - total
+            wounded = struck & (new_hp > 0)
+            hp_column[rows[wounded]] = np.minimum(
+                new_hp[wounded], table.columns['max_hp'][rows[wounded]])
+        else:
+            old_hp = np.array([target.current_hp for target in unique])
+            new_hp = old_hp - total
+            wounded = np.flatnonzero(struck & (new_hp > 0))
+            for slot, value in zip(wounded.tolist(), new_hp[wounded].tolist()):
+                target = unique[slot]
+                target.current_hp = value if value < target.max_hp else target.max_hp
+        self.damage_dealt += damage.sum().item()
+        recorder = self.battle and self.battle.recorder
+        if recorder:
+            # Replay the loop's events hit by hit, dying on each lethal one
+            hp = old_hp.tolist()
+            slots = inverse.tolist()
+            for i in np.flatnonzero(hits).tolist():
+                amount = damage[i].item()
+                recorder.record(EVENT_DEALT, self, amount)
+                recorder.record(EVENT_HP, targets[i], -amount)
+                hp[slots[i]] -= amount
+                if hp[slots[i]] <= 0:
+                    targets[i].die()
+        else:
+            for slot in np.flatnonzero(struck & (new_hp <= 0)).tolist():
+                unique[slot].die()
+        return hits, damage
+
+    def area_attack(self, dist, metric=CHEBYSHEV, hit_func=None, dmg_func=None):
+        """
+        Attacks every enemy within dist squares with melee_atk_many()
+        """
+        return self.melee_atk_many(self.enemies_within(dist, metric),
+                                   hit_func, dmg_func)
+
+    def is_enemy(self, other):
+        return other is not self and other.alive and other.team is not self.team
+
+    def enemies_within(self, dist, metric=CHEBYSHEV):
+        """
+        Returns the living enemies within dist squares, using the Battle's
+        occupancy index
+        """
+        return [unit for unit in self.battle.units_within(self.location, dist, metric)
+                if self.is_enemy(unit)]
+
+    def can_see(self, other, radius=SIGHT_RADIUS):
+        """
+        Returns True if other's cell is in this Unit's field of view
+        """
+        location = self.location
+        field = self.battle.grid.field_of_view(location.x, location.y, radius)
+        return (other.location.x, other.location.y) in field
+
+    def nearest_enemy(self):
+        """
+        Returns the closest living enemy, or None
+        """
+        return self.battle.nearest_unit(self.location, self.is_enemy)
+
+    def melee_hit_check(self, target):
+        """
+        Determine if a melee attack hits target
+        Currently a placeholder
+        """
+        return True
+
+    def melee_dmg(self, target):
+        """
+        Determine melee damage
+        Currently a placeholder
+        """
+        damage = 10
+        return damage
+
+    def melee_hit_check_many(self, targets):
+        """
+        Batched melee_hit_check(), one bool per target
+        Currently a placeholder
+        """
+        return np.ones(len(targets), dtype=np.bool_)
+
+    def melee_dmg_many(self, targets):
+        """
+        Batched melee_dmg(), one damage amount per target
+        Currently a placeholder
+        """
+        return np.full(len(targets), 10, dtype=np.int64)
+
+
+def _table_column(name):
+    """
+    A property that stores an attribute in a UnitTable column
+    """
+    def fget(self):
+        return self.table.columns[name][self.row].item()
+
+    def fset(self, value):
+        self.table.columns[name][self.row] = value
+
+    return property(fget, fset)
+
+
+class UnitTable(object):
+    """
+    Struct-of-arrays storage for the numeric state of many Units.
+
+    Each column is a NumPy array with one row per Unit. TableUnits are thin
+    handles that read and write their row, so whole columns can be read
+    or updated at once (see Unit.melee_atk_many and ct()). Columns hold
+    integers, apart from alive.
+    """
+    COLUMNS = (
+        ('_speed', np.int64),
+        ('_ct', np.int64),
+        ('_ct_clock', np.int64),
+        ('current_hp', np.int64),
+        ('max_hp', np.int64),
+        ('alive', np.bool_),
+        ('damage_dealt', np.int64),
+    )
+
+    def __init__(self, capacity=64):
+        self.size = 0
+        self.units = []
+        self.columns = dict((name, np.zeros(capacity, dtype=dtype))
+                            for name, dtype in self.COLUMNS)
+
+    def add_row(self, unit):
+        """
+        Allocates a row for unit and returns its index
+        """
+        capacity = len(self.columns['alive'])
+        if self.size == capacity:
+            for name, column in self.columns.items():
+                grown = np.zeros(2 * capacity, dtype=column.dtype)
+                grown[:capacity] = column
+                self.columns[name] = grown
+        self.units.append(unit)
+        self.size += 1
+        return self.size - 1
+
+    def column(self, name):
+        """
+        Returns the live part of a column, one entry per Unit
+        """
+        return self.columns[name][:self.size]
+
+    def ct(self, clock):
+        """
+        Returns every Unit's CT at scheduler time clock. Only meaningful
+        for Units held by a CTScheduler with that clock.
+        """
+        return (self.column('_ct') +
+                (clock - self.column('_ct_clock')) * self.column('_speed'))
+
+    @staticmethod
+    def rows_of(units):
+        """
+        Returns (table, rows) if every Unit in units lives in the same
+        UnitTable, and (None, None) otherwise
+        """
+        table = getattr(units[0], 'table', None)
+        if table is None:
+            return None, None
+        rows = []
+        for unit in units:
+            if getattr(unit, 'table', None) is not table:
+                return None, None
+            rows.append(unit.row)
+        return table, np.array(rows, dtype=np.intp)
+
+
+class TableUnit(Unit):
+    """
+    A Unit whose numeric state lives in a row of a UnitTable
+    """
+    __slots__ = ('table', 'row')
+
+    _speed = _table_column('_speed')
+    _ct = _table_column('_ct')
+    _ct_clock = _table_column('_ct_clock')
+    current_hp = _table_column('current_hp')
+    max_hp = _table_column('max_hp')
+    alive = _table_column('alive')
+    damage_dealt = _table_column('damage_dealt')
+
+    def __init__(self, table):
+        self.table = table
+        self.row = table.add_row(self)
+        Unit.__init__(self)
+
+
+class HitRoll(object):
+    """
+    Rolls hits at a fixed chance from a NumPy RandomState.
+
+    An instance is a per-target hit_func for Unit.melee_atk(), and its
+    many() method is the batched hit_func for Unit.melee_atk_many(). Both
+    draw one number per target in order, so they consume the random
+    stream identically.
+    """
+
+    def __init__(self, chance, rng):
+        self.chance = chance
+        self.rng = rng
+
+    def __call__(self, target):
+        return self.rng.random_sample() < self.chance
+
+    def many(self, targets):
+        return self.rng.random_sample(len(targets)) < self.chance
+
+    def rolls(self, targets, damage):
+        """
+        Rolls hits for targets and, for each hit, an amount from the
+        DamageRoll damage on the same RandomState, in the order a melee_atk()
+        loop draws them: every hit roll is followed by its damage roll.
+
+        Returns the hits, one per target, and the damage, one per hit.
+        """
+        count = len(targets)
+        state = self.rng.get_state()
+        # At most two numbers per target; replay how many the loop takes
+        draws = self.rng.random_sample(2 * count)
+        hit_draws = (draws < self.chance).tolist()
+        hits = np.zeros(count, dtype=np.bool_)
+        damage_at = []
+        position = 0
+        for i in xrange(count):
+            if hit_draws[position]:
+                hits[i] = True
+                damage_at.append(position + 1)
+                position += 2
+            else:
+                position += 1
+        self.rng.set_state(state)
+        self.rng.random_sample(position)
+        return hits, damage.amounts(draws[damage_at])
+
+
+class DamageRoll(object):
+    """
+    Rolls damage from low to high inclusive from a NumPy RandomState.
+
+    The damage counterpart of HitRoll: an instance is a per-target dmg_func
+    for Unit.melee_atk() and many() the batched one for
+    Unit.melee_atk_many(), each drawing one number per target.
+    """
+
+    def __init__(self, low, high, rng):
+        self.low = low
+        self.high = high
+        self.rng = rng
+
+    def __call__(self, target):
+        return self.amounts(self.rng.random_sample()).item()
+
+    def many(self, targets):
+        return self.amounts(self.rng.random_sample(len(targets)))
+
+    def amounts(self, draws):
+        """
+        Maps uniform draws in [0, 1) onto damage amounts
+        """
+        span = self.high - self.low + 1
+        return self.low + np.floor(np.asarray(draws) * span).astype(np.int64)
+
+
+class UnitSet(object):
+    """
+    An insertion-ordered set of Units, keyed by identity.
+
+    Adding, removing and membership tests are O(1). append() is kept as
+    an alias of add() so list-style code keeps working, and units can
+    still be indexed in insertion order.
+
+    on_add, if given, is called with each Unit the first time it is added.
+    """
+
+    def __init__(self, units=(), on_add=None):
+        self._units = collections.OrderedDict()
+        self.on_add = on_add
+        for unit in units:
+            self.add(unit)
+
+    def add(self, unit):
+        key = id(unit)
+        if key not in self._units:
+            self._units[key] = unit
+            if self.on_add:
+                self.on_add(unit)
+
+    append = add
+
+    def discard(self, unit):
+        self._units.pop(id(unit), None)
+
+    def remove(self, unit):
+        try:
+            del self._units[id(unit)]
+        except KeyError:
+            raise ValueError("%r is not in the set" % (unit,))
+
+    def __contains__(self, unit):
+        return id(unit) in self._units
+
+    def __len__(self):
+        return len(self._units)
+
+    def __iter__(self):
+        return self._units.itervalues()
+
+    def __getitem__(self, index):
+        return self._units.values()[index]
+
+    def __repr__(self):
+        return "UnitSet(%r)" % (self._units.values(),)
+
+
+class UnitList(list):
+    """
+    A list of Units that counts its changes, so that a CTScheduler can
+    tell in O(1) whether it changed since it last looked.
+
+    version is bumped by every change. rewrites is bumped only by changes
+    other than adding to the end (removing, replacing, inserting or
+    reordering units).
+    """
+
+    def __init__(self, units=()):
+        list.__init__(self, units)
+        self.version = 0
+        self.rewrites = 0
+
+    def _rewrite(self):
+        self.version += 1
+        self.rewrites += 1
+
+    def append(self, unit):
+        list.append(self, unit)
+        self.version += 1
+
+    def extend(self, units):
+        list.extend(self, units)
+        self.version += 1
+
+    def __iadd__(self, units):
+        self.extend(units)
+        return self
+
+    def insert(self, index, unit):
+        list.insert(self, index, unit)
+        self._rewrite()
+
+    def pop(self, index=-1):
+        unit = list.pop(self, index)
+        self._rewrite()
+        return unit
+
+    def remove(self, unit):
+        list.remove(self, unit)
+        self._rewrite()
+
+    def reverse(self):
+        list.reverse(self)
+        self._rewrite()
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._rewrite()
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        self._rewrite()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._rewrite()
+
+    def __setslice__(self, i, j, units):
+        list.__setslice__(self, i, j, units)
+        self._rewrite()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._rewrite()
+
+    def __imul__(self, count):
+        list.__imul__(self, count)
+        self._rewrite()
+        return self
+
+
+class Team(object):
+    """
+    A group of Units controlled by a player or AI.
+
+    live_units and dead_units are kept up to date as Units die, so
+    is_defeated() is O(1).
+    """
+
+    def __init__(self):
+        self.all_units = UnitSet(on_add=self._register)
+        self.live_units = UnitSet()
+        self.dead_units = UnitSet()
+
+    def _register(self, unit):
+        unit.team = self
+        self.unit_status_changed(unit)
+
+    def unit_status_changed(self, unit):
+        """
+        Files a Unit under live_units or dead_units. Called by the Unit
+        when it dies.
+        """
+        if unit.alive:
+            self.dead_units.discard(unit)
+            self.live_units.add(unit)
+        else:
+            self.live_units.discard(unit)
+            self.dead_units.add(unit)
+
+    def live_update(self):
+        """
+        Re-files every Unit. Only needed if Units have been changed
+        without going through Unit.die.
+        """
+        for unit in self.all_units:
+            self.unit_status_changed(unit)
+
+    def add_unit(self, unit):
+        """
+        Puts a Unit on the Team
+        """
+        self.all_units.add(unit)
+
+    def is_defeated(self):
+        """
+        Flags true when all a team's units are dead.
+        """
+        return len(self.live_units) == 0
+
+
+def within_dist(dx, dy, dist, metric=CHEBYSHEV):
+    """
+    Returns True if the offset (dx, dy) lies within dist under metric
+    """
+    if metric == CHEBYSHEV:
+        return max(abs(dx), abs(dy)) <= dist
+    if metric == MANHATTAN:
+        return abs(dx) + abs(dy) <= dist
+    if metric == EUCLIDEAN:
+        return dx * dx + dy * dy <= dist * dist
+    raise ValueError("Unknown metric %r" % (metric,))
+
+
+class SpatialIndex(object):
+    """
+    Tracks which Unit stands on which cell.
+
+    cells maps (x, y) to the Unit there. Units are also kept in coarse
+    square buckets of bucket_size cells, so radius and nearest-unit
+    queries only look at the buckets that could hold an answer.
+    """
+    BUCKET_SIZE = 8
+
+    def __init__(self, bucket_size=BUCKET_SIZE):
+        self.bucket_size = bucket_size
+        self.cells = {}
+        self.buckets = {}
+        self.reach = 0
+
+    def bucket_of(self, x, y):
+        return (x // self.bucket_size, y // self.bucket_size)
+
+    def add(self, unit, x, y):
+        self.cells[(x, y)] = unit
+        key = self.bucket_of(x, y)
+        self.buckets.setdefault(key, []).append(unit)
+        self.reach = max(self.reach, abs(key[0]), abs(key[1]))
+
+    def remove(self, unit, x, y):
+        if self.cells.get((x, y)) is unit:
+            del self.cells[(x, y)]
+        key = self.bucket_of(x, y)
+        bucket = self.buckets.get(key)
+        if bucket and unit in bucket:
+            bucket.remove(unit)
+            if not bucket:
+                del self.buckets[key]
+
+    def unit_at(self, x, y):
+        return self.cells.get((x, y))
+
+    def within(self, x, y, dist, metric=CHEBYSHEV):
+        """
+        Returns the Units within dist of (x,y), including any on (x,y)
+        itself, ordered by x, then y
+        """
+        low_x, low_y = self.bucket_of(x - dist, y - dist)
+        high_x, high_y = self.bucket_of(x + dist, y + dist)
+        found = []
+        for bx in xrange(low_x, high_x + 1):
+            for by in xrange(low_y, high_y + 1):
+                for unit in self.buckets.get((bx, by), ()):
+                    node = unit.location
+                    if within_dist(node.x - x, node.y - y, dist, metric):
+                        found.append(((node.x, node.y), unit))
+        found.sort(key=lambda item: item[0])
+        return [unit for _, unit in found]
+
+    def in_rect(self, x0, y0, x1, y1):
+        """
+        Returns the Units on cells with x0 <= x < x1 and y0 <= y < y1,
+        ordered by x, then y
+        """
+        if x1 <= x0 or y1 <= y0:
+            return []
+        low_x, low_y = self.bucket_of(x0, y0)
+        high_x, high_y = self.bucket_of(x1 - 1, y1 - 1)
+        if (high_x - low_x + 1) * (high_y - low_y + 1) > len(self.buckets):
+            keys = [key for key in self.buckets
+                    if low_x <= key[0] <= high_x and low_y <= key[1] <= high_y]
+        else:
+            keys = [(bx, by) for bx in xrange(low_x, high_x + 1)
+                    for by in xrange(low_y, high_y + 1)]
+        found = []
+        for key in keys:
+            for unit in self.buckets.get(key, ()):
+                node = unit.location
+                if x0 <= node.x < x1 and y0 <= node.y < y1:
+                    found.append(((node.x, node.y), unit))
+        found.sort(key=lambda item: item[0])
+        return [unit for _, unit in found]
+
+    def nearest(self, x, y, predicate):
+        """
+        Returns the Unit closest to (x,y) by Chebyshev distance for which
+        predicate(unit) is true, or None. Ties go to the lowest (x, y).
+        """
+        size = self.bucket_size
+        bx, by = self.bucket_of(x, y)
+        best = None
+        best_key = None
+        ring = 0
+        limit = self.reach + max(abs(bx), abs(by))
+        while ring <= limit:
+            if best is not None and best_key[0] <= (ring - 1) * size:
+                break
+            for i in xrange(-ring, ring + 1):
+                for j in xrange(-ring, ring + 1):
+                    if max(abs(i), abs(j)) != ring:
+                        continue
+                    for unit in self.buckets.get((bx + i, by + j), ()):
+                        node = unit.location
+                        key = (max(abs(node.x - x), abs(node.y - y)), node.x, node.y)
+                        if (best_key is None or key < best_key) and predicate(unit):
+                            best = unit
+                            best_key = key
+            ring += 1
+        return best
+
+
+class CTScheduler(object):
+    """
+    Event-driven turn order for a Battle.
+
+    Every tick each unit's CT grows by its speed, so the tick on which it
+    reaches READY_CT can be worked out in advance. Units wait in a heap
+    keyed by that tick, and the clock jumps straight to the next one
+    instead of ticking through the gap. Units that have reached READY_CT
+    move to a second heap, the ready pool, ordered by their position in
+    battle.units so the tie-break of Battle.tick() costs O(log n).
+
+    A scheduled Unit's ct is derived from the clock, so nothing is updated
+    for units that are not ready. battle.units, a UnitList, is checked on
+    each call (see sync()); changing a Unit's ct or speed reschedules it,
+    and dead units are dropped.
+    """
+    READY_CT = 100
+
+    def __init__(self, battle):
+        self.battle = battle
+        self.clock = 0
+        self.heap = []
+        self.pool = []
+        self.order = {}
+        self.entries = {}
+        self._units = None
+        self._version = None
+        self._rewrites = None
+        self._seen = 0
+        # Bumped whenever the turn order may have changed
+        self.changes = 0
+
+    def sync(self):
+        """
+        Catches up with battle.units, which may be changed in any way
+        between calls. Units appended since the last call are scheduled.
+        Any other change (the list replaced, or units in it removed,
+        replaced or reordered) reschedules everything, as ties are broken
+        by position in the list. Spotting changes only compares the
+        UnitList's counters with the ones seen last time.
+        """
+        units = self.battle.units
+        if units is self._units and units.version == self._version:
+            return
+        if units is self._units and units.rewrites == self._rewrites:
+            new = units[self._seen:]
+        else:
+            self.clear()
+            self._units = units
+            new = units
+        for unit in new:
+            self.add(unit)
+        self._version = units.version
+        self._rewrites = units.rewrites
+        self._seen = len(units)
+
+    def clear(self):
+        """
+        Releases every unit, leaving each with its current ct
+        """
+        for unit in self.order:
+            unit._ct = unit.ct
+            unit.scheduler = False
+        self.changes += 1
+        self.heap = []
+        self.pool = []
+        self.order = {}
+        self.entries = {}
+        self._units = None
+        self._version = None
+        self._rewrites = None
+        self._seen = 0
+
+    def add(self, unit):
+        if not unit.alive:
+            return
+        unit._ct = unit.ct
+        unit._ct_clock = self.clock
+        unit.scheduler = self
+        self.order[unit] = len(self.order)
+        self.reschedule(unit)
+
+    def remove(self, unit):
+        """
+        Stops scheduling unit, leaving it with its current ct. Its heap
+        entries go stale and are dropped lazily.
+        """
+        if self.entries.pop(unit, None) is None:
+            return
+        unit._ct = unit.ct
+        unit.scheduler = False
+        self.changes += 1
+
+    def ready_tick(self, unit):
+        """
+        Returns the tick on which unit's CT reaches READY_CT
+        """
+        ct = unit.ct
+        if ct >= self.READY_CT:
+            return self.clock
+        if unit.speed <= 0:
+            return float("inf")
+        return self.clock + int(-((ct - self.READY_CT) // unit.speed))
+
+    def reschedule(self, unit):
+        entry = (self.ready_tick(unit), -self.order[unit], unit)
+        self.entries[unit] = entry
+        self.changes += 1
+        if len(self.heap) + len(self.pool) > 2 * len(self.entries) + 16:
+            self._rebuild()
+        else:
+            heapq.heappush(self.heap, entry)
+
+    def _rebuild(self):
+        """
+        Drops stale heap entries
+        """
+        self.heap = []
+        self.pool = []
+        for entry in self.entries.itervalues():
+            if entry[0] <= self.clock:
+                self.pool.append((entry[1], entry))
+            else:
+                self.heap.append(entry)
+        heapq.heapify(self.heap)
+        heapq.heapify(self.pool)
+
+    def _live(self, entry):
+        return self.entries.get(entry[2]) is entry
+
+    def _next_due(self):
+        """
+        Returns the earliest tick on which some unit is ready
+        """
+        pool = self.pool
+        while pool and not self._live(pool[0][1]):
+            heapq.heappop(pool)
+        if pool:
+            return self.clock
+        heap = self.heap
+        while heap and not self._live(heap[0]):
+            heapq.heappop(heap)
+        if heap:
+            return heap[0][0]
+        return float("inf")
+
+    def _activate(self, when):
+        """
+        Moves the clock to when and returns the last unit, in battle order,
+        that is ready by then
+        """
+        heap = self.heap
+        pool = self.pool
+        while heap and heap[0][0] <= when:
+            entry = heapq.heappop(heap)
+            if self._live(entry):
+                heapq.heappush(pool, (entry[1], entry))
+        while not self._live(pool[0][1]):
+            heapq.heappop(pool)
+        self.clock = when
+        self.changes += 1
+        return pool[0][1][2]
+
+    def next_ready(self):
+        """
+        Jumps to the next tick on which some unit is ready and returns it.
+
+        At least one tick always passes. When several units are ready, the
+        last one in battle.units wins, exactly as with Battle.tick().
+        """
+        self.sync()
+        due = self._next_due()
+        if due == float("inf"):
+            raise ValueError("No unit in the battle can ever become ready")
+        return self._activate(max(due, self.clock + 1))
+
+    def step(self, ticks=1):
+        """
+        Moves the clock forward by ticks. Returns the unit that is ready,
+        or False if none is.
+        """
+        self.sync()
+        when = self.clock + ticks
+        if self._next_due() > when:
+            self.clock = when
+            return False
+        return self._activate(when)
+
+    @staticmethod
+    def _in_order(heap, live):
+        """
+        Yields the live entries of heap from smallest to largest without
+        popping anything. Each costs O(log k) for the k entries seen so far.
+        """
+        if not heap:
+            return
+        frontier = [(heap[0], 0)]
+        size = len(heap)
+        while frontier:
+            entry, index = heapq.heappop(frontier)
+            for child in (2 * index + 1, 2 * index + 2):
+                if child < size:
+                    heapq.heappush(frontier, (heap[child], child))
+            if live(entry):
+                yield entry
+
+    def forecast(self, count, active=None):
+        """
+        Returns the next count activations as (tick, unit) pairs, worked out
+        from each unit's ct and speed rather than by running the clock.
+
+        Turns are assumed to end with ct reset to 0 and nothing else
+        changing. If active is given, it is the unit taking its turn now: it
+        comes first, at the current clock. The scheduler's heaps are walked
+        in order without being modified, so the cost is O(count log n) plus
+        one heap push for every other unit found ready along the way, and
+        the result always reflects the latest speed changes, deaths and
+        arrivals.
+        """
+        self.sync()
+        entries = self.entries
+        played = {}
+
+        def live(entry):
+            return entries.get(entry[2]) is entry and entry[2] not in played
+
+        waiting = self._in_order(self.heap, live)
+        pooled = self._in_order(self.pool, lambda item: live(item[1]))
+        next_waiting = next(waiting, None)
+        next_pooled = next(pooled, None)
+        replayed = []
+        ready = []
+        clock = self.clock
+        result = []
+
+        def play(unit, when):
+            result.append((when, unit))
+            played[unit] = True
+            if unit.speed > 0:
+                heapq.heappush(replayed, (
+                    when + int(-(-self.READY_CT // unit.speed)),
+                    -self.order[unit], unit))
+
+        if active is not None and active in entries and count > 0:
+            play(active, clock)
+            if next_waiting is not None and not live(next_waiting):
+                next_waiting = next(waiting, None)
+            if next_pooled is not None and not live(next_pooled[1]):
+                next_pooled = next(pooled, None)
+        while len(result) < count:
+            if ready or next_pooled is not None:
+                due = clock
+            else:
+                due = min(next_waiting[0] if next_waiting else float("inf"),
+                          replayed[0][0] if replayed else float("inf"))
+                if due == float("inf"):
+                    break
+            when = max(due, clock + 1)
+            while next_waiting is not None and next_waiting[0] <= when:
+                heapq.heappush(ready, (next_waiting[1], next_waiting[2]))
+                next_waiting = next(waiting, None)
+            while replayed and replayed[0][0] <= when:
+                entry = heapq.heappop(replayed)
+                heapq.heappush(ready, (entry[1], entry[2]))
+            if (next_pooled is not None and
+                    (not ready or next_pooled[0] < ready[0][0])):
+                unit = next_pooled[1][2]
+                next_pooled = next(pooled, None)
+            else:
+                unit = heapq.heappop(ready)[1]
+            clock = when
+            play(unit, when)
+        return result
+
+
+class Battle(object):
+    def __init__(self, grid, use_table=False):
+        """
+        use_table: Keep the numeric state of Units made by new_unit() in a
+        UnitTable rather than on each Unit.
+        """
+        self.teams = []
+        self.units = []
+        self.active_unit = False
+        self.grid = grid
+        self.table = UnitTable() if use_table else None
+        self.scheduler = CTScheduler(self)
+        self.occupancy = SpatialIndex()
+        # Objects with unit_moved(unit, old, new) and unit_removed(unit,
+        # node) methods, told about every change to the occupancy index
+        self.listeners = []
+        self.threats = None
+        self.actions = ActionCache(self)
+        self.listeners.append(self.actions)
+        # The ReplayWriter logging this Battle, if any
+        self.recorder = None
+
+        self.finished = False
+
+    @property
+    def units(self):
+        """
+        The Units in the battle, in the order that breaks ties for turns. Kept as a
+        UnitList, so the scheduler can see every change made to it;
+        assigning any other sequence stores a UnitList copy of it.
+        """
+        return self._units
+
+    @units.setter
+    def units(self, units):
+        if not isinstance(units, UnitList):
+            units = UnitList(units)
+        self._units = units
+
+    def clone(self):
+        """
+        Returns an independent copy of the Battle: grid cells, units,
+        teams, CT and the active unit. Much cheaper than a deepcopy, as
+        only plain state is copied and cached search results are dropped.
+        """
+        battle = Battle(self.grid.copy(), self.table is not None)
+        battle.teams = [Team() for _ in self.teams]
+        teams = dict(zip(self.teams, battle.teams))
+        battle.scheduler.clock = self.scheduler.clock
+        copies = {}
+        for unit in self.units:
+            copy = battle.new_unit()
+            for field in Unit.STATE_FIELDS:
+                setattr(copy, field, getattr(unit, field))
+            copy.ct = unit.ct
+            copy.battle = battle
+            if unit.location:
+                copy.location = battle.grid.get_node(unit.location.x,
+                                                     unit.location.y)
+                if copy.alive:
+                    battle.occupancy.add(copy, copy.location.x, copy.location.y)
+            if unit.team in teams:
+                teams[unit.team].add_unit(copy)
+            battle.units.append(copy)
+            copies[unit] = copy
+        battle.active_unit = copies.get(self.active_unit, False)
+        return battle
+
+    def snapshot(self):
+        """
+        Returns the Battle as a binary snapshot string (see BattleSnapshot)
+        """
+        return write_snapshot(self)
+
+    def save(self, path):
+        """
+        Writes a binary snapshot of the Battle to path
+        """
+        with open(path, "wb") as snapshot_file:
+            snapshot_file.write(self.snapshot())
+
+    @staticmethod
+    def load(path):
+        """
+        Restores a Battle saved with save()
+        """
+        return BattleSnapshot.open(path).restore()
+
+    def new_unit(self):
+        """
+        Returns a new Unit suited to the Battle's storage. It still has
+        to join_battle().
+        """
+        if self.table is not None:
+            return TableUnit(self.table)
+        return Unit()
+
+    def place_unit(self, unit, old, new):
+        """
+        Records a Unit moving from Node old (False when it is first
+        placed) to Node new, keeping the occupancy index and the grid's
+        occupied flags up to date. Called by Unit.move.
+        """
+        if old:
+            self.clear_cell(unit, old)
+        self.occupancy.add(unit, new.x, new.y)
+        self.grid.set_occupied(new.x, new.y, True)
+        for listener in self.listeners:
+            listener.unit_moved(unit, old, new)
+
+    def remove_unit(self, unit, node):
+        """
+        Takes a Unit off the map at node, e.g. when it dies
+        """
+        self.clear_cell(unit, node)
+        for listener in self.listeners:
+            listener.unit_removed(unit, node)
+
+    def clear_cell(self, unit, node):
+        self.occupancy.remove(unit, node.x, node.y)
+        self.grid.set_occupied(node.x, node.y,
+                               self.occupancy.unit_at(node.x, node.y) is not None)
+
+    def threat_map(self):
+        """
+        Returns the Battle's ThreatMap, building it on first use
+        """
+        if self.threats is None:
+            self.threats = ThreatMap(self)
+        return self.threats
+
+    def unit_at(self, x, y):
+        """
+        Returns the living Unit at (x,y), or None
+        """
+        return self.occupancy.unit_at(x, y)
+
+    def units_within(self, node, dist, metric=CHEBYSHEV):
+        """
+        Returns the living Units within dist of node, including any on
+        node itself
+        """
+        return self.occupancy.within(node.x, node.y, dist, metric)
+
+    def units_in(self, x0, y0, x1, y1):
+        """
+        Returns the living Units on cells with x0 <= x < x1 and
+        y0 <= y < y1
+        """
+        return self.occupancy.in_rect(x0, y0, x1, y1)
+
+    def nearest_unit(self, node, predicate):
+        """
+        Returns the living Unit closest to node for which predicate(unit)
+        is true, or None
+        """
+        return self.occupancy.nearest(node.x, node.y, predicate)
+
+    def sight_matrix(self, radius=SIGHT_RADIUS):
+        """
+        Batched who-can-see-whom query. Returns an (n, n) bool array over
+        battle.units where [i, j] is True if living unit i can see living
+        unit j within radius. Fields of view come from the grid's cache,
+        so repeated calls only pay for the spatial lookups.
+        """
+        count = len(self.units)
+        seen = np.zeros((count, count), dtype=np.bool_)
+        index = dict((id(unit), i) for i, unit in enumerate(self.units))
+        for i, viewer in enumerate(self.units):
+            if not (viewer.alive and viewer.location):
+                continue
+            x, y = viewer.location.x, viewer.location.y
+            field = self.grid.field_of_view(x, y, radius)
+            for target in self.occupancy.within(x, y, radius, EUCLIDEAN):
+                location = target.location
+                if target is not viewer and (location.x, location.y) in field:
+                    seen[i, index[id(target)]] = True
+        return seen
+
+    def visible_mask(self, team, radius=SIGHT_RADIUS, window=None):
+        """
+        Returns a (height, width) bool array of the cells seen by any
+        living unit of team. With window, an (x0, y0, x1, y1) rect of
+        cells, only that part of the map is returned and only units within
+        radius of it are looked at.
+        """
+        x0, y0, x1, y1 = window or (0, 0, self.grid.width, self.grid.height)
+        mask = np.zeros((y1 - y0, x1 - x0), dtype=np.bool_)
+        for unit in team.live_units:
+            if not unit.location:
+                continue
+            x, y = unit.location.x, unit.location.y
+            if not (x0 - radius <= x < x1 + radius and
+                    y0 - radius <= y < y1 + radius):
+                continue
+            cells = self.grid.field_of_view(x, y, radius).cells()
+            xs = cells[:, 0] - x0
+            ys = cells[:, 1] - y0
+            inside = ((xs >= 0) & (xs < x1 - x0) &
+                      (ys >= 0) & (ys < y1 - y0))
+            mask[ys[inside], xs[inside]] = True
+        return mask
+
+    def tick(self):
+        """
+        Moves time forward by one tick
+        """
+        unit = self.scheduler.step()
+        if unit:
+            self.active_unit = unit
+
+    def advance(self):
+        """
+        Advances time until a unit is ready
+        """
+        if not self.active_unit:
+            self.active_unit = self.scheduler.next_ready()
+
+    def forecast(self, count):
+        """
+        Returns the next count units to act, in order, starting with the
+        active unit if there is one. Worked out from CT and speed by
+        CTScheduler.forecast() in O(count log n), assuming every turn ends
+        with CT reset to 0.
+        """
+        return [unit for _, unit in
+                self.scheduler.forecast(count, self.active_unit or None)]
+
+    def run(self, kill_func, input_func=None):
+        """
+        Main Battle loop.
+
+        Parameters:
+        kill_func : A function that ends the loop when it returns True
+        input_func: The function that returns the command. Prompts on the
+        terminal by default.
+        """
+        input_func = input_func or text_command
+        self.finished = False
+        while not self.finished:
+            self.next_turn(input_func)
+            self.finished = kill_func()
+
+    def run_commands(self, input_func, max_turns=None):
+        """
+        Plays turns with commands from input_func, e.g. a CommandSource,
+        until a Team is defeated, max_turns turns have been played, or the
+        commands run out (input_func raises EOFError) part way through a
+        turn. Returns the number of turns completed.
+        """
+        turns = 0
+        try:
+            while (not self.defeat_check() and
+                   (max_turns is None or turns < max_turns)):
+                self.next_turn(input_func)
+                turns += 1
+        except EOFError:
+            pass
+        return turns
+
+    def next_turn(self, input_func):
+        '''
+        Finds the next active unit, runs its turn, and resets
+
+        input_func: The function that returns the command.
+        '''
+        unit = self._begin_turn()
+        unit.turn(input_func)
+        self._end_turn(unit)
+
+    def _begin_turn(self):
+        """
+        Starts the next turn for next_turn(), turn_steps() and
+        policy_turn(): finds the active unit, clears its moved and acted
+        flags and tells the recorder. Returns the unit.
+        """
+        if self.recorder:
+            self.recorder.before_turn()
+        self.advance()
+        unit = self.active_unit
+        if self.recorder:
+            self.recorder.record(EVENT_TURN, unit)
+        unit.moved = False
+        unit.acted = False
+        return unit
+
+    def _end_turn(self, unit):
+        """
+        Ends unit's turn: resets its CT, clears the active unit and tells
+        the recorder.
+        """
+        unit.ct = 0
+        self.active_unit = False
+        if self.recorder:
+            self.recorder.end_turn(unit)
+
+    def turn_steps(self):
+        """
+        Resumable counterpart of next_turn(). Finds the next active unit
+        and plays its turn through Unit.turn_steps(), passing on what that
+        yields and is sent.
+        """
+        unit = self._begin_turn()
+        steps = unit.turn_steps()
+        prompt = next(steps)
+        while True:
+            command = yield prompt
+            try:
+                prompt = steps.send(command)
+            except StopIteration:
+                break
+        self._end_turn(unit)
+
+    def manual_kill_check(self):
+        """
+        Manual stop of the main loop
+        """
+        if raw_input("Quit?") == "y":
+            return True
+        else:
+            return False
+
+    def policy_turn(self, policies, rng):
+        """
+        Headless counterpart of next_turn(). Finds the next active unit,
+        lets its Team's policy play the turn, and resets it.
+
+        policies: A dict mapping each Team to a callable
+        policy(unit, battle, rng) that plays one turn for unit.
+        rng: The random.Random instance handed to the policy.
+
+        Returns the Unit that took the turn.
+        """
+        unit = self._begin_turn()
+        policy = policies.get(unit.team)
+        if unit.alive and policy:
+            policy(unit, self, rng)
+        self._end_turn(unit)
+        return unit
+
+    def record(self, target, keyframe_interval=None):
+        """
+        Starts logging the Battle to target, a path or a writable file,
+        and returns the ReplayWriter. Close it with stop_recording().
+        Units must not join the Battle while it is being recorded.
+        """
+        self.recorder = ReplayWriter(self, target, keyframe_interval)
+        return self.recorder
+
+    def stop_recording(self):
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+
+    def defeat_check(self):
+        for team in self.teams:
+            if team.is_defeated():
+                return True
+        return False
+
+
+class ActionCache(object):
+    """
+    Memoizes each Unit's legal moves, adjacent enemies and turn commands,
+    so that policies and menus asking the same question many times in a
+    turn pay for the answer once.
+
+    A unit's moves are kept with the ReachField they came from and reused
+    while the grid still caches that field, i.e. until the unit moves or
+    a cell the flood looked at changes. Adjacent enemies are dropped for
+    every unit next to a cell that a unit enters, leaves or dies on; call
+    clear() after moving units between Teams. Turn commands depend only
+    on the moved and acted flags.
+
+    hits and misses count lookups per kind; see stats().
+    """
+    KINDS = ("moves", "targets", "actions")
+
+    def __init__(self, battle):
+        self.battle = battle
+        self.moves = {}
+        self.targets = {}
+        self.actions = {}
+        self.hits = dict.fromkeys(self.KINDS, 0)
+        self.misses = dict.fromkeys(self.KINDS, 0)
+
+    def clear(self):
+        self.moves.clear()
+        self.targets.clear()
+
+    def legal_moves(self, unit):
+        grid = self.battle.grid
+        field = grid.reachable(unit.location, unit.move_speed)
+        entry = self.moves.get(unit)
+        if entry is not None and entry[0] is field:
+            self.hits["moves"] += 1
+            return entry[1]
+        self.misses["moves"] += 1
+        nodes = grid.nodes_at(field.destinations())
+        self.moves[unit] = (field, nodes)
+        return nodes
+
+    def adjacent_enemies(self, unit):
+        targets = self.targets.get(unit)
+        if targets is not None:
+            self.hits["targets"] += 1
+            return targets
+        self.misses["targets"] += 1
+        targets = self.targets[unit] = unit.enemies_within(1)
+        return targets
+
+    def possible_actions(self, unit):
+        key = (unit.moved, unit.acted)
+        options = self.actions.get(key)
+        if options is not None:
+            self.hits["actions"] += 1
+            return options
+        self.misses["actions"] += 1
+        options = self.actions[key] = unit.list_actions()
+        return options
+
+    def unit_moved(self, unit, old, new):
+        self.targets.pop(unit, None)
+        if self.targets:
+            if old:
+                self.drop_targets_around(old)
+            self.drop_targets_around(new)
+
+    def unit_removed(self, unit, node):
+        self.moves.pop(unit, None)
+        self.targets.pop(unit, None)
+        if self.targets:
+            self.drop_targets_around(node)
+
+    def drop_targets_around(self, node):
+        for other in self.battle.units_within(node, 1):
+            self.targets.pop(other, None)
+
+    def stats(self):
+        """
+        Returns {kind: {"hits": ..., "misses": ..., "hit_rate": ...}}
+        """
+        stats = {}
+        for kind in self.KINDS:
+            hits, misses = self.hits[kind], self.misses[kind]
+            stats[kind] = {"hits": hits, "misses": misses,
+                           "hit_rate": hits / float(hits + misses or 1)}
+        return stats
+
+
+class ThreatMap(object):
+    """
+    Dense per-team maps of where each Team can strike next turn.
+
+    A unit threatens every cell within melee reach (1 square) of a cell it
+    can move to, or of where it stands. For each Team, count[team] holds how
+    many of its units threaten each cell and damage[team] how much melee
+    damage they could deal there, as (height, width) arrays indexed
+    [y, x]. total_count and total_damage sum over all Teams.
+
+    The map listens to its Battle. When a unit moves or dies, only its own
+    footprint and those of units whose reach explored the cells involved
+    are recomputed. Call cell_changed() after editing terrain, and
+    refresh() after changing a unit's move_speed or team. Maps built
+    directly, rather than through Battle.threat_map(), should be closed
+    when no longer needed so that the Battle stops updating them.
+    """
+
+    def __init__(self, battle):
+        self.battle = battle
+        shape = (battle.grid.height, battle.grid.width)
+        self.shape = shape
+        self.count = {}
+        self.damage = {}
+        self.total_count = np.zeros(shape, dtype=np.int32)
+        self.total_damage = np.zeros(shape, dtype=np.int64)
+        # unit -> (team, row slice, column slice, mask, damage, ReachField)
+        self.footprints = {}
+        self.radius = 0
+        battle.listeners.append(self)
+        self.rebuild()
+
+    def rebuild(self):
+        """
+        Recomputes every footprint from scratch
+        """
+        for team in self.count:
+            self.count[team][:] = 0
+            self.damage[team][:] = 0
+        self.total_count[:] = 0
+        self.total_damage[:] = 0
+        self.footprints = {}
+        for unit in self.battle.units:
+            self.refresh(unit)
+
+    def team_arrays(self, team):
+        if team not in self.count:
+            self.count[team] = np.zeros(self.shape, dtype=np.int32)
+            self.damage[team] = np.zeros(self.shape, dtype=np.int64)
+        return self.count[team], self.damage[team]
+
+    def close(self):
+        """
+        Stops listening to the Battle, which forgets the map if it was its
+        threat_map()
+        """
+        if self in self.battle.listeners:
+            self.battle.listeners.remove(self)
+        if self.battle.threats is self:
+            self.battle.threats = None
+
+    def footprint(self, unit):
+        """
+        Returns the cells unit threatens as (row slice, column slice, mask)
+        over its bounding box, and the ReachField it was derived from
+        """
+        grid = self.battle.grid
+        x, y = unit.location.x, unit.location.y
+        field = grid.reachable(unit.location, unit.move_speed)
+        cells = np.vstack(([[x, y]], field.destinations()))
+        low = np.maximum(cells.min(axis=0) - 1, 0)
+        high = np.minimum(cells.max(axis=0) + 2, (grid.width, grid.height))
+        mask = np.zeros((high[1] - low[1], high[0] - low[0]), dtype=np.bool_)
+        limit = mask.shape
+        rows = cells[:, 1] - low[1]
+        columns = cells[:, 0] - low[0]
+        for dy in (-1, 0, 1):
+            row = rows + dy
+            for dx in (-1, 0, 1):
+                column = columns + dx
+                inside = ((row >= 0) & (row < limit[0]) &
+                          (column >= 0) & (column < limit[1]))
+                mask[row[inside], column[inside]] = True
+        return (slice(low[1], high[1]), slice(low[0], high[0]), mask), field
+
+    def drop(self, unit):
+        record = self.footprints.pop(unit, None)
+        if record is None:
+            return
+        team, rows, columns, mask, damage, _ = record
+        count, team_damage = self.team_arrays(team)
+        count[rows, columns] -= mask
+        self.total_count[rows, columns] -= mask
+        team_damage[rows, columns] -= mask * damage
+        self.total_damage[rows, columns] -= mask * damage
+
+    def refresh(self, unit):
+        """
+        Recomputes one unit's footprint
+        """
+        self.drop(unit)
+        if not (unit.alive and unit.location and unit.team):
+            return
+        (rows, columns, mask), field = self.footprint(unit)
+        damage = unit.melee_dmg(None)
+        count, team_damage = self.team_arrays(unit.team)
+        count[rows, columns] += mask
+        self.total_count[rows, columns] += mask
+        team_damage[rows, columns] += mask * damage
+        self.total_damage[rows, columns] += mask * damage
+        self.footprints[unit] = (unit.team, rows, columns, mask, damage, field)
+        self.radius = max(self.radius, unit.move_speed + 1)
+
+    def cell_changed(self, x, y, moved=None):
+        """
+        Refreshes every unit whose reach depends on cell (x,y)
+        """
+        node = Node(x, y)
+        for other in self.battle.units_within(node, self.radius):
+            record = self.footprints.get(other)
+            if other is not moved and record and (x, y) in record[5].explored:
+                self.refresh(other)
+
+    def unit_moved(self, unit, old, new):
+        self.refresh(unit)
+        if old:
+            self.cell_changed(old.x, old.y, unit)
+        self.cell_changed(new.x, new.y, unit)
+
+    def unit_removed(self, unit, node):
+        self.drop(unit)
+        self.cell_changed(node.x, node.y)
+
+    def enemy_damage(self, team):
+        """
+        Returns the damage team's enemies could deal to each cell
+        """
+        own = self.damage.get(team)
+        if own is None:
+            return self.total_damage
+        return self.total_damage - own
+
+    def enemy_count(self, team):
+        """
+        Returns how many of team's enemies threaten each cell
+        """
+        own = self.count.get(team)
+        if own is None:
+            return self.total_count
+        return self.total_count - own
+
+    def danger_at(self, unit, x, y):
+        """
+        Damage unit's enemies could deal at (x,y)
+        """
+        own = self.damage.get(unit.team)
+        danger = self.total_damage[y, x]
+        if own is not None:
+            danger -= own[y, x]
+        return int(danger)
+
+    def safest_cell(self, unit):
+        """
+        Returns the Node reachable by unit (including where it stands) that
+        its enemies could deal the least damage to, ties going to the
+        fewest threatening enemies, then staying put, then the lowest (x, y)
+        """
+        location = unit.location
+        field = self.battle.grid.reachable(location, unit.move_speed)
+        cells = np.vstack(([[location.x, location.y]], field.destinations()))
+        xs, ys = cells[:, 0], cells[:, 1]
+        damage = self.total_damage[ys, xs]
+        count = self.total_count[ys, xs]
+        if unit.team in self.damage:
+            damage = damage - self.damage[unit.team][ys, xs]
+            count = count - self.count[unit.team][ys, xs]
+        moving = np.ones(len(cells), dtype=np.bool_)
+        moving[0] = False
+        best = np.lexsort((ys, xs, moving, count, damage))[0]
+        if best == 0:
+            return location
+        return self.battle.grid.get_node(int(xs[best]), int(ys[best]))
+
+
+SNAPSHOT_MAGIC = "TACS"
+SNAPSHOT_VERSION = 1
+
+# magic, version, grid kind, flags, width, height, unit count, team count,
+# clock, active unit, then the offsets of the terrain, height, occupancy,
+# unit and name sections and the length of the name section
+SNAPSHOT_HEADER = struct.Struct("<4sHBBIIIIqi6Q")
+SNAPSHOT_HEADER_SIZE = 96
+SNAPSHOT_USES_TABLE = 1
+
+SNAPSHOT_GRIDS = [Grid, ArrayGrid, ChunkedGrid]
+
+# A ChunkedGrid's tile size, tile cap, tile count and map file path length
+SNAPSHOT_TILES = struct.Struct("<IIII")
+
+SNAPSHOT_TILE = np.dtype([
+    ("x", "<u4"),
+    ("y", "<u4"),
+    ("dirty", "<u4"),
+])
+
+SNAPSHOT_UNIT = np.dtype([
+    ("speed", "<i8"),
+    ("ct", "<i8"),
+    ("max_hp", "<i8"),
+    ("current_hp", "<i8"),
+    ("damage_dealt", "<i8"),
+    ("move_speed", "<i4"),
+    ("x", "<i4"),
+    ("y", "<i4"),
+    ("team", "<i4"),
+    ("name_offset", "<u4"),
+    ("name_length", "<u4"),
+    ("flags", "<u1"),
+])
+
+UNIT_ALIVE, UNIT_MOVED, UNIT_ACTED, UNIT_TURN_FINISHED, UNIT_PLACED = (
+    1, 2, 4, 8, 16)
+
+
+def _padded(length):
+    return (length + 7) & ~7
+
+
+def write_snapshot(battle):
+    """
+    Packs a Battle into the binary snapshot format read by BattleSnapshot.
+
+    The file is a fixed header followed by 8-byte aligned sections: the
+    grid's terrain, height and occupancy arrays in row order, one packed
+    SNAPSHOT_UNIT record per unit in battle order, and the unit names.
+
+    A ChunkedGrid is not densified. Its three sections instead hold the
+    SNAPSHOT_TILES header and map file path, one SNAPSHOT_TILE record per
+    tile that differs from the map file, and those tiles' terrain, heights
+    and occupancy. The map file itself is referenced, not copied.
+    """
+    grid = battle.grid
+    try:
+        grid_kind = SNAPSHOT_GRIDS.index(type(grid))
+    except ValueError:
+        raise ValueError("Cannot snapshot a %s" % type(grid).__name__)
+    if isinstance(grid, ChunkedGrid):
+        keys, cells = grid.pack_tiles()
+        path = grid.map_file.filename if grid.map_file is not None else ""
+        grid_sections = (SNAPSHOT_TILES.pack(grid.tile_size, grid.max_tiles,
+                                             len(keys), len(path)) + path,
+                         keys.tostring(), cells)
+    else:
+        terrain, heights, occupancy = grid.cell_arrays()
+        grid_sections = (terrain.astype("<u1", copy=False).tostring(),
+                         heights.astype("<i2", copy=False).tostring(),
+                         occupancy.astype("<u1", copy=False).tostring())
+
+    teams = dict((team, i) for i, team in enumerate(battle.teams))
+    records = np.zeros(len(battle.units), dtype=SNAPSHOT_UNIT)
+    names = []
+    name_length = 0
+    for i, unit in enumerate(battle.units):
+        name = unit.name
+        if isinstance(name, unicode):
+            name = name.encode("utf-8")
+        name = str(name)
+        flags = ((unit.alive and UNIT_ALIVE) | (unit.moved and UNIT_MOVED) |
+                 (unit.acted and UNIT_ACTED) |
+                 (unit.turn_finished and UNIT_TURN_FINISHED))
+        x = y = -1
+        if unit.location:
+            flags |= UNIT_PLACED
+            x = unit.location.x
+            y = unit.location.y
+        records[i] = (unit.speed, unit.ct, unit.max_hp, unit.current_hp,
+                      unit.damage_dealt, unit.move_speed, x, y,
+                      teams.get(unit.team, -1), name_length, len(name), flags)
+        names.append(name)
+        name_length += len(name)
+
+    offsets = []
+    sections = []
+    position = SNAPSHOT_HEADER_SIZE
+    for data in grid_sections + (records.tostring(), "".join(names)):
+        offsets.append(position)
+        sections.append(data)
+        sections.append("\0" * (_padded(len(data)) - len(data)))
+        position += _padded(len(data))
+
+    active = -1
+    if battle.active_unit:
+        active = battle.units.index(battle.active_unit)
+    flags = SNAPSHOT_USES_TABLE if battle.table is not None else 0
+    header = SNAPSHOT_HEADER.pack(
+        SNAPSHOT_MAGIC, SNAPSHOT_VERSION, grid_kind, flags,
+        grid.width, grid.height, len(battle.units), len(battle.teams),
+        battle.scheduler.clock, active, *(offsets + [name_length]))
+    header += "\0" * (SNAPSHOT_HEADER_SIZE - len(header))
+    return header + "".join(sections)
+
+
+class BattleSnapshot(object):
+    """
+    Read-only view of a binary battle snapshot (see write_snapshot).
+
+    Only the header is parsed up front. terrain, heights, occupancy and
+    units are NumPy views straight into the buffer, so a snapshot opened
+    over a memory map reads only the pages that are touched. restore()
+    builds a live Battle from it. The cell arrays are not available for
+    a ChunkedGrid, whose tiles are read by chunked_grid() instead.
+    """
+
+    def __init__(self, buf):
+        if len(buf) < SNAPSHOT_HEADER_SIZE:
+            raise ValueError("Not a battle snapshot")
+        fields = SNAPSHOT_HEADER.unpack_from(buf, 0)
+        (magic, version, self.grid_kind, self.flags, self.width, self.height,
+         self.unit_count, self.team_count, self.clock, self.active) = fields[:10]
+        (self.terrain_offset, self.heights_offset, self.occupancy_offset,
+         self.units_offset, self.names_offset, self.names_length) = fields[10:]
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not a battle snapshot")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version %d" % version)
+        self.buf = buf
+
+    @classmethod
+    def open(cls, path):
+        """
+        Opens a snapshot file through a read-only memory map
+        """
+        with open(path, "rb") as snapshot_file:
+            buf = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buf)
+
+    def _array(self, dtype, count, offset):
+        return np.frombuffer(self.buf, dtype=dtype, count=count, offset=offset)
+
+    @property
+    def terrain(self):
+        return self._array("<u1", self.width * self.height, self.terrain_offset)
+
+    @property
+    def heights(self):
+        return self._array("<i2", self.width * self.height, self.heights_offset)
+
+    @property
+    def occupancy(self):
+        return self._array("<u1", self.width * self.height,
+                           self.occupancy_offset).view(np.bool_)
+
+    @property
+    def units(self):
+        return self._array(SNAPSHOT_UNIT, self.unit_count, self.units_offset)
+
+    def chunked_grid(self):
+        """
+        Rebuilds a snapshotted ChunkedGrid over its map file, if it had one
+        """
+        tile_size, max_tiles, count, length = SNAPSHOT_TILES.unpack_from(
+            self.buf, self.terrain_offset)
+        start = self.terrain_offset + SNAPSHOT_TILES.size
+        path = self.buf[start:start + length]
+        if path:
+            grid = ChunkedGrid.open(path, max_tiles)
+        else:
+            grid = ChunkedGrid(self.width, self.height, tile_size, max_tiles)
+        area = tile_size * tile_size
+        grid.load_tiles(self._array(SNAPSHOT_TILE, count, self.heights_offset),
+                        self._array("<u1", count * 4 * area,
+                                    self.occupancy_offset))
+        return grid
+
+    def unit_name(self, index):
+        record = self.units[index]
+        start = self.names_offset + int(record["name_offset"])
+        return self.buf[start:start + int(record["name_length"])]
+
+    def restore(self):
+        """
+        Builds a new Battle from the snapshot
+        """
+        grid_class = SNAPSHOT_GRIDS[self.grid_kind]
+        if grid_class is ChunkedGrid:
+            grid = self.chunked_grid()
+        else:
+            grid = grid_class(self.width, self.height)
+            grid.load_cell_arrays(self.terrain, self.heights, self.occupancy)
+        battle = Battle(grid, bool(self.flags & SNAPSHOT_USES_TABLE))
+        battle.teams = [Team() for _ in xrange(self.team_count)]
+        battle.scheduler.clock = self.clock
+        records = self.units
+        for i, record in enumerate(records.tolist()):
+            (speed, ct, max_hp, current_hp, damage_dealt, move_speed,
+             x, y, team, _, _, flags) = record
+            unit = battle.new_unit()
+            unit.name = self.unit_name(i)
+            unit.speed = speed
+            unit.ct = ct
+            unit.max_hp = max_hp
+            unit.current_hp = current_hp
+            unit.damage_dealt = damage_dealt
+            unit.move_speed = move_speed
+            unit.alive = bool(flags & UNIT_ALIVE)
+            unit.moved = bool(flags & UNIT_MOVED)
+            unit.acted = bool(flags & UNIT_ACTED)
+            unit.turn_finished = bool(flags & UNIT_TURN_FINISHED)
+            unit.battle = battle
+            if flags & UNIT_PLACED:
+                unit.location = grid.get_node(x, y)
+                if unit.alive:
+                    battle.occupancy.add(unit, x, y)
+            if team >= 0:
+                battle.teams[team].add_unit(unit)
+            battle.units.append(unit)
+        if self.active >= 0:
+            battle.active_unit = battle.units[self.active]
+        return battle
+
+    def apply(self, battle, previous):
+        """
+        Brings battle, which matches the snapshot previous, up to this
+        snapshot by changing only the cells and units that differ. Returns
+        the (x, y) cells whose terrain or height changed, or None, leaving
+        battle alone, when the grid, teams or units do not line up and
+        restore() is needed instead.
+        """
+        layout = ("grid_kind", "flags", "width", "height", "unit_count",
+                  "team_count")
+        if [getattr(self, name) for name in layout] != \
+                [getattr(previous, name) for name in layout]:
+            return None
+        records = self.units
+        old = previous.units
+        if not np.array_equal(records["team"], old["team"]):
+            return None
+        flags = records["flags"].astype(np.int64)
+        old_flags = old["flags"].astype(np.int64)
+        placed = flags & UNIT_PLACED
+        alive = flags & UNIT_ALIVE
+        if (((old_flags & UNIT_PLACED) & ~placed).any() or
+                ((alive != 0) & ((old_flags & UNIT_ALIVE) == 0)).any()):
+            return None
+        if SNAPSHOT_GRIDS[self.grid_kind] is ChunkedGrid:
+            if (self.buf[self.terrain_offset:self.units_offset] !=
+                    previous.buf[previous.terrain_offset:previous.units_offset]):
+                return None
+            cells = []
+        else:
+            changed = np.flatnonzero((self.terrain != previous.terrain) |
+                                     (self.heights != previous.heights))
+            cells = zip((changed % self.width).tolist(),
+                        (changed // self.width).tolist())
+            terrain = self.terrain[changed].tolist()
+            heights = self.heights[changed].tolist()
+            for (x, y), kind, height in zip(cells, terrain, heights):
+                battle.grid.set_terrain(x, y, kind)
+                battle.grid.set_height(x, y, height)
+
+        battle.scheduler.clock = self.clock
+        retimed = self.clock != previous.clock
+        grid = battle.grid
+        for i in np.flatnonzero(records != old).tolist():
+            (speed, ct, max_hp, current_hp, damage_dealt, move_speed,
+             x, y, _, _, _, flags) = records[i].tolist()
+            unit = battle.units[i]
+            if flags & UNIT_PLACED and (not unit.location or
+                                        (unit.location.x, unit.location.y) !=
+                                        (x, y)):
+                unit.move(grid.get_node(x, y))
+            if unit.alive and not flags & UNIT_ALIVE:
+                unit.die()
+            unit.speed = speed
+            unit.ct = ct
+            unit.max_hp = max_hp
+            unit.current_hp = current_hp
+            unit.damage_dealt = damage_dealt
+            unit.move_speed = move_speed
+            unit.moved = bool(flags & UNIT_MOVED)
+            unit.acted = bool(flags & UNIT_ACTED)
+            unit.turn_finished = bool(flags & UNIT_TURN_FINISHED)
+        if retimed:
+            for unit, ct in zip(battle.units, records["ct"].tolist()):
+                unit.ct = ct
+        battle.active_unit = (battle.units[self.active] if self.active >= 0
+                              else False)
+        return cells
+
+
+# Replay event kinds
+(EVENT_TURN, EVENT_END, EVENT_MOVE, EVENT_HP, EVENT_DEALT, EVENT_DIE,
+ EVENT_KEYFRAME) = range(1, 8)
+
+REPLAY_MAGIC = "TREP"
+REPLAY_END_MAGIC = "TEND"
+REPLAY_VERSION = 1
+KEYFRAME_INTERVAL = 50
+
+# magic, version, keyframe interval
+REPLAY_HEADER = struct.Struct("<4sHH")
+# kind, unit index (turn number for keyframes), then two arguments
+REPLAY_EVENT = struct.Struct("<BIii")
+# turn, file offset of the keyframe event
+REPLAY_INDEX = struct.Struct("<IQ")
+# index offset, keyframe count, turns, magic
+REPLAY_TRAILER = struct.Struct("<QII4s")
+
+
+class ReplayWriter(object):
+    """
+    Appends a Battle's events to a binary replay log.
+
+    The log is a short header followed by fixed-size REPLAY_EVENT records:
+    turn start and end, moves, HP changes, damage dealt and deaths. Every
+    keyframe_interval turns a snapshot of the Battle (see write_snapshot)
+    is stored inline as a keyframe, the first one when recording starts.
+    close() appends an index of the keyframes so that readers can seek
+    without scanning.
+    """
+
+    def __init__(self, battle, target, keyframe_interval=None):
+        self.battle = battle
+        self.keyframe_interval = keyframe_interval or KEYFRAME_INTERVAL
+        if hasattr(target, "write"):
+            self.file = target
+            self.owns_file = False
+        else:
+            self.file = open(target, "wb", 1 << 16)
+            self.owns_file = True
+        self.offset = 0
+        self.turns = 0
+        self.keyframes = []
+        self.index = {}
+        self.indexed = 0
+        self.write(REPLAY_HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION,
+                                      self.keyframe_interval))
+        self.keyframe()
+
+    def write(self, data):
+        self.file.write(data)
+        self.offset += len(data)
+
+    def unit_index(self, unit):
+        units = self.battle.units
+        if self.indexed != len(units):
+            self.index = dict((id(other), i) for i, other in enumerate(units))
+            self.indexed = len(units)
+        return self.index[id(unit)]
+
+    def record(self, kind, unit, first=0, second=0):
+        self.write(REPLAY_EVENT.pack(kind, self.unit_index(unit), first, second))
+
+    def keyframe(self):
+        data = self.battle.snapshot()
+        self.keyframes.append((self.turns, self.offset))
+        self.write(REPLAY_EVENT.pack(EVENT_KEYFRAME, self.turns, len(data), 0))
+        self.write(data)
+
+    def before_turn(self):
+        if self.turns and self.turns % self.keyframe_interval == 0:
+            self.keyframe()
+
+    def end_turn(self, unit):
+        flags = (unit.moved and UNIT_MOVED) | (unit.acted and UNIT_ACTED)
+        self.record(EVENT_END, unit, flags)
+        self.turns += 1
+
+    def close(self):
+        index_offset = self.offset
+        for turn, offset in self.keyframes:
+            self.write(REPLAY_INDEX.pack(turn, offset))
+        self.write(REPLAY_TRAILER.pack(index_offset, len(self.keyframes),
+                                       self.turns, REPLAY_END_MAGIC))
+        if self.owns_file:
+            self.file.close()
+        else:
+            self.file.flush()
+
+
+class Replay(object):
+    """
+    Reads a replay log written by ReplayWriter, from bytes or (with
+    open()) a memory-mapped file.
+
+    battle_at(turn) rebuilds the Battle as it stood before turn was played
+    by restoring the nearest earlier keyframe and replaying at most
+    keyframe_interval turns of events, so seeking costs the same anywhere
+    in the log. A log that was never closed is scanned for its keyframes.
+    """
+
+    def __init__(self, buf):
+        if len(buf) < REPLAY_HEADER.size:
+            raise ValueError("Not a replay log")
+        magic, version, self.keyframe_interval = REPLAY_HEADER.unpack_from(buf, 0)
+        if magic != REPLAY_MAGIC:
+            raise ValueError("Not a replay log")
+        if version != REPLAY_VERSION:
+            raise ValueError("Unsupported replay version %d" % version)
+        self.buf = buf
+        self.end = len(buf)
+        trailer = None
+        if len(buf) >= REPLAY_HEADER.size + REPLAY_TRAILER.size:
+            trailer = REPLAY_TRAILER.unpack_from(buf, len(buf) - REPLAY_TRAILER.size)
+        if trailer and trailer[3] == REPLAY_END_MAGIC:
+            index_offset, count, self.turns, _ = trailer
+            self.end = index_offset
+            self.keyframes = [REPLAY_INDEX.unpack_from(buf, index_offset + i * REPLAY_INDEX.size)
+                              for i in xrange(count)]
+        else:
+            self.scan()
+        self.keyframe_turns = [turn for turn, _ in self.keyframes]
+
+    @classmethod
+    def open(cls, path):
+        with open(path, "rb") as replay_file:
+            buf = mmap.mmap(replay_file.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buf)
+
+    def events(self, offset):
+        """
+        Yields (offset after the event, kind, unit, first, second) from
+        offset to the end of the events. Keyframe payloads are skipped.
+        """
+        size = REPLAY_EVENT.size
+        while offset + size <= self.end:
+            kind, unit, first, second = REPLAY_EVENT.unpack_from(self.buf, offset)
+            offset += size
+            if kind == EVENT_KEYFRAME:
+                offset += first
+            yield offset, kind, unit, first, second
+
+    def scan(self):
+        self.keyframes = []
+        self.turns = 0
+        offset = REPLAY_HEADER.size
+        for after, kind, unit, first, _ in self.events(offset):
+            if kind == EVENT_KEYFRAME:
+                if after > self.end:
+                    break
+                self.keyframes.append((unit, offset))
+            elif kind == EVENT_END:
+                self.turns += 1
+            offset = after
+        self.end = offset
+
+    def keyframe_battle(self, offset):
+        kind, turn, length, _ = REPLAY_EVENT.unpack_from(self.buf, offset)
+        start = offset + REPLAY_EVENT.size
+        return BattleSnapshot(buffer(self.buf, start, length)).restore()
+
+    def seek(self, turn):
+        """
+        Returns (battle, offset) for the state before turn, where offset
+        is where the events of turn begin
+        """
+        if not 0 <= turn <= self.turns:
+            raise IndexError("Turn %d is outside the replay" % turn)
+        slot = bisect.bisect_right(self.keyframe_turns, turn) - 1
+        start_turn, offset = self.keyframes[slot]
+        battle = self.keyframe_battle(offset)
+        offset += REPLAY_EVENT.size + REPLAY_EVENT.unpack_from(self.buf, offset)[2]
+        return battle, self.play(battle, offset, start_turn, turn)
+
+    def battle_at(self, turn):
+        return self.seek(turn)[0]
+
+    def play(self, battle, offset, turn, stop):
+        """
+        Applies events to battle, which stands before turn, from offset
+        until it stands before turn stop. Returns the offset reached.
+        """
+        units = battle.units
+        for after, kind, index, first, second in self.events(offset):
+            if turn >= stop and kind == EVENT_TURN:
+                break
+            if kind == EVENT_TURN:
+                battle.advance()
+                if battle.active_unit is not units[index]:
+                    raise ValueError("Replay diverged at turn %d" % turn)
+                battle.active_unit.moved = False
+                battle.active_unit.acted = False
+            elif kind == EVENT_END:
+                unit = units[index]
+                unit.ct = 0
+                unit.moved = bool(first & UNIT_MOVED)
+                unit.acted = bool(first & UNIT_ACTED)
+                battle.active_unit = False
+                turn += 1
+            elif kind == EVENT_MOVE:
+                units[index].move(battle.grid.get_node(first, second))
+            elif kind == EVENT_HP:
+                units[index].update_hp(first)
+            elif kind == EVENT_DEALT:
+                units[index].damage_dealt += first
+            elif kind == EVENT_DIE:
+                if units[index].alive:
+                    units[index].die()
+            offset = after
+        return offset
+
+
+class ReplayPlayer(object):
+    """
+    Steps and seeks through a Replay, keeping the current Battle. Stepping
+    forward replays events onto the same Battle; anything else restores
+    a new one from the nearest keyframe.
+    """
+
+    def __init__(self, replay):
+        self.replay = replay
+        self.seek(0)
+
+    def seek(self, turn):
+        turn = max(0, min(turn, self.replay.turns))
+        self.battle, self.offset = self.replay.seek(turn)
+        self.turn = turn
+
+    def step(self, turns=1):
+        target = max(0, min(self.turn + turns, self.replay.turns))
+        if target < self.turn:
+            self.seek(target)
+        else:
+            self.offset = self.replay.play(self.battle, self.offset, self.turn,
+                                           target)
+            self.turn = target
+
+
+def aggressive_policy(unit, battle, rng):
+    """
+    Attacks an adjacent enemy if there is one. Otherwise moves as close as
+    possible to the nearest enemy, then attacks if now adjacent.
+    """
+    adjacent = unit.adjacent_enemies()
+    if not adjacent:
+        nearest = unit.nearest_enemy()
+        if nearest is None:
+            return
+        moves = unit.legal_moves()
+        if moves:
+            def gap(node):
+                return max(abs(node.x - nearest.location.x),
+                           abs(node.y - nearest.location.y))
+            best = min(gap(node) for node in moves)
+            unit.move(rng.choice([node for node in moves if gap(node) == best]))
+        adjacent = unit.adjacent_enemies()
+    if adjacent:
+        target = rng.choice(adjacent)
+        unit.melee_atk(target, unit.melee_hit_check, unit.melee_dmg)
+        unit.acted = True
+
+
+def random_policy(unit, battle, rng):
+    """
+    Moves to a random legal square, then attacks a random adjacent enemy
+    if there is one.
+    """
+    moves = unit.legal_moves()
+    if moves:
+        unit.move(rng.choice(moves))
+    adjacent = unit.adjacent_enemies()
+    if adjacent:
+        unit.melee_atk(rng.choice(adjacent), unit.melee_hit_check, unit.melee_dmg)
+        unit.acted = True
+
+
+class BattleSpec(object):
+    """
+    A picklable recipe for a Battle, used for headless simulation.
+
+    Parameters:
+    width, height: The size of the grid.
+    units: A list of dicts, one per Unit, with keys "team", "x" and "y".
+    Any other keys must be in UNIT_KEYS (name, speed, move_speed, max_hp,
+    ...) and are set as attributes on the Unit; anything else raises
+    ValueError.
+    policies: One policy(unit, battle, rng) callable per team. These must
+    be module-level functions so that they can be sent to worker processes.
+    max_turns: Turn limit after which a battle counts as a draw.
+    use_table: Store Unit state in a UnitTable.
+    """
+
+    UNIT_KEYS = frozenset(Unit.STATE_FIELDS + ('ct',))
+
+    def __init__(self, width, height, units, policies, max_turns=1000,
+                 grid_class=None, use_table=False):
+        for info in units:
+            unknown = set(info) - self.UNIT_KEYS - set(("team", "x", "y"))
+            if unknown:
+                raise ValueError("Unknown unit keys %s" %
+                                 ", ".join(sorted(unknown)))
+        self.width = width
+        self.height = height
+        self.units = units
+        self.policies = policies
+        self.max_turns = max_turns
+        self.grid_class = grid_class or ArrayGrid
+        self.use_table = use_table
+
+    def build(self):
+        """
+        Returns a new Battle set up from the spec
+        """
+        battle = Battle(self.grid_class(self.width, self.height), self.use_table)
+        battle.teams = [Team() for _ in self.policies]
+        for info in self.units:
+            unit = battle.new_unit()
+            for key, value in info.iteritems():
+                if key not in ("team", "x", "y"):
+                    setattr(unit, key, value)
+            if "max_hp" in info and "current_hp" not in info:
+                unit.current_hp = unit.max_hp
+            battle.teams[info["team"]].add_unit(unit)
+            unit.join_battle(battle, info["x"], info["y"])
+        return battle
+
+
+def simulate(spec, seed, replay=None):
+    """
+    Plays one Battle built from spec to completion without any input or
+    display. The same seed always gives the same result. If replay is
+    given, the Battle is recorded there (see Battle.record).
+
+    Returns a dict with the seed, the number of turns taken, the winning
+    team index (None for a draw), and per-team damage dealt and survivors.
+    """
+    rng = random.Random(seed)
+    battle = spec.build()
+    policies = dict(zip(battle.teams, spec.policies))
+    if replay is not None:
+        battle.record(replay)
+    turns = 0
+    while turns < spec.max_turns and not battle.defeat_check():
+        battle.policy_turn(policies, rng)
+        turns += 1
+    battle.stop_recording()
+    standing = [i for i, team in enumerate(battle.teams)
+                if not team.is_defeated()]
+    winner = None
+    if len(standing) == 1:
+        winner = standing[0]
+    return {
+        "seed": seed,
+        "turns": turns,
+        "winner": winner,
+        "damage": [sum(unit.damage_dealt for unit in team.all_units)
+                   for team in battle.teams],
+        "survivors": [len(team.live_units) for team in battle.teams],
+    }
+
+
+class BatchResult(object):
+    """
+    Aggregated outcome of many simulated Battles
+    """
+
+    def __init__(self, results, team_count):
+        self.results = results
+        self.battles = len(results)
+        self.wins = [0] * team_count
+        self.draws = 0
+        damage = [0] * team_count
+        for result in results:
+            if result["winner"] is None:
+                self.draws += 1
+            else:
+                self.wins[result["winner"]] += 1
+            for i, dealt in enumerate(result["damage"]):
+                damage[i] += dealt
+        battles = float(max(self.battles, 1))
+        self.win_rates = [wins / battles for wins in self.wins]
+        self.draw_rate = self.draws / battles
+        self.mean_damage = [dealt / battles for dealt in damage]
+        turns = [result["turns"] for result in results] or [0]
+        self.mean_turns = sum(turns) / battles
+        self.min_turns = min(turns)
+        self.max_turns = max(turns)
+
+    def __str__(self):
+        lines = ["%d battles, %.1f turns on average (%d-%d), %.1f%% draws" % (
+            self.battles, self.mean_turns, self.min_turns, self.max_turns,
+            100 * self.draw_rate)]
+        for i, rate in enumerate(self.win_rates):
+            lines.append("Team %d: %.1f%% wins, %.1f damage dealt per battle" % (
+                i, 100 * rate, self.mean_damage[i]))
+        return "\n".join(lines)
+
+
+_worker_spec = None
+_worker_replay_dir = None
+
+
+def replay_path(replay_dir, seed):
+    return os.path.join(replay_dir, "%d.replay" % seed)
+
+
+def _init_worker(spec, replay_dir=None):
+    global _worker_spec, _worker_replay_dir
+    _worker_spec = spec
+    _worker_replay_dir = replay_dir
+
+
+def _simulate_seed(seed):
+    replay = None
+    if _worker_replay_dir is not None:
+        replay = replay_path(_worker_replay_dir, seed)
+    return simulate(_worker_spec, seed, replay)
+
+
+def run_batch(spec, battles, processes=None, seed=0, replay_dir=None):
+    """
+    Simulates battles Battles from spec across a pool of processes and
+    returns a BatchResult.
+
+    Battle i is played with seed + i, so a batch is reproducible whatever
+    the number of processes. processes=1 runs everything in this process.
+    With replay_dir, every battle is recorded to replay_path(replay_dir,
+    seed).
+    """
+    seeds = range(seed, seed + battles)
+    if processes == 1:
+        _init_worker(spec, replay_dir)
+        results = [_simulate_seed(battle_seed) for battle_seed in seeds]
+    else:
+        pool = multiprocessing.Pool(processes, _init_worker, (spec, replay_dir))
+        try:
+            chunksize = max(1, battles // (4 * (processes or multiprocessing.cpu_count())))
+            results = pool.map(_simulate_seed, seeds, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    return BatchResult(results, len(spec.policies))
+
+
+# One state of a Battle played by a Simulation: the turns played so far,
+# whether the battle is over, and the Battle as a write_snapshot() string
+Frame = collections.namedtuple("Frame", "turn finished snapshot")
+
+
+class FrameQueue(object):
+    """
+    A bounded queue of Frames that never holds up the publisher for long.
+
+    When the queue is full the oldest Frame is dropped to make room, and
+    latest() skips straight to the newest one, so a consumer that falls
+    behind costs the producer nothing. Backed by a multiprocessing.Queue,
+    or by a Queue.Queue when both ends are threads of one process.
+    dropped and skipped count, in the publishing and consuming process
+    respectively, the Frames nobody saw.
+    """
+
+    def __init__(self, size=4, threads=False):
+        if threads:
+            self.queue = Queue.Queue(size)
+        else:
+            self.queue = multiprocessing.Queue(size)
+        self.dropped = 0
+        self.skipped = 0
+
+    # Longest wait, in seconds, for a Frame to drop from a full queue
+    DROP_WAIT = .05
+
+    def publish(self, frame):
+        """
+        Queues frame, dropping the oldest Frame if there is no room
+        """
+        while True:
+            try:
+                self.queue.put_nowait(frame)
+                return
+            except Queue.Full:
+                pass
+            # A full queue can still look empty for a moment, while a
+            # multiprocessing.Queue's feeder thread catches up or the
+            # consumer holds the read end, so wait for the oldest Frame
+            # rather than spinning on get_nowait()
+            try:
+                self.queue.get(True, self.DROP_WAIT)
+                self.dropped += 1
+            except Queue.Empty:
+                pass
+
+    def latest(self, frame=None):
+        """
+        Returns the newest queued Frame, discarding older ones, or frame
+        if nothing has been queued since the last call
+        """
+        while True:
+            try:
+                newer = self.queue.get_nowait()
+            except Queue.Empty:
+                return frame
+            if frame is not None:
+                self.skipped += 1
+            frame = newer
+
+    def wait(self, timeout=None):
+        """
+        Blocks until a Frame is queued and returns the newest one. Raises
+        Queue.Empty if none arrives within timeout seconds.
+        """
+        return self.latest(self.queue.get(True, timeout))
+
+
+def run_simulation(spec, seed, frames, delay=0, stop=None, interval=0):
+    """
+    Plays a Battle built from spec exactly like simulate(), publishing a
+    Frame to frames before the first turn and after every turn.
+
+    delay: Seconds to wait between turns, e.g. to make a battle watchable.
+    stop: An Event that ends the battle early once set.
+    interval: Publish at most one Frame per interval seconds, besides the
+    first and the last, rather than snapshotting turns nobody will see.
+
+    Returns the number of turns played.
+    """
+    rng = random.Random(seed)
+    battle = spec.build()
+    policies = dict(zip(battle.teams, spec.policies))
+    turns = 0
+    finished = turns >= spec.max_turns or battle.defeat_check()
+    frames.publish(Frame(turns, finished, write_snapshot(battle)))
+    published = timeit.default_timer()
+    while not finished:
+        if stop is not None and stop.is_set():
+            break
+        battle.policy_turn(policies, rng)
+        turns += 1
+        finished = turns >= spec.max_turns or battle.defeat_check()
+        now = timeit.default_timer()
+        if finished or now - published >= interval:
+            frames.publish(Frame(turns, finished, write_snapshot(battle)))
+            published = now
+        if delay and not finished:
+            if stop is not None:
+                stop.wait(delay)
+            else:
+                time.sleep(delay)
+    return turns
+
+
+class Simulation(object):
+    """
+    Plays a Battle with run_simulation() in a child process, or a thread,
+    so that the simulation and whatever shows it never wait on each
+    other: policies that think for a long time cannot freeze a window,
+    and a slow frame cannot hold up the battle. The Frames come out of
+    self.frames, at most FRAME_RATE a second unless turns are delayed.
+    """
+    FRAME_RATE = 60
+
+    def __init__(self, spec, seed=0, delay=0, queue_size=4, threads=False):
+        self.frames = FrameQueue(queue_size, threads)
+        if threads:
+            self.stopping = threading.Event()
+            worker = threading.Thread
+        else:
+            self.stopping = multiprocessing.Event()
+            worker = multiprocessing.Process
+        self.worker = worker(target=run_simulation,
+                             args=(spec, seed, self.frames, delay,
+                                   self.stopping, 1.0 / self.FRAME_RATE))
+        self.worker.daemon = True
+
+    def start(self):
+        self.worker.start()
+        return self
+
+    def running(self):
+        return self.worker.is_alive()
+
+    def stop(self, timeout=5):
+        """
+        Ends the battle after the current turn and waits up to timeout
+        seconds for the worker, draining Frames so that a child process
+        can flush its end of the queue and exit
+        """
+        self.stopping.set()
+        deadline = time.time() + timeout
+        while self.worker.is_alive() and time.time() < deadline:
+            self.frames.latest()
+            self.worker.join(0.05)
+
+
+# A macro-action is one whole turn: (dest, target), where dest is the
+# (x, y) to move to or None to stay put, and target is the index in
+# battle.units of the enemy to attack afterwards, or None.
+
+def macro_actions(unit, limit=None):
+    """
+    Returns the macro-actions open to unit, most promising first: attacks
+    on the weakest reachable enemies, then moves ending closest to the
+    nearest enemy. limit keeps only the first few, bounding the branching
+    factor on large maps.
+    """
+    battle = unit.battle
+    index = dict((id(other), i) for i, other in enumerate(battle.units))
+    nearest = unit.nearest_enemy()
+    ranked = []
+    dests = [unit.location] + unit.legal_moves()
+    for node in dests:
+        dest = None if node is unit.location else (node.x, node.y)
+        targets = [other for other in battle.units_within(node, 1)
+                   if unit.is_enemy(other)]
+        for target in targets:
+            ranked.append(((0, target.current_hp, dest is not None),
+                           (dest, index[id(target)])))
+        if not targets:
+            gap = 0
+            if nearest is not None:
+                gap = max(abs(node.x - nearest.location.x),
+                          abs(node.y - nearest.location.y))
+            ranked.append(((1, gap, dest is not None), (dest, None)))
+    ranked.sort(key=lambda item: item[0])
+    actions = [action for _, action in ranked]
+    if limit is not None:
+        actions = actions[:limit]
+    return actions
+
+
+def perform_action(unit, action):
+    """
+    Carries out a macro-action for unit without any menus
+    """
+    dest, target = action
+    if dest is not None:
+        unit.move(unit.battle.grid.get_node(dest[0], dest[1]))
+        unit.moved = True
+    if target is not None:
+        unit.melee_atk(unit.battle.units[target], unit.melee_hit_check,
+                       unit.melee_dmg)
+        unit.acted = True
+
+
+def _next_decision(battle):
+    """
+    Ends the active unit's turn and advances to the next living unit.
+    Returns False once the battle is over.
+    """
+    if battle.active_unit:
+        battle.active_unit.ct = 0
+        battle.active_unit = False
+    while not battle.defeat_check():
+        battle.advance()
+        unit = battle.active_unit
+        if unit.alive:
+            unit.moved = False
+            unit.acted = False
+            return True
+        unit.ct = 0
+        battle.active_unit = False
+    return False
+
+
+def battle_score(battle, team):
+    """
+    Scores battle for the team at index team in battle.teams, between 0
+    (a loss) and 1 (a win): the mean of the team's share of the remaining
+    HP and of the living units
+    """
+    hp = units = 0
+    total_hp = total_units = 0
+    for i, other in enumerate(battle.teams):
+        other_hp = sum(unit.current_hp for unit in other.live_units)
+        total_hp += other_hp
+        total_units += len(other.live_units)
+        if i == team:
+            hp = other_hp
+            units = len(other.live_units)
+    if not total_units:
+        return 0.5
+    return (hp / float(max(total_hp, 1)) + units / float(total_units)) / 2
+
+
+class SearchNode(object):
+    """
+    One decision in the MCTS tree. value is the summed reward from the
+    root team's point of view; mover is the index of the team deciding at
+    this node.
+    """
+    __slots__ = ('parent', 'action', 'children', 'untried', 'mover',
+                 'visits', 'value')
+
+    def __init__(self, parent=None, action=None):
+        self.parent = parent
+        self.action = action
+        self.children = []
+        self.untried = None
+        self.mover = None
+        self.visits = 0
+        self.value = 0.0
+
+
+def mcts_search(battle, iterations=None, deadline=None, rollout_turns=20,
+                exploration=1.4, max_actions=12,
+                rollout_policy=aggressive_policy, rng=None):
+    """
+    Monte Carlo tree search over macro-actions for battle.active_unit.
+
+    Each iteration clones the battle, replays the tree's actions down to a
+    leaf, expands one new action, plays rollout_turns turns with
+    rollout_policy and scores the result with battle_score(). The battle
+    itself is never modified.
+
+    Stops after iterations iterations or once time.time() passes deadline,
+    whichever comes first; at least one must be given.
+
+    Returns a dict mapping each root macro-action tried to
+    (visits, total value).
+    """
+    if iterations is None and deadline is None:
+        raise ValueError("mcts_search needs an iteration or time budget")
+    rng = rng or random.Random()
+    root_team = battle.teams.index(battle.active_unit.team)
+    policies = dict((team, rollout_policy) for team in battle.teams)
+    root = SearchNode()
+    done = 0
+    while iterations is None or done < iterations:
+        if deadline is not None and time.time() >= deadline:
+            break
+        state = battle.clone()
+        node = root
+        while True:
+            if node.untried is None:
+                unit = state.active_unit
+                if unit and not state.defeat_check():
+                    node.mover = state.teams.index(unit.team)
+                    node.untried = macro_actions(unit, max_actions)[::-1]
+                else:
+                    node.untried = []
+            if node.untried or not node.children:
+                break
+            log_visits = math.log(node.visits)
+
+            def score(child):
+                mean = child.value / child.visits
+                if node.mover != root_team:
+                    mean = 1 - mean
+                return mean + exploration * math.sqrt(log_visits / child.visits)
+            node = max(node.children, key=score)
+            perform_action(state.active_unit, node.action)
+            _next_decision(state)
+        if node.untried:
+            child = SearchNode(node, node.untried.pop())
+            node.children.append(child)
+            node = child
+            perform_action(state.active_unit, node.action)
+            if _next_decision(state):
+                for _ in xrange(rollout_turns):
+                    if state.defeat_check():
+                        break
+                    state.policy_turn(policies, rng)
+        reward = battle_score(state, root_team)
+        while node is not None:
+            node.visits += 1
+            node.value += reward
+            node = node.parent
+        done += 1
+    return dict((child.action, (child.visits, child.value))
+                for child in root.children)
+
+
+def best_action(stats):
+    """
+    The most visited action in mcts_search() results, ties going to the
+    higher value
+    """
+    return max(stats, key=lambda action: stats[action])
+
+
+def _search_snapshot(args):
+    data, seed, settings = args
+    battle = BattleSnapshot(data).restore()
+    return mcts_search(battle, rng=random.Random(seed), **settings)
+
+
+class MCTSController(object):
+    """
+    An AI input_func for Unit.turn and Battle.next_turn.
+
+    On the first call of each turn it searches for the active unit's best
+    macro-action with mcts_search(), then answers the turn's prompts one
+    call at a time: "Move" and the move menu index, "Action" and the
+    target menu index, then "End Turn".
+
+    Parameters:
+    battle: The Battle being played.
+    iterations: Rollout budget per decision, shared between processes.
+    time_limit: Seconds allowed per decision. Searching stops when either
+    budget runs out.
+    processes: With more than one, the search is root-parallel: every
+    worker searches its own tree from a snapshot of the battle and the
+    root statistics are summed.
+    The remaining parameters are passed on to mcts_search().
+    """
+    # Scripted: the menus it answers need not be printed
+    quiet = True
+
+    def __init__(self, battle, iterations=200, time_limit=None,
+                 processes=1, seed=0, rollout_turns=20, exploration=1.4,
+                 max_actions=12, rollout_policy=aggressive_policy):
+        self.battle = battle
+        self.iterations = iterations
+        self.time_limit = time_limit
+        self.processes = processes
+        self.rng = random.Random(seed)
+        self.settings = {"rollout_turns": rollout_turns,
+                         "exploration": exploration,
+                         "max_actions": max_actions,
+                         "rollout_policy": rollout_policy}
+        self.pool = None
+        self.commands = None
 
-        (Loosely coupled for testing, can pass in dummy hit/dmg calcs)
+    def __call__(self):
+        command = None
+        if self.commands is not None:
+            command = next(self.commands, None)
+        if command is None:
+            self.commands = self.turn_commands(self.decide())
+            command = next(self.commands)
+        return command
+
+    def decide(self):
         """
-        if hit_func(target):
-            target.update_hp(-dmg_func(target))
+        Returns the chosen macro-action for the active unit
+        """
+        actions = macro_actions(self.battle.active_unit, 2)
+        if len(actions) < 2:
+            return actions[0]
+        deadline = None
+        if self.time_limit is not None:
+            deadline = time.time() + self.time_limit
+        if self.processes == 1:
+            stats = mcts_search(self.battle, self.iterations, deadline,
+                                rng=self.rng, **self.settings)
+        else:
+            stats = self.parallel_search(deadline)
+        if not stats:
+            return actions[0]
+        return best_action(stats)
 
-    def melee_hit_check(self, target):
+    def parallel_search(self, deadline):
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes)
+        settings = dict(self.settings, deadline=deadline)
+        if self.iterations is not None:
+            settings["iterations"] = -(-self.iterations // self.processes)
+        data = self.battle.snapshot()
+        jobs = [(data, self.rng.randrange(2 ** 31), settings)
+                for _ in xrange(self.processes)]
+        stats = {}
+        for result in self.pool.map(_search_snapshot, jobs):
+            for action, (visits, value) in result.iteritems():
+                total_visits, total_value = stats.get(action, (0, 0.0))
+                stats[action] = (total_visits + visits, total_value + value)
+        return stats
+
+    def turn_commands(self, action):
         """
-        Determine if a melee attack hits target
-        Currently a placeholder
+        Yields the commands that play action through the turn menus
         """
-        return True
+        unit = self.battle.active_unit
+        dest, target = action
+        if dest is not None:
+            yield "Move"
+            moves = [(node.x, node.y) for node in unit.legal_moves()]
+            yield str(moves.index(dest))
+        if target is not None:
+            yield "Action"
+            yield str(unit.adjacent_enemies().index(self.battle.units[target]))
+        yield "End Turn"
 
-    def melee_dmg(self, target):
+    def close(self):
         """
-        Determine melee damage
-        Currently a placeholder
+        Shuts down the worker pool, if one was started
         """
-        damage = 10
-        return damage
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
 
 
-class Team(object):
+class Profiler(object):
     """
-    A group of Units controlled by a player or AI.
+    Opt-in timing and counters for the Battle loop's hot paths.
+
+    enable() swaps the methods in HOOKS for timing wrappers and disable()
+    puts the originals back, so a disabled Profiler costs nothing. Also
+    usable as a context manager.
+
+    Every wrapped call is timed, with time spent in nested wrapped calls
+    counted separately as child time. Counters track scheduler ticks,
+    turns, cells settled and explored by move floods, moves generated and
+    turn commands parsed.
+
+    Results: summary() returns a text table; write_trace() writes a Chrome
+    trace (chrome://tracing, Perfetto, speedscope); collapsed_stacks()
+    returns self time per call stack in flamegraph.pl's folded format.
     """
 
-    def __init__(self):
-        self.all_units = []
-        self.live_units = []
-        self.dead_units = []
+    def __init__(self, max_spans=1000000):
+        self.max_spans = max_spans
+        self.enabled = False
+        self.saved = []
+        self.reset()
 
-    def live_update(self):
-        for unit in self.all_units:
-            if unit.alive:
-                if unit not in self.live_units:
-                    self.live_units.append(unit)
-                if unit in self.dead_units:
-                    self.dead_units.remove(unit)
-            elif not unit.alive:
-                if unit in self.live_units:
-                    self.live_units.remove(unit)
-                if unit not in self.dead_units:
-                    self.dead_units.append(unit)
+    def reset(self):
+        self.stats = {}
+        self.counters = collections.Counter()
+        self.paths = collections.Counter()
+        self.spans = []
+        self.dropped = 0
+        self.stack = []
+        self.labels = []
+        self.origin = timeit.default_timer()
 
-    def is_defeated(self):
+    def hooks(self):
         """
-        Flags true when all a team's units are dead.
+        The (owner, attribute, label, before, after) of every hooked
+        callable. owner is a class, or None for this module's globals.
+        before(args) returns state handed to after(args, result, state).
         """
-        self.live_update()
-        if len(self.live_units) == 0:
-            return True
-        else:
-            return False
+        counters = self.counters
 
+        def clock_before(args):
+            return args[0].scheduler.clock
 
-class Battle(object):
-    def __init__(self, grid):
-        self.teams = []
-        self.units = []
-        self.active_unit = False
-        self.grid = grid
+        def count_ticks(args, result, before):
+            counters["ticks"] += args[0].scheduler.clock - before
 
-        self.finished = False
+        def count_turn(args, result, before):
+            counters["turns"] += 1
 
-    def tick(self):
-        """
-        Moves time forward by one tick
-        """
-        for unit in self.units:
-            unit.ct += unit.speed
-            if unit.ct >= 100:
-                self.active_unit = unit
+        def count_flood(args, result, before):
+            counters["floods"] += 1
+            counters["nodes_expanded"] += len(result.costs)
+            counters["cells_explored"] += len(result.explored)
 
-    def advance(self):
+        def count_moves(args, result, before):
+            counters["moves_generated"] += len(result)
+
+        def count_command(args, result, before):
+            counters["commands"] += 1
+
+        return [
+            (Battle, "tick", "battle.tick", clock_before, count_ticks),
+            (Battle, "advance", "battle.advance", clock_before, count_ticks),
+            (Battle, "next_turn", "battle.next_turn", None, count_turn),
+            (Battle, "policy_turn", "battle.policy_turn", None, count_turn),
+            (Unit, "turn", "unit.turn", None, None),
+            (Unit, "legal_moves", "unit.legal_moves", None, count_moves),
+            (Unit, "action_parse", "unit.action_parse", None, count_command),
+            (Unit, "melee_atk", "unit.melee_atk", None, None),
+            (Unit, "melee_atk_many", "unit.melee_atk_many", None, None),
+            (Grid, "neighbors", "grid.neighbors", None, None),
+            (Grid, "_flood", "grid.flood", None, count_flood),
+            (Grid, "find_path", "grid.find_path", None, None),
+            (MCTSController, "decide", "ai.decide", None, None),
+            (None, "mcts_search", "ai.mcts_search", None, None),
+        ]
+
+    def enable(self):
+        if self.enabled:
+            return
+        namespace = globals()
+        for owner, name, label, before, after in self.hooks():
+            if owner is None:
+                original = namespace[name]
+                namespace[name] = self.wrap(original, label, before, after)
+            else:
+                original = owner.__dict__[name]
+                setattr(owner, name, self.wrap(original, label, before, after))
+            self.saved.append((owner, name, original))
+        self.enabled = True
+
+    def disable(self):
+        namespace = globals()
+        for owner, name, original in reversed(self.saved):
+            if owner is None:
+                namespace[name] = original
+            else:
+                setattr(owner, name, original)
+        self.saved = []
+        self.enabled = False
+
+    def __enter__(self):
+        self.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.disable()
+
+    def wrap(self, func, label, before=None, after=None):
+        profiler = self
+        clock = timeit.default_timer
+
+        def wrapper(*args, **kwargs):
+            state = before(args) if before else None
+            profiler.stack.append(0.0)
+            profiler.labels.append(label)
+            start = clock()
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                elapsed = clock() - start
+                profiler.record(label, start, elapsed)
+            if after:
+                after(args, result, state)
+            return result
+        wrapper.__name__ = func.__name__
+        wrapper.__doc__ = func.__doc__
+        wrapper.wrapped = func
+        return wrapper
+
+    def record(self, label, start, elapsed):
+        stack = self.stack
+        own = elapsed - stack.pop()
+        path = ";".join(self.labels)
+        self.labels.pop()
+        if stack:
+            stack[-1] += elapsed
+        stat = self.stats.get(label)
+        if stat is None:
+            stat = self.stats[label] = [0, 0.0, 0.0, 0.0]
+        stat[0] += 1
+        stat[1] += elapsed
+        stat[2] += own
+        if elapsed > stat[3]:
+            stat[3] = elapsed
+        self.paths[path] += own
+        if len(self.spans) < self.max_spans:
+            self.spans.append((label, start, elapsed, len(stack)))
+        else:
+            self.dropped += 1
+
+    def summary(self):
         """
-        Advances time until a unit is ready
+        Returns a text table of calls and times per hook, slowest self time
+        first, followed by the counters
         """
-        while not self.active_unit:
-            self.tick()
+        lines = ["%-22s %9s %11s %11s %11s %11s" % (
+            "hook", "calls", "total ms", "self ms", "mean us", "max us")]
+        rows = sorted(self.stats.iteritems(), key=lambda item: -item[1][2])
+        for label, (calls, total, own, longest) in rows:
+            lines.append("%-22s %9d %11.2f %11.2f %11.2f %11.2f" % (
+                label, calls, total * 1e3, own * 1e3, total / calls * 1e6,
+                longest * 1e6))
+        counters = self.counters
+        if counters:
+            lines.append("")
+            for name in sorted(counters):
+                lines.append("%-22s %9d" % (name, counters[name]))
+            if counters["turns"]:
+                lines.append("%-22s %9.2f" % ("ticks per turn",
+                                              counters["ticks"] / float(counters["turns"])))
+            if counters["floods"]:
+                lines.append("%-22s %9.2f" % ("nodes per flood",
+                                              counters["nodes_expanded"] / float(counters["floods"])))
+        if self.dropped:
+            lines.append("(%d spans past max_spans not kept for the trace)"
+                         % self.dropped)
+        return "\n".join(lines)
 
-    def run(self, kill_func):
+    def trace_events(self):
         """
-        Main Battle loop.
-
-        Parameters:
-        input_func: The function that returns the command
-        kill_func : A function that ends the loop when it returns True
+        Returns the recorded spans and final counters as Chrome trace
+        events, with timestamps in microseconds since the last reset()
         """
-        self.finished = False
-        while not self.finished:
-            self.next_turn(self.active_unit.text_get_command)
-            self.finished = kill_func()
-
-    def next_turn(self, input_func):
-        '''
-        Finds the next active unit, runs its turn, and resets
+        pid = os.getpid()
+        events = [{"name": label, "ph": "X", "pid": pid, "tid": 0,
+                   "ts": (start - self.origin) * 1e6, "dur": elapsed * 1e6}
+                  for label, start, elapsed, _ in self.spans]
+        if self.counters:
+            end = max([event["ts"] + event["dur"] for event in events] or [0])
+            events.append({"name": "counters", "ph": "C", "pid": pid,
+                           "tid": 0, "ts": end,
+                           "args": dict(self.counters)})
+        return events
 
-        input_func: The function that returns the command.
-        '''
-        self.advance()
-        self.active_unit.turn(input_func)
-        self.active_unit = False
+    def write_trace(self, path):
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": self.trace_events(),
+                       "displayTimeUnit": "ms"}, trace_file)
 
-    def manual_kill_check(self):
+    def collapsed_stacks(self):
         """
-        Manual stop of the main loop
+        Returns self time per call stack as "a;b;c microseconds" lines
         """
-        if raw_input("Quit?") == "y":
-            return True
-        else:
-            return False
-
-    def defeat_check(self):
-        for team in self.teams:
-            if team.is_defeated():
-                return True
-        return False
+        return "\n".join("%s %d" % (path, round(own * 1e6))
+                         for path, own in sorted(self.paths.iteritems()))
 
 
 class Menu(object):
@@ -398,17 +4566,20 @@ class Menu(object):
         """
         try:
             command = int(command)
-        except:
-            return False
-        if command in xrange(len(self.options)):
-            result = self.options[command]
-            return result
-        else:
+        except (TypeError, ValueError):
             return False
+        if 0 <= command < len(self.options):
+            return self.options[command]
+        return False
 
     def text_fail(self):
         print "Invalid input. Please select again."
 
+    def no_display(self):
+        """
+        Display and fail function for scripted input: shows nothing
+        """
+
     def get_result(self,
                    display_func,
                    input_func,
@@ -426,14 +4597,11 @@ class Menu(object):
         (Currently only self.text_fail)
         """
         display_func()
-        finished = False
-        while not finished:
-            command = input_func()
-            if self.pull(command):
-                finished = True
-                return self.pull(command)
-            else:
-                fail_func()
+        while True:
+            result = self.pull(input_func())
+            if result:
+                return result
+            fail_func()
 
     def text_get_result(self):
         """
@@ -444,98 +4612,821 @@ class Menu(object):
                                 self.text_fail))
 
 
+def text_command():
+    """
+    Prompts for a turn command on the terminal
+    """
+    return raw_input("Command: ")
+
+
+def is_quiet(input_func):
+    """
+    Whether input_func is scripted, so that menus and messages need not
+    be printed for it
+    """
+    return getattr(input_func, "quiet", False)
+
+
+class CommandSource(object):
+    """
+    An input_func that answers from a sequence of commands instead of
+    the terminal, e.g. a pre-recorded command script.
+
+    Commands come from push() first, then from commands, any iterable of
+    strings such as a list or an open file; trailing newlines are
+    stripped. When both run out it raises EOFError, as raw_input does.
+
+    A quiet source (the default) tells menus not to print, so scripted
+    battles run without console output.
+    """
+
+    def __init__(self, commands=(), quiet=True):
+        self.pending = collections.deque()
+        self.commands = iter(commands)
+        self.quiet = quiet
+        self.count = 0
+
+    @classmethod
+    def from_file(cls, path, quiet=True):
+        """
+        Reads a command script in one go. Blank lines and lines starting
+        with # are skipped.
+        """
+        with open(path) as script:
+            lines = script.read().splitlines()
+        return cls([line for line in lines
+                    if line.strip() and not line.startswith("#")], quiet)
+
+    @classmethod
+    def from_stream(cls, stream=None, quiet=True):
+        """
+        Streams commands from a file object, by default stdin, reading
+        them in buffered blocks rather than prompting for each one
+        """
+        return cls(stream or sys.stdin, quiet)
+
+    def push(self, *commands):
+        """
+        Queues commands ahead of those still to come
+        """
+        self.pending.extend(commands)
+
+    def __call__(self):
+        if self.pending:
+            command = self.pending.popleft()
+        else:
+            try:
+                command = next(self.commands)
+            except StopIteration:
+                raise EOFError("Out of commands")
+        self.count += 1
+        return command.rstrip("\r\n")
+
+
+class CommandRecorder(object):
+    """
+    Wraps an input_func and writes every command it returns to stream,
+    one per line, producing a script CommandSource can replay
+    """
+
+    def __init__(self, input_func, stream):
+        self.input_func = input_func
+        self.stream = stream
+        self.quiet = is_quiet(input_func)
+
+    def __call__(self):
+        command = self.input_func()
+        self.stream.write("%s\n" % command)
+        return command
+
+
+class Camera(object):
+    """
+    The part of a grid shown in a viewport of (width, height) pixels.
+
+    x, y is the cell at the top left of the view and cell_size the zoom,
+    in pixels per cell. By default the whole grid is fitted to the
+    viewport, unless that would make cells smaller than MIN_CELL, in
+    which case the camera starts at DEFAULT_CELL over the top left corner.
+    """
+    MIN_CELL, MAX_CELL = 4, 128
+    DEFAULT_CELL = 16
+
+    def __init__(self, grid_width, grid_height, viewport, cell_size=None):
+        self.grid_width = grid_width
+        self.grid_height = grid_height
+        self.viewport = viewport
+        if cell_size is None:
+            cell_size = min(viewport[0] // grid_width,
+                            viewport[1] // grid_height)
+            if cell_size < self.MIN_CELL:
+                cell_size = self.DEFAULT_CELL
+        self.cell_size = max(self.MIN_CELL, min(cell_size, self.MAX_CELL))
+        self.x = 0
+        self.y = 0
+
+    def span(self):
+        """
+        Returns how many cells fit across and down the viewport,
+        counting partly shown ones
+        """
+        size = self.cell_size
+        return -(-self.viewport[0] // size), -(-self.viewport[1] // size)
+
+    def view(self):
+        """
+        Returns the (x0, y0, x1, y1) cells in view, x1 and y1 exclusive
+        """
+        across, down = self.span()
+        return (self.x, self.y, min(self.grid_width, self.x + across),
+                min(self.grid_height, self.y + down))
+
+    def state(self):
+        return (self.x, self.y, self.cell_size)
+
+    def cell_rect(self, x, y):
+        size = self.cell_size
+        return pygame.Rect((x - self.x) * size, (y - self.y) * size, size, size)
+
+    def cell_at(self, px, py):
+        """
+        Returns the cell under the viewport pixel (px, py)
+        """
+        return (self.x + px // self.cell_size, self.y + py // self.cell_size)
+
+    def clamp(self):
+        """
+        Keeps the view on the grid
+        """
+        size = self.cell_size
+        self.x = max(0, min(self.x, self.grid_width - self.viewport[0] // size))
+        self.y = max(0, min(self.y, self.grid_height - self.viewport[1] // size))
+
+    def pan(self, dx, dy):
+        self.x += dx
+        self.y += dy
+        self.clamp()
+
+    def center_on(self, x, y):
+        across, down = self.span()
+        self.x = x - across // 2
+        self.y = y - down // 2
+        self.clamp()
+
+    def zoom(self, factor, focus=None):
+        """
+        Multiplies cell_size by factor, keeping the cell under the viewport
+        pixel focus (the centre by default) where it is
+        """
+        if focus is None:
+            focus = (self.viewport[0] // 2, self.viewport[1] // 2)
+        x, y = self.cell_at(*focus)
+        size = int(round(self.cell_size * factor))
+        self.cell_size = max(self.MIN_CELL, min(size, self.MAX_CELL))
+        self.x = x - focus[0] // self.cell_size
+        self.y = y - focus[1] // self.cell_size
+        self.clamp()
+
+
 class Visualizer(object):
     """
     Uses pygame to graphically represent a Battle
+
+    A Camera picks the part of the grid in view; only the cells and units
+    inside it are drawn, so frame cost follows the window size rather
+    than the map size. The view is rendered once to a background surface:
+    terrain colours, tinted by any overlays, are looked up for the whole
+    view at once with numpy and written through a surfarray view of the
+    surface. Units are stamped from a sprite atlas cached per zoom level,
+    in one batch of blits. Each frame only the cells whose units
+    moved or changed HP are restored from the background, redrawn and
+    pushed to the display.
+
+    W, A, S and D pan the camera; the mouse wheel and the + and - keys
+    zoom. A bar along the bottom shows who acts next, from
+    Battle.forecast().
+
+    Set fog_team to a Team to draw fog of war from its point of view:
+    cells none of its units can see are shaded and enemies on them are
+    hidden.
+
+    Given a ReplayPlayer as player, the arrow keys scrub through the
+    replay: right and left step one turn, page up and down ten, home and
+    end jump to the start and finish.
     """
     WINDOWWIDTH, WINDOWHEIGHT = 800, 800
+    FPS = 30
 
     BLACK = (0, 0, 0)
     WHITE = (255, 255, 255)
     DK_GREY = (40, 40, 40)
+    GREY = (150, 150, 150)
+    GREEN = (40, 180, 40)
+    RED = (200, 40, 40)
+    TAN = (210, 190, 140)
+    BLUE = (60, 100, 200)
+    FOG_ALPHA = 150
+    OVERLAY_ALPHA = 0.4
+    # Transparent colour of the unit atlas
+    KEY = (255, 0, 255)
+    TEAM_COLORS = (BLUE, RED, GREEN, TAN)
 
-    def __init__(self, battle):
+    TIMELINE_LENGTH = 8
+    TIMELINE_HEIGHT = 24
+
+    TERRAIN_COLORS = {
+        PLAIN: WHITE,
+        ROUGH: TAN,
+        WATER: BLUE,
+        WALL: DK_GREY,
+    }
+
+    SCRUB_KEYS = {
+        pygame.K_RIGHT: 1,
+        pygame.K_LEFT: -1,
+        pygame.K_PAGEUP: 10,
+        pygame.K_PAGEDOWN: -10,
+    }
+    PAN_KEYS = {
+        pygame.K_w: (0, -1),
+        pygame.K_a: (-1, 0),
+        pygame.K_s: (0, 1),
+        pygame.K_d: (1, 0),
+    }
+    ZOOM_KEYS = {
+        pygame.K_EQUALS: 2,
+        pygame.K_PLUS: 2,
+        pygame.K_KP_PLUS: 2,
+        pygame.K_MINUS: 0.5,
+        pygame.K_KP_MINUS: 0.5,
+    }
+    WHEEL_UP, WHEEL_DOWN = 4, 5
+
+    def __init__(self, battle, player=None, screen=None, camera=None,
+                 timeline=None):
+        """
+        screen: A Surface to draw on instead of opening a window, e.g. an
+        offscreen pygame.Surface for headless rendering.
+        camera: A Camera to start from instead of fitting the grid to the
+        screen.
+        timeline: How many upcoming turns the bar along the bottom shows;
+        0 hides it. Defaults to TIMELINE_LENGTH.
+        """
         pygame.init()
-        self.screen = pygame.display.set_mode(
-            (self.WINDOWWIDTH, self.WINDOWHEIGHT))
+        if screen is None:
+            screen = pygame.display.set_mode(
+                (self.WINDOWWIDTH, self.WINDOWHEIGHT))
+        self.screen = screen
+
+        self.player = player
+        if player is not None:
+            battle = player.battle
+        self.battle = None
+        self.corpses = None
+        self.watch(battle)
+        self.timeline = self.TIMELINE_LENGTH if timeline is None else timeline
+        width, height = screen.get_size()
+        if self.timeline:
+            height -= self.TIMELINE_HEIGHT
+        self.camera = camera or Camera(self.grid.width, self.grid.height,
+                                       (width, height))
+        self.timeline_rect = pygame.Rect(0, height, width,
+                                         screen.get_height() - height)
+        self.turns = []
+        self.forecasted = []
+        self.forecast_state = None
+
+        self.font = pygame.font.Font(None, 36)
+        self.small_font = pygame.font.Font(None, 20)
+        self.labels = {}
+
+        self.palette = np.array([self.TERRAIN_COLORS.get(terrain, self.WHITE)
+                                 for terrain in xrange(256)], dtype=np.uint8)
+        self.overlays = []
+        self.sprites = {}
+        self.background = None
+        self.rendered = None
+        self.fog_team = None
+        self.fog = None
+        self.drawn = {}
+        self.last_frame = None
+        self.frame_battle = None
+        self.clock = pygame.time.Clock()
+        self.frame_times = collections.deque(maxlen=1000)
 
+    def watch(self, battle):
+        """
+        Follows battle: listens for deaths so that fallen units can be
+        drawn from an index of their own
+        """
+        if self.battle is not None and self in self.battle.listeners:
+            self.battle.listeners.remove(self)
         self.battle = battle
         self.grid = battle.grid
-        self.grid_width = self.WINDOWWIDTH / len(self.grid.nodes[0])
-        self.grid_height = self.WINDOWHEIGHT / len(self.grid.nodes)
+        self.corpses = SpatialIndex()
+        for unit in battle.units:
+            if not unit.alive and unit.location:
+                self.corpses.add(unit, unit.location.x, unit.location.y)
+        battle.listeners.append(self)
 
-        self.font = pygame.font.Font(None, 36)
+    def unit_moved(self, unit, old, new):
+        pass
 
-    def draw_grid(self):
-        for x in range(0, self.WINDOWWIDTH, self.grid_width):
-            pygame.draw.line(
-                self.screen,
-                self.DK_GREY,
-                (x, 0),
-                (x, self.WINDOWHEIGHT)
-            )
-        for y in range(0, self.WINDOWHEIGHT, self.grid_height):
-            pygame.draw.line(
-                self.screen,
-                self.DK_GREY,
-                (0, y),
-                (self.WINDOWWIDTH, y))
-
-    def fill_grid(self):
-        for row in self.grid.nodes:
-            for node in row:
-                draw_x = node.x * self.grid_width
-                draw_y = node.y * self.grid_height
-                color = self.WHITE
-                draw_node = pygame.Rect(
-                    (draw_x, draw_y, self.grid_width, self.grid_height))
-                pygame.draw.rect(self.screen, color, draw_node)
-
-    def place_units(self):
-        for unit in self.battle.units:
-            draw_x = int((unit.location.x * self.grid_width) + 0.5 * self.grid_width)
-            draw_y = int((unit.location.y * self.grid_height) + 0.5 * self.grid_height)
-            color = self.BLACK
-            pygame.draw.circle(self.screen, color, (draw_x, draw_y), int(.45 * self.grid_width))
+    def unit_removed(self, unit, node):
+        if not unit.alive:
+            self.corpses.add(unit, node.x, node.y)
+
+    def sprite(self, kind):
+        """
+        Returns the Surface for kind at the current zoom, drawing it the
+        first time it is asked for: "fog" shades a cell, and "units" is
+        the atlas units are stamped from
+        """
+        size = self.camera.cell_size
+        cache = self.sprites.setdefault(size, {})
+        sprite = cache.get(kind)
+        if sprite is None:
+            if kind == "fog":
+                sprite = pygame.Surface((size, size), 0, self.screen)
+                sprite.set_alpha(self.FOG_ALPHA)
+            else:
+                sprite = self.unit_atlas(size)
+            cache[kind] = sprite
+        return sprite
+
+    def unit_atlas(self, size):
+        """
+        Returns a Surface holding, side by side, a living and a fallen unit
+        over an empty HP bar, and a full HP bar to stamp on top
+        """
+        atlas = pygame.Surface((3 * size, size), 0, self.screen)
+        atlas.fill(self.KEY)
+        atlas.set_colorkey(self.KEY)
+        for index, color in enumerate((self.BLACK, self.GREY)):
+            rect = pygame.Rect(index * size, 0, size, size)
+            pygame.draw.circle(atlas, color, rect.center, int(.45 * size))
+            atlas.fill(self.RED, (rect.left + 1, rect.bottom - 4, size - 2, 3))
+        atlas.fill(self.GREEN, (2 * size, 0, size - 2, 3))
+        return atlas
+
+    def fill_grid(self, surface=None):
+        """
+        Draws the cells in view: terrain colours, tinted by the overlays,
+        are mapped to pixel values for the whole view at once and spread
+        over each cell through a surfarray view of the surface, which
+        then gets grid lines along the top and left of each cell.
+        surface must not be 24 bit.
+        """
+        surface = surface or self.screen
+        x0, y0, x1, y1 = self.camera.view()
+        if x1 <= x0 or y1 <= y0:
+            return
+        colors = self.palette[self.grid.terrain_in(x0, y0, x1, y1)]
+        for mask, color in self.overlays:
+            tinted = mask[y0:y1, x0:x1]
+            colors[tinted] = (colors[tinted] * (1 - self.OVERLAY_ALPHA) +
+                              np.array(color) * self.OVERLAY_ALPHA)
+        cells = pygame.surfarray.map_array(surface, colors.transpose(1, 0, 2))
+        size = self.camera.cell_size
+        pixels = pygame.surfarray.pixels2d(surface)
+        across, down = (x1 - x0) * size, (y1 - y0) * size
+        if across <= pixels.shape[0] and down <= pixels.shape[1]:
+            board = pixels[:across, :down]
+            board.reshape(x1 - x0, size, y1 - y0, size)[:] = \
+                cells[:, None, :, None]
+        else:
+            # Cells cut off by the edge of the surface
+            across = min(across, pixels.shape[0])
+            down = min(down, pixels.shape[1])
+            board = pixels[:across, :down]
+            board[:] = cells.repeat(size, 0).repeat(size, 1)[:across, :down]
+        line = surface.map_rgb(self.DK_GREY)
+        board[::size, :] = line
+        board[:, ::size] = line
+        del pixels, board
+
+    def draw_grid(self, surface=None):
+        """
+        Draws the board in view, cells and grid lines, to surface (the
+        screen by default). Kept for callers of the old line-drawing API;
+        it is now fill_grid() itself.
+        """
+        self.fill_grid(surface)
+
+    def set_overlays(self, overlays):
+        """
+        Tints cells of the board. overlays is a list of (mask, color), each
+        mask a (height, width) bool array over the grid such as
+        threat_overlay() returns. Takes effect on the next frame.
+        """
+        self.overlays = list(overlays)
+        self.rendered = None
+
+    def threat_overlay(self, team, color=None):
+        """
+        Returns an overlay of the cells team's enemies can strike next turn
+        """
+        return (self.battle.threat_map().enemy_count(team) > 0,
+                color or self.RED)
+
+    def render_background(self):
+        """
+        Renders the grid in view to self.background
+        """
+        size = self.screen.get_size()
+        if self.background is None or self.background.get_size() != size:
+            if self.screen.get_bitsize() == 24:
+                self.background = pygame.Surface(size, 0, 32)
+            else:
+                self.background = pygame.Surface(size, 0, self.screen)
+        self.background.fill(self.BLACK)
+        self.fill_grid(self.background)
+        self.rendered = self.camera.state()
+
+    def cell_rect(self, node):
+        return self.camera.cell_rect(node.x, node.y)
+
+    def unit_state(self, unit):
+        """
+        Everything about a unit that affects how it is drawn
+        """
+        return (unit.location.x, unit.location.y, unit.current_hp,
+                unit.max_hp, unit.alive)
+
+    def draw_units(self, units, surface=None):
+        """
+        Stamps units from the atlas in one batch of blits: a circle with an
+        HP bar along the bottom of its cell
+        """
+        atlas = self.sprite("units")
+        size = self.camera.cell_size
+        left, top = self.camera.x, self.camera.y
+        bodies = ((0, 0, size, size), (size, 0, size, size))
+        full = float(size - 2)
+        blits = []
+        for unit in units:
+            x = (unit.location.x - left) * size
+            y = (unit.location.y - top) * size
+            blits.append((atlas, (x, y), bodies[not unit.alive]))
+            width = int(full * max(unit.current_hp, 0) / unit.max_hp)
+            if width > 0:
+                blits.append((atlas, (x + 1, y + size - 4),
+                              (2 * size, 0, width, 3)))
+        (surface or self.screen).blits(blits, False)
+
+    def draw_unit(self, unit, surface=None):
+        self.draw_units([unit], surface)
+
+    def units_in_view(self):
+        """
+        Returns the units in view, fallen ones first so that the living
+        are drawn over them
+        """
+        view = self.camera.view()
+        return self.corpses.in_rect(*view) + self.battle.units_in(*view)
+
+    def place_units(self, surface=None):
+        self.draw_units([unit for unit in self.units_in_view()
+                         if self.shows(unit)], surface)
+
+    def visible_cells(self):
+        """
+        Returns which cells in view the fog_team sees, as a bool array
+        shaped like the view, or None when fog is off
+        """
+        if self.fog_team is None:
+            return None
+        return self.battle.visible_mask(self.fog_team,
+                                        window=self.camera.view())
+
+    def shows(self, unit):
+        """
+        Whether unit is drawn: always without fog, otherwise only for the
+        fog_team's own units and units on visible cells in view
+        """
+        if self.fog is None or unit.team is self.fog_team:
+            return True
+        x = unit.location.x - self.camera.x
+        y = unit.location.y - self.camera.y
+        height, width = self.fog.shape
+        return 0 <= x < width and 0 <= y < height and bool(self.fog[y, x])
+
+    def cell_rects(self, mask):
+        """
+        Returns the rects of the cells that are True in a mask of the
+        cells in view
+        """
+        camera = self.camera
+        return [camera.cell_rect(camera.x + x, camera.y + y)
+                for y, x in np.argwhere(mask).tolist()]
+
+    def draw_fog(self):
+        """
+        Shades the hidden cells in view
+        """
+        if self.fog is not None:
+            fog = self.sprite("fog")
+            self.screen.blits([(fog, rect) for rect in
+                               self.cell_rects(~self.fog)], False)
+
+    def team_color(self, unit):
+        if unit.team in self.battle.teams:
+            index = self.battle.teams.index(unit.team)
+            return self.TEAM_COLORS[index % len(self.TEAM_COLORS)]
+        return self.GREY
+
+    def label(self, text):
+        """
+        Returns text rendered in the small font, caching it
+        """
+        label = self.labels.get(text)
+        if label is None:
+            label = self.labels[text] = self.small_font.render(
+                text, True, self.WHITE)
+        return label
+
+    def forecast(self):
+        """
+        Returns the units the timeline shows, only asking the Battle for a
+        new forecast when its scheduler has changed
+        """
+        if not self.timeline:
+            return []
+        scheduler = self.battle.scheduler
+        scheduler.sync()
+        state = (scheduler, scheduler.changes, self.battle.active_unit)
+        if state != self.forecast_state:
+            self.forecast_state = state
+            self.forecasted = self.battle.forecast(self.timeline)
+        return self.forecasted
+
+    def draw_timeline(self):
+        """
+        Draws self.turns, the units due to act next, as a row of team
+        colored markers along the bottom, the active unit outlined
+        """
+        bar = self.timeline_rect
+        self.screen.fill(self.DK_GREY, bar)
+        slot = bar.width // self.timeline
+        radius = max(min(slot, bar.height) // 2 - 3, 1)
+        for i, unit in enumerate(self.turns):
+            center = (bar.left + i * slot + bar.height // 2, bar.centery)
+            pygame.draw.circle(self.screen, self.team_color(unit), center,
+                               radius)
+            if i == 0 and unit is self.battle.active_unit:
+                pygame.draw.circle(self.screen, self.WHITE, center, radius, 1)
+            label = self.label(unit.name)
+            self.screen.blit(label, label.get_rect(
+                midleft=(center[0] + radius + 4, bar.centery)))
 
     def draw(self):
-        self.fill_grid()
-        self.draw_grid()
-        self.place_units()
+        """
+        Redraws the whole window. Returns the rects that changed.
+        """
+        if self.background is None or self.rendered != self.camera.state():
+            self.render_background()
+        self.screen.blit(self.background, (0, 0))
+        self.fog = self.visible_cells()
+        self.draw_fog()
+        units = self.units_in_view()
+        self.draw_units([unit for unit in units if self.shows(unit)])
+        self.drawn = dict((unit, (self.cell_rect(unit.location), self.unit_state(unit)))
+                          for unit in units)
+        if self.timeline:
+            self.turns = self.forecast()
+            self.draw_timeline()
+        return [self.screen.get_rect()]
 
-    def run(self):
-        while True:
-            self.draw()
+    def draw_dirty(self):
+        """
+        Redraws only the cells in view whose units have moved, changed HP,
+        joined or left since the last frame, and the timeline if the
+        turn order has changed. Returns the rects that changed.
+        """
+        if self.background is None or self.rendered != self.camera.state():
+            return self.draw()
+        dirty = []
+        current = {}
+        units = self.units_in_view()
+        for unit in units:
+            state = self.unit_state(unit)
+            old = self.drawn.get(unit)
+            rect = self.cell_rect(unit.location)
+            current[unit] = (rect, state)
+            if old is None:
+                dirty.append(rect)
+            elif old[1] != state:
+                if old[0] != rect:
+                    dirty.append(old[0])
+                dirty.append(rect)
+        for unit, (rect, state) in self.drawn.iteritems():
+            if unit not in current:
+                dirty.append(rect)
+        self.drawn = current
+        fog = self.visible_cells()
+        if fog is not None and self.fog is not None:
+            dirty.extend(self.cell_rects(fog != self.fog))
+        elif fog is not None or self.fog is not None:
+            dirty.extend(self.cell_rects(
+                ~(fog if fog is not None else self.fog)))
+        self.fog = fog
+        turns = self.forecast()
+        retimed = turns != self.turns
+        if not dirty and not retimed:
+            return dirty
+        camera = self.camera
+        self.screen.blits([(self.background, rect, rect) for rect in dirty],
+                          False)
+        if fog is not None:
+            shade = self.sprite("fog")
+            size = camera.cell_size
+            self.screen.blits(
+                [(shade, rect) for rect in dirty
+                 if not fog[rect.y // size, rect.x // size]], False)
+        self.draw_units([unit for unit in units
+                         if current[unit][0].collidelist(dirty) != -1 and
+                         self.shows(unit)])
+        if self.timeline and (retimed or
+                              self.timeline_rect.collidelist(dirty) != -1):
+            self.turns = turns
+            self.draw_timeline()
+            dirty.append(self.timeline_rect)
+        return dirty
+
+    def show(self, battle):
+        """
+        Switches to displaying another Battle on the same grid size and
+        redraws. Returns the rects that changed. Fog follows the Team at
+        the same index in the new Battle.
+        """
+        if self.fog_team is not None:
+            self.fog_team = battle.teams[self.battle.teams.index(self.fog_team)]
+        self.watch(battle)
+        self.background = None
+        self.drawn = {}
+        return self.draw()
+
+    def show_frame(self, frame):
+        """
+        Switches to the Battle in a Frame from a Simulation. Frames after
+        the first are applied to the Battle on screen and only what changed
+        is redrawn, unless the grid or teams differ, when the frame is
+        restored and shown in full. Returns the rects that changed.
+        """
+        snapshot = BattleSnapshot(frame.snapshot)
+        last = self.last_frame
+        self.last_frame = snapshot
+        if last is not None and self.battle is self.frame_battle:
+            cells = snapshot.apply(self.battle, last)
+            if cells is not None:
+                if cells:
+                    self.background = None
+                return self.draw_dirty()
+        self.frame_battle = snapshot.restore()
+        return self.show(self.frame_battle)
+
+    def scrub(self, key):
+        """
+        Moves the replay player in response to key. Returns the rects that
+        changed, or None if key does not scrub.
+        """
+        if self.player is None:
+            return None
+        if key in self.SCRUB_KEYS:
+            self.player.step(self.SCRUB_KEYS[key])
+        elif key == pygame.K_HOME:
+            self.player.seek(0)
+        elif key == pygame.K_END:
+            self.player.seek(self.player.replay.turns)
+        else:
+            return None
+        if self.player.battle is not self.battle:
+            return self.show(self.player.battle)
+        return self.draw_dirty()
+
+    def steer(self, key):
+        """
+        Pans the camera a quarter of the view, or zooms it, in response to
+        key. Returns the rects that changed, or None if key does not move
+        the camera.
+        """
+        if key in self.PAN_KEYS:
+            dx, dy = self.PAN_KEYS[key]
+            across, down = self.camera.span()
+            self.camera.pan(dx * max(1, across // 4), dy * max(1, down // 4))
+        elif key in self.ZOOM_KEYS:
+            self.camera.zoom(self.ZOOM_KEYS[key])
+        else:
+            return None
+        return self.draw_dirty()
+
+    def frame_stats(self):
+        """
+        Returns statistics, in milliseconds, for the time spent drawing
+        recent frames
+        """
+        times = sorted(self.frame_times)
+        if not times:
+            return {"frames": 0}
+        count = len(times)
+        return {
+            "frames": count,
+            "mean_ms": 1000 * sum(times) / count,
+            "median_ms": 1000 * times[count // 2],
+            "p95_ms": 1000 * times[min(count - 1, int(count * 0.95))],
+            "max_ms": 1000 * times[-1],
+            "fps": self.clock.get_fps(),
+        }
+
+    def run(self, max_frames=None, frames=None):
+        """
+        Display loop, capped at FPS frames per second.
+
+        frames: A FrameQueue, e.g. a Simulation's, whose newest Frame is
+        shown on each pass. Frames that arrive faster than they can be
+        drawn are skipped.
+        """
+        pygame.display.update(self.draw())
+        drawn = 0
+        while max_frames is None or drawn < max_frames:
+            start = timeit.default_timer()
+            dirty = []
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     pygame.quit()
                     sys.exit()
-            pygame.display.update()
+                if event.type == pygame.KEYDOWN:
+                    dirty.extend(self.scrub(event.key) or
+                                 self.steer(event.key) or [])
+                if (event.type == pygame.MOUSEBUTTONDOWN and
+                        event.button in (self.WHEEL_UP, self.WHEEL_DOWN)):
+                    factor = 2 if event.button == self.WHEEL_UP else 0.5
+                    self.camera.zoom(factor, event.pos)
+            frame = frames.latest() if frames is not None else None
+            if frame is not None:
+                dirty.extend(self.show_frame(frame))
+            dirty.extend(self.draw_dirty())
+            if dirty:
+                pygame.display.update(dirty)
+            self.frame_times.append(timeit.default_timer() - start)
+            self.clock.tick(self.FPS)
+            drawn += 1
+
+
+def demo_spec():
+    """
+    The two-unit skirmish that the demo opens with
+    """
+    return BattleSpec(10, 10, [
+        {"name": "A", "speed": 3, "team": 0, "x": 0, "y": 0},
+        {"name": "B", "speed": 8, "team": 1, "x": 9, "y": 9},
+    ], [aggressive_policy, aggressive_policy], grid_class=Grid)
 
 
 if __name__ == '__main__':
 
     def main():
-        g = Grid(10, 10)
-        b = Battle(g)
+        parser = argparse.ArgumentParser(description="Tactics demo")
+        parser.add_argument("--headless", type=int, metavar="N",
+                            help="simulate N battles without a window and "
+                                 "print the aggregated results")
+        parser.add_argument("--processes", type=int, default=None,
+                            help="worker processes for --headless")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--replay-dir", metavar="DIR",
+                            help="record every --headless battle to DIR")
+        parser.add_argument("--replay", metavar="PATH",
+                            help="open a recorded battle in the viewer")
+        parser.add_argument("--delay", type=float, default=0.5,
+                            help="seconds between turns of the demo battle")
+        parser.add_argument("--profile", metavar="PATH",
+                            help="profile --headless battles in this "
+                                 "process, print a summary and write a "
+                                 "Chrome trace to PATH")
+        args = parser.parse_args()
 
-        start_positions = [(0, 0),
-                           (9, 9)]
-        names = ["A",
-                 "B"]
+        if args.headless and args.profile:
+            with Profiler() as profiler:
+                result = run_batch(demo_spec(), args.headless, 1, args.seed,
+                                   args.replay_dir)
+            print result
+            print profiler.summary()
+            profiler.write_trace(args.profile)
+            return
 
-        speeds = [3, 8]
+        if args.headless:
+            print run_batch(demo_spec(), args.headless, args.processes,
+                            args.seed, args.replay_dir)
+            return
 
-        for info in zip(names, speeds, start_positions):
-            name, speed, start = info
-            x = start[0]
-            y = start[1]
-            new_unit = Unit()
-            new_unit.name = name
-            new_unit.speed = speed
-            new_unit.join_battle(b, x, y)
+        if args.replay:
+            player = ReplayPlayer(Replay.open(args.replay))
+            Visualizer(None, player).run()
+            return
 
-        v = Visualizer(b)
-        v.run()
+        simulation = Simulation(demo_spec(), args.seed, args.delay).start()
+        frames = simulation.frames
+        v = Visualizer(BattleSnapshot(frames.wait(10).snapshot).restore())
+        v.run(frames=frames)
 
-    main()
\ No newline at end of file
+    main()
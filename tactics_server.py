@@ -0,0 +1,599 @@
+"""
+A line-based TCP server hosting many concurrent tactics Battles.
+
+Run from the repository root:
+
+    python tactics_server.py [--port 7777] [--workers 4] [--timeout 30]
+
+One asyncore loop handles every connection. Game logic never runs on it:
+each Battle is stepped on a pool of worker threads, one job at a time per
+game, through the resumable Battle.turn_steps(), so a game waiting on a
+player holds no thread at all.
+
+Protocol (one command per line, in both directions):
+
+    client                       server
+    PLAY [seats]                 GAME <id> <team>   start a game; seats is
+                                                    how many teams are
+                                                    played by clients
+    JOIN <id>                    GAME <id> <team>   take a free seat
+                                 START <id>         all seats are taken
+                                 TURN <name> <x> <y> <hp>
+                                 ACTIONS <action>,...
+    Move | Action | End Turn
+                                 MENU <count> <title>
+                                 OPTION <index> <item>
+    <index>
+                                 INVALID            the command was not
+                                                    usable; asked again
+                                 TIMEOUT            the turn ran out of
+                                                    time and was ended
+                                 OVER <team>|draw
+    QUIT
+                                 WAIT               not your turn
+                                 ERROR <message>
+
+Teams without a client, including those whose client disconnects, are
+played by the BattleSpec's policies.
+"""
+import argparse
+import asynchat
+import asyncore
+import collections
+import heapq
+import os
+import random
+import socket
+import sys
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+import tactics as t
+
+
+MAX_LINE = 1024
+
+
+def describe(item):
+    """
+    Protocol text for a menu option
+    """
+    if isinstance(item, t.Node):
+        return "%d %d" % (item.x, item.y)
+    if isinstance(item, t.Unit):
+        return "%s %d %d %d" % (item.name, item.location.x, item.location.y,
+                                item.current_hp)
+    return str(item)
+
+
+class Game(object):
+    """
+    One hosted Battle.
+
+    seats maps the team indices played by clients to the Client in each
+    seat, None while it is free or after its client left. Methods that
+    change the Game, seating included, run on the server's worker threads
+    one at a time and return the lines to send as a list of (client, line)
+    pairs. Clients that asked for a seat and found none are listed in
+    refused for the server to release.
+    """
+
+    def __init__(self, game_id, spec, seats, turn_timeout=None, seed=0):
+        self.id = game_id
+        self.spec = spec
+        self.battle = spec.build()
+        self.policies = dict(zip(self.battle.teams, spec.policies))
+        self.rng = random.Random(seed)
+        self.seats = dict((team, None) for team in xrange(seats))
+        self.turn_timeout = turn_timeout
+        self.started = False
+        self.refused = []
+        self.turns = 0
+        self.steps = None
+        self.prompt = None
+        self.player = None
+        self.deadline = None
+        self.armed = None
+        self.over = False
+        self.busy = False
+        self.jobs = collections.deque()
+
+    def open_seat(self):
+        """
+        Returns the lowest free team index, or None
+        """
+        free = [team for team, client in self.seats.iteritems()
+                if client is None]
+        return min(free) if free else None
+
+    def clients(self):
+        return [client for client in self.seats.itervalues() if client]
+
+    def seat(self, client):
+        """
+        Puts client in the lowest free seat, starting the game once every
+        seat is taken
+        """
+        team = self.open_seat()
+        if team is None:
+            self.refused.append(client)
+            return [(client, "ERROR no free seat in game %d" % self.id)]
+        self.seats[team] = client
+        lines = [(client, "GAME %d %d" % (self.id, team))]
+        if self.started:
+            return lines + self.resume(client)
+        if self.open_seat() is None:
+            return lines + self.start()
+        return lines
+
+    def start(self):
+        self.started = True
+        return ([(client, "START %d" % self.id) for client in self.clients()] +
+                self.advance())
+
+    def resume(self, client):
+        """
+        Lets client, seated after the game started, pick it up where it is.
+        Only client is told; the turn in progress carries on as it was.
+        """
+        lines = [(client, "START %d" % self.id)]
+        unit = self.battle.active_unit
+        if (self.steps is not None and self.player is None and
+                self.seats.get(self.battle.teams.index(unit.team)) is client):
+            self.player = client
+            lines.append((client, "TURN %s %d %d %d" % (
+                unit.name, unit.location.x, unit.location.y,
+                unit.current_hp)))
+            lines.extend(self.ask(self.prompt))
+        return lines
+
+    def advance(self):
+        """
+        Plays policy turns until a seated client's unit is up, then asks
+        for its first command. Ends the game when a team is defeated or
+        the spec's turn limit is reached.
+        """
+        battle = self.battle
+        while True:
+            if self.turns >= self.spec.max_turns or battle.defeat_check():
+                return self.finish()
+            battle.advance()
+            unit = battle.active_unit
+            self.turns += 1
+            client = self.seats.get(battle.teams.index(unit.team))
+            if client is None or not unit.alive:
+                battle.policy_turn(self.policies, self.rng)
+                continue
+            self.player = client
+            self.steps = battle.turn_steps()
+            if self.turn_timeout:
+                self.deadline = time.time() + self.turn_timeout
+            line = "TURN %s %d %d %d" % (unit.name, unit.location.x,
+                                         unit.location.y, unit.current_hp)
+            return [(client, line)] + self.ask(next(self.steps))
+
+    def ask(self, prompt):
+        """
+        Returns the lines that ask the player for a reply to prompt
+        """
+        self.prompt = prompt
+        player = self.player
+        if prompt is None:
+            actions = self.battle.active_unit.possible_actions()
+            return [(player, "ACTIONS " + ",".join(actions))]
+        lines = [(player, "MENU %d %s" % (len(prompt.options), prompt.title))]
+        lines.extend((player, "OPTION %d %s" % (index, describe(item)))
+                     for index, item in enumerate(prompt.options))
+        return lines
+
+    def reply(self, command):
+        """
+        Sends command to the current turn and returns what follows. None
+        ends the turn.
+        """
+        prompt = self.prompt
+        try:
+            next_prompt = self.steps.send(command)
+        except StopIteration:
+            self.steps = None
+            self.prompt = None
+            self.player = None
+            self.deadline = None
+            return self.advance()
+        lines = []
+        if next_prompt is prompt:
+            lines.append((self.player, "INVALID"))
+        return lines + self.ask(next_prompt)
+
+    def command(self, client, line):
+        if self.steps is None or client is not self.player:
+            return [(client, "WAIT")]
+        return self.reply(line)
+
+    def time_out(self, turn):
+        """
+        Ends turn number turn if it is still waiting for its player
+        """
+        if self.steps is None or turn != self.turns:
+            return []
+        return [(self.player, "TIMEOUT")] + self.reply(None)
+
+    def leave(self, client):
+        """
+        Frees client's seat; its team is played by its policy from now
+        on. A game nobody is left in ends.
+        """
+        for team, seated in self.seats.items():
+            if seated is client:
+                self.seats[team] = None
+        if not self.clients():
+            self.over = True
+            return []
+        if self.player is client:
+            self.player = None
+            return self.reply(None)
+        return []
+
+    def finish(self):
+        self.over = True
+        self.steps = None
+        self.deadline = None
+        standing = [index for index, team in enumerate(self.battle.teams)
+                    if not team.is_defeated()]
+        winner = str(standing[0]) if len(standing) == 1 else "draw"
+        return [(client, "OVER " + winner) for client in self.clients()]
+
+
+def run_job(method, args):
+    try:
+        return method(*args)
+    except Exception:
+        traceback.print_exc()
+        return []
+
+
+class Waker(asyncore.file_dispatcher):
+    """
+    Lets worker threads hand calls back to the asyncore loop: call()
+    queues a function and writes a byte to a pipe the loop is watching.
+    """
+
+    def __init__(self, socket_map):
+        read_fd, self.write_fd = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_fd, socket_map)
+        os.close(read_fd)
+        self.calls = collections.deque()
+
+    def writable(self):
+        return False
+
+    def call(self, func, *args):
+        self.calls.append((func, args))
+        os.write(self.write_fd, "x")
+
+    def handle_read(self):
+        self.recv(4096)
+        while self.calls:
+            func, args = self.calls.popleft()
+            func(*args)
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_fd)
+
+
+class Client(asynchat.async_chat):
+    """
+    One connection to the Server
+    """
+
+    def __init__(self, server, sock):
+        asynchat.async_chat.__init__(self, sock, server.socket_map)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.server = server
+        self.buffer = []
+        self.size = 0
+        self.game = None
+        self.set_terminator("\n")
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size > MAX_LINE:
+            self.send_line("ERROR line too long")
+            self.close_when_done()
+
+    def found_terminator(self):
+        line = "".join(self.buffer).strip()
+        self.buffer = []
+        self.size = 0
+        if line:
+            self.server.handle_line(self, line)
+
+    def send_line(self, line):
+        self.push(line + "\n")
+
+    def handle_close(self):
+        self.server.client_left(self)
+        self.close()
+
+
+class Server(asyncore.dispatcher):
+    """
+    Accepts clients and hosts a Game built from spec for each PLAY.
+
+    turn_timeout: Seconds a client has to finish each of its turns before
+    it is ended for it. None waits forever.
+    workers: Threads that step the Battles.
+    """
+
+    def __init__(self, spec, host="127.0.0.1", port=0, workers=4,
+                 turn_timeout=30.0, seed=0):
+        self.socket_map = {}
+        asyncore.dispatcher.__init__(self, map=self.socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(128)
+        self.address = self.socket.getsockname()
+        self.spec = spec
+        self.turn_timeout = turn_timeout
+        self.seed = seed
+        self.pool = ThreadPool(workers)
+        self.waker = Waker(self.socket_map)
+        self.games = {}
+        self.next_id = 1
+        self.timers = []
+        self.running = False
+        self.finished = 0
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            Client(self, pair[0])
+
+    def handle_line(self, client, line):
+        words = line.split()
+        if client.game is not None:
+            if words == ["QUIT"]:
+                self.client_left(client)
+                client.close_when_done()
+            else:
+                self.submit(client.game, client.game.command, client, line)
+        elif words[0] == "PLAY" and len(words) <= 2:
+            self.play(client, words[1:])
+        elif words[0] == "JOIN" and len(words) == 2:
+            self.join(client, words[1])
+        elif words == ["QUIT"]:
+            client.close_when_done()
+        else:
+            client.send_line("ERROR expected PLAY [seats] or JOIN <id>")
+
+    def play(self, client, args):
+        try:
+            seats = int(args[0]) if args else 1
+        except ValueError:
+            seats = 0
+        if not 1 <= seats <= len(self.spec.policies):
+            client.send_line("ERROR seats must be 1 to %d" %
+                             len(self.spec.policies))
+            return
+        game = Game(self.next_id, self.spec, seats, self.turn_timeout,
+                    self.seed + self.next_id)
+        self.next_id += 1
+        self.games[game.id] = game
+        self.seat(client, game)
+
+    def join(self, client, game_id):
+        try:
+            game = self.games.get(int(game_id))
+        except ValueError:
+            game = None
+        if game is None:
+            client.send_line("ERROR no free seat in game %s" % game_id)
+            return
+        self.seat(client, game)
+
+    def seat(self, client, game):
+        """
+        Queues client's seating behind the game's other jobs. Its lines go
+        to the game from now on, and are turned away with WAIT until it
+        has a seat.
+        """
+        client.game = game
+        self.submit(game, game.seat, client)
+
+    def client_left(self, client):
+        game = client.game
+        if game is not None:
+            client.game = None
+            self.submit(game, game.leave, client)
+
+    def submit(self, game, method, *args):
+        """
+        Queues a Game method to run on a worker thread after the game's
+        earlier jobs
+        """
+        game.jobs.append((method, args))
+        if not game.busy:
+            self.next_job(game)
+
+    def next_job(self, game):
+        if not game.jobs:
+            return
+        method, args = game.jobs.popleft()
+        game.busy = True
+
+        def done(lines):
+            self.waker.call(self.job_done, game, lines)
+        self.pool.apply_async(run_job, (method, args), callback=done)
+
+    def job_done(self, game, lines):
+        game.busy = False
+        batches = collections.OrderedDict()
+        for client, line in lines:
+            if client is not None and client.connected:
+                batches.setdefault(client, []).append(line + "\n")
+        for client, batch in batches.iteritems():
+            client.push("".join(batch))
+        for client in game.refused:
+            if client.game is game:
+                client.game = None
+        game.refused = []
+        if game.over:
+            if self.games.pop(game.id, None) is not None:
+                self.finished += 1
+            for client in game.clients():
+                client.game = None
+            for method, args in game.jobs:
+                if method == game.seat and args[0].game is game:
+                    args[0].game = None
+                    args[0].send_line("ERROR no free seat in game %d" %
+                                      game.id)
+            return
+        if game.deadline is not None and game.deadline != game.armed:
+            game.armed = game.deadline
+            heapq.heappush(self.timers, (game.deadline, game.id, game.turns))
+        self.next_job(game)
+
+    def check_timers(self):
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, game_id, turn = heapq.heappop(self.timers)
+            game = self.games.get(game_id)
+            if game is not None and game.turns == turn:
+                self.submit(game, game.time_out, turn)
+
+    def poll(self, timeout=0.1):
+        """
+        Handles whatever is ready within timeout seconds
+        """
+        if self.timers:
+            timeout = max(0, min(timeout, self.timers[0][0] - time.time()))
+        asyncore.loop(timeout, map=self.socket_map, count=1)
+        self.check_timers()
+
+    def serve(self):
+        """
+        Runs the loop until stop() is called
+        """
+        self.running = True
+        while self.running:
+            self.poll()
+
+    def stop(self):
+        """
+        Makes serve() return. Safe to call from any thread.
+        """
+        def halt():
+            self.running = False
+        self.waker.call(halt)
+
+    def close(self):
+        for dispatcher in self.socket_map.values():
+            if dispatcher is not self:
+                dispatcher.close()
+        asyncore.dispatcher.close(self)
+        self.pool.terminate()
+        self.pool.join()
+
+
+class Bot(asynchat.async_chat):
+    """
+    A scripted client for tests and load testing that plays games back
+    to back. On its turns it attacks the first target when it can, moves
+    to the first destination offered, and then ends the turn.
+
+    Results: winners holds each game's OVER result, and latencies the
+    seconds between sending each command and the server's reply.
+    """
+
+    def __init__(self, address, games=1, socket_map=None, command="PLAY"):
+        asynchat.async_chat.__init__(self, map=socket_map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.games = games
+        self.command = command
+        self.buffer = []
+        self.winners = []
+        self.latencies = []
+        self.game = None
+        self.sent = None
+        self.tried = set()
+        self.last = None
+        self.set_terminator("\n")
+        self.connect(address)
+
+    def handle_connect(self):
+        self.send_line(self.command)
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def send_line(self, line):
+        self.sent = time.time()
+        self.push(line + "\n")
+
+    def found_terminator(self):
+        line = "".join(self.buffer)
+        self.buffer = []
+        word, _, rest = line.partition(" ")
+        if self.sent is not None and word != "OPTION":
+            self.latencies.append(time.time() - self.sent)
+            self.sent = None
+        if word == "GAME":
+            self.game = int(rest.split()[0])
+        elif word == "TURN":
+            self.tried = set()
+        elif word == "ACTIONS":
+            self.act(rest.split(","))
+        elif word == "INVALID":
+            self.tried.add(self.last)
+        elif word == "MENU":
+            self.send_line("0")
+        elif word == "OVER":
+            self.winners.append(rest)
+            self.game = None
+            if len(self.winners) < self.games:
+                self.send_line("PLAY")
+            else:
+                self.close()
+        elif word == "ERROR":
+            self.close()
+
+    def act(self, actions):
+        for action in ("Action", "Move"):
+            if action in actions and action not in self.tried:
+                self.last = action
+                self.send_line(action)
+                return
+        self.last = "End Turn"
+        self.send_line("End Turn")
+
+    def handle_close(self):
+        self.close()
+
+
+if __name__ == '__main__':
+
+    def main():
+        parser = argparse.ArgumentParser(description="Tactics server")
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=7777)
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--timeout", type=float, default=30.0,
+                            help="seconds allowed per turn")
+        parser.add_argument("--seed", type=int, default=0)
+        args = parser.parse_args()
+        server = Server(t.demo_spec(), args.host, args.port, args.workers,
+                        args.timeout, args.seed)
+        print "Serving on %s:%d" % server.address
+        sys.stdout.flush()
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+        server.close()
+
+    main()
@@ -4,6 +4,8 @@ Created on Aug 11, 2014
 @author: rwill127
 """
 from nose.tools import *
+import numpy as np
+import random
 import tactics as t
 
 
@@ -41,6 +43,298 @@ class TestGrid(object):
         n3 = self.m.get_node(9, 9)
         eq_(len(self.m.neighbors(n3, 1)), 3)
 
+    def test_neighbors_non_square(self):
+        m = t.Grid(3, 6)
+        eq_(len(m.neighbors(m.get_node(1, 4), 1)), 8)
+        eq_(len(m.neighbors(m.get_node(2, 5), 1)), 3)
+        corner = m.neighbors(m.get_node(0, 0), 5)
+        eq_(len(corner), 3 * 6 - 1)
+        ok_(m.get_node(2, 5) in corner)
+
+    def test_neighbor_metrics(self):
+        n = self.m.get_node(5, 5)
+        eq_(len(self.m.neighbors(n, 2, t.CHEBYSHEV)), 24)
+        eq_(len(self.m.neighbors(n, 2, t.MANHATTAN)), 12)
+        eq_(len(self.m.neighbors(n, 2, t.EUCLIDEAN)), 12)
+        assert_raises(ValueError, self.m.neighbors, n, 2, "taxicab")
+
+    def test_packed_neighbors(self):
+        coords = self.m.neighbors(self.m.get_node(0, 0), 1, packed=True)
+        eq_(sorted(map(tuple, coords.tolist())), [(0, 1), (1, 0), (1, 1)])
+
+
+class TestArrayGrid(object):
+    def setup(self):
+        self.m = t.ArrayGrid(10, 10)
+
+    def test_get_node(self):
+        n = self.m.get_node(3, 7)
+        ok_(isinstance(n, t.Node))
+        eq_((n.x, n.y), (3, 7))
+        eq_(n, self.m.get_node(3, 7))
+        assert_raises(IndexError, self.m.get_node, 10, 0)
+
+    def test_copy(self):
+        import copy
+        self.m.set_terrain(1, 2, t.WALL)
+        for c in (self.m.copy(), copy.deepcopy(self.m.get_node(1, 2)).grid):
+            eq_(c.terrain_at(1, 2), t.WALL)
+            c.set_terrain(1, 2, t.PLAIN)
+            eq_(self.m.terrain_at(1, 2), t.WALL)
+
+    def test_views_write_through(self):
+        n = self.m.get_node(2, 4)
+        n.terrain = 3
+        n.height = -2
+        n.occupied = True
+        eq_(self.m.terrain[4 * 10 + 2], 3)
+        eq_(self.m.get_node(2, 4).height, -2)
+        ok_(self.m.is_occupied(2, 4))
+
+    def test_neighbors(self):
+        eq_(len(self.m.neighbors(self.m.get_node(5, 5), 1)), 8)
+        eq_(len(self.m.neighbors(self.m.get_node(0, 3), 1)), 5)
+        eq_(len(self.m.neighbors(self.m.get_node(9, 9), 1)), 3)
+
+    def test_occupancy_follows_units(self):
+        b = t.Battle(self.m)
+        u = t.Unit()
+        u.join_battle(b, 1, 1)
+        ok_(self.m.is_occupied(1, 1))
+        u.move(self.m.get_node(2, 2))
+        ok_(not self.m.is_occupied(1, 1))
+        ok_(self.m.is_occupied(2, 2))
+
+
+class TestChunkedGrid(object):
+    def setup(self):
+        self.m = t.ChunkedGrid(20, 18, tile_size=4, max_tiles=10)
+
+    def test_lazy_tiles(self):
+        n = self.m.get_node(13, 17)
+        eq_((n.x, n.y), (13, 17))
+        eq_(len(self.m.tiles), 0)
+        eq_(n.terrain, t.PLAIN)
+        eq_(self.m.tiles.keys(), [(3, 4)])
+        assert_raises(IndexError, self.m.get_node, 20, 0)
+        assert_raises(IndexError, self.m.terrain_at, 0, 18)
+
+    def test_edits_spilled(self):
+        for i in range(12):
+            self.m.set_terrain(i * 4 % 20, i * 4 // 20 * 4, t.WALL)
+        ok_(len(self.m.tiles) <= 10)
+        ok_(self.m.spilled)
+        for i in range(12):
+            eq_(self.m.terrain_at(i * 4 % 20, i * 4 // 20 * 4), t.WALL)
+        eq_(self.m.cell_arrays()[0].sum(), 12 * t.WALL)
+        assert_raises(ValueError, t.ChunkedGrid, 20, 18, writable=True)
+
+    def test_matches_array_grid(self):
+        a = t.ArrayGrid(20, 18)
+        for y in range(0, 16):
+            for grid in (a, self.m):
+                grid.set_terrain(9, y, t.WALL)
+                grid.set_terrain(3, y, t.ROUGH)
+                grid.set_height(y, 2, y)
+        for grid in (a, self.m):
+            eq_(len(grid.neighbors(grid.get_node(19, 17), 2)), 8)
+        eq_(self.m.reachable(self.m.get_node(1, 1), 12).costs,
+            a.reachable(a.get_node(1, 1), 12).costs)
+        path = self.m.find_path(self.m.get_node(0, 0), self.m.get_node(15, 0))
+        eq_([(n.x, n.y) for n in path],
+            [(n.x, n.y) for n in a.find_path(a.get_node(0, 0),
+                                             a.get_node(15, 0))])
+        eq_(self.m.field_of_view(5, 5).visible, a.field_of_view(5, 5).visible)
+        for mine, theirs in zip(self.m.cell_arrays(), a.cell_arrays()):
+            ok_(np.array_equal(mine, theirs))
+
+    def test_lru_eviction(self):
+        for x in range(0, 20, 4):
+            for y in range(0, 18, 4):
+                self.m.terrain_at(x, y)
+        ok_(len(self.m.tiles) <= 10)
+        eq_(self.m.loads, 25)
+        ok_(self.m.evictions >= 15)
+        ok_((4, 4) in self.m.tiles)
+        ok_((0, 0) not in self.m.tiles)
+        eq_(self.m.memory_usage(), len(self.m.tiles) * 4 * 16)
+
+    def test_pinned_tiles(self):
+        b = t.Battle(self.m)
+        u = t.Unit()
+        u.join_battle(b, 1, 1)
+        self.m.set_terrain(5, 1, t.WATER)
+        for x in range(0, 20, 4):
+            for y in range(0, 18, 4):
+                self.m.height_at(x, y)
+        ok_((0, 0) in self.m.tiles)
+        eq_(self.m.terrain_at(5, 1), t.WATER)
+        u.move(self.m.get_node(9, 9))
+        ok_(not self.m.is_occupied(1, 1))
+        eq_(self.m.tiles[(2, 2)].occupied, 1)
+        eq_(self.m.tiles[(0, 0)].occupied, 0)
+
+    def test_map_file(self):
+        import os
+        import tempfile
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            self.m.set_terrain(17, 16, t.WALL)
+            self.m.set_height(2, 3, -4)
+            self.m.save(path)
+            grid = t.ChunkedGrid.open(path, max_tiles=2, writable=True)
+            eq_((grid.width, grid.height, grid.tile_size), (20, 18, 4))
+            eq_(grid.terrain_at(17, 16), t.WALL)
+            eq_(grid.height_at(2, 3), -4)
+            eq_(grid.terrain_at(0, 0), t.PLAIN)
+            grid.set_terrain(10, 10, t.ROUGH)
+            for x in range(0, 20, 4):
+                grid.terrain_at(x, 0)
+            ok_((2, 2) not in grid.tiles)
+            eq_(grid.terrain_at(10, 10), t.ROUGH)
+            grid.set_height(11, 11, 7)
+            copy = grid.copy()
+            grid.set_terrain(1, 17, t.WALL)
+            grid.flush()
+            del grid
+            eq_(copy.height_at(11, 11), 7)
+            eq_(copy.terrain_at(1, 17), t.PLAIN)
+            for x in range(0, 20, 4):
+                copy.set_terrain(x, 16, t.WATER)
+            ok_(len(copy.tiles) <= 2)
+            eq_(copy.terrain_at(10, 10), t.ROUGH)
+            eq_(copy.terrain_at(4, 16), t.WATER)
+            grid = t.ChunkedGrid.open(path)
+            eq_(grid.height_at(11, 11), 7)
+            eq_(grid.terrain_at(10, 10), t.ROUGH)
+            del grid
+            with open(path, "r+b") as data:
+                data.write("XXXX")
+            assert_raises(ValueError, t.ChunkedGrid.open, path)
+        finally:
+            os.remove(path)
+
+    def test_snapshot(self):
+        b = t.Battle(t.ChunkedGrid(200, 200, tile_size=32))
+        t.Unit().join_battle(b, 180, 160)
+        b.grid.set_terrain(6, 6, t.WATER)
+        b.grid.terrain_at(100, 100)
+        data = b.snapshot()
+        ok_(len(data) < 2 * 4 * 32 * 32 + 1000)
+        copy = t.BattleSnapshot(data).restore()
+        ok_(type(copy.grid) is t.ChunkedGrid)
+        eq_(copy.grid.tile_size, 32)
+        eq_(copy.grid.terrain_at(6, 6), t.WATER)
+        ok_(copy.grid.is_occupied(180, 160))
+        eq_(sorted(copy.grid.tiles), [(0, 0), (5, 5)])
+
+    def test_snapshot_map_file(self):
+        import os
+        import tempfile
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            self.m.set_terrain(17, 16, t.WALL)
+            self.m.save(path)
+            b = t.Battle(t.ChunkedGrid.open(path, max_tiles=3))
+            b.grid.set_height(2, 3, 5)
+            copy = t.BattleSnapshot(b.snapshot()).restore().grid
+            eq_(copy.map_file.filename, b.grid.map_file.filename)
+            eq_((copy.tile_size, copy.max_tiles), (4, 3))
+            eq_(sorted(copy.tiles), [(0, 0)])
+            eq_(copy.height_at(2, 3), 5)
+            eq_(copy.terrain_at(17, 16), t.WALL)
+            del b, copy
+        finally:
+            os.remove(path)
+
+
+class TestTerrainIn(object):
+    def test_grids_agree(self):
+        grids = [t.Grid(20, 18), t.ArrayGrid(20, 18),
+                 t.ChunkedGrid(20, 18, tile_size=4, max_tiles=10)]
+        rng = random.Random(2)
+        cells = [(rng.randrange(20), rng.randrange(18),
+                  rng.choice([t.WALL, t.ROUGH, t.WATER])) for _ in range(40)]
+        for grid in grids:
+            for x, y, terrain in cells:
+                grid.set_terrain(x, y, terrain)
+        for window in [(0, 0, 20, 18), (3, 5, 11, 14), (17, 2, 20, 3)]:
+            x0, y0, x1, y1 = window
+            expected = np.array([[grids[0].terrain_at(x, y)
+                                  for x in range(x0, x1)]
+                                 for y in range(y0, y1)])
+            for grid in grids:
+                eq_(grid.terrain_in(*window).tolist(), expected.tolist())
+        eq_(grids[0].terrain_in(4, 4, 4, 8).shape, (4, 0))
+
+
+class TestPathfinding(object):
+    def setup(self):
+        self.m = t.Grid(10, 10)
+        for y in range(0, 9):
+            self.m.set_terrain(4, y, t.WALL)
+
+    def test_reachable_costs(self):
+        self.m.set_terrain(1, 0, t.ROUGH)
+        field = self.m.reachable(self.m.get_node(0, 0), 2)
+        eq_(field.costs[(1, 1)], 1)
+        eq_(field.costs[(1, 0)], 2)
+        eq_(field.costs[(2, 2)], 2)
+        ok_((3, 3) not in field.costs)
+
+    def test_walls_block(self):
+        field = self.m.reachable(self.m.get_node(3, 3), 3)
+        ok_(all(x < 4 for x, y in field.costs))
+
+    def test_find_path(self):
+        path = self.m.find_path(self.m.get_node(0, 0), self.m.get_node(8, 0))
+        eq_(path[-1], self.m.get_node(8, 0))
+        ok_(self.m.get_node(4, 9) in path)
+        eq_(len(path), 18)
+        self.m.set_terrain(4, 9, t.WALL)
+        eq_(self.m.find_path(self.m.get_node(0, 0), self.m.get_node(8, 0)), None)
+
+    def test_field_cache(self):
+        start = self.m.get_node(1, 1)
+        field = self.m.reachable(start, 2)
+        ok_(self.m.reachable(start, 2) is field)
+        self.m.set_occupied(8, 8, True)
+        ok_(self.m.reachable(start, 2) is field)
+        self.m.set_occupied(2, 2, True)
+        field2 = self.m.reachable(start, 2)
+        ok_(field2 is not field)
+        ok_((2, 2) not in field2.costs)
+
+    def test_field_cache_bounded(self):
+        cache = self.m.reach_cache
+        cache.size = 20
+        for x in range(10):
+            for y in range(10):
+                self.m.reachable(self.m.get_node(x, y), 1)
+        ok_(len(cache) <= 20)
+        ok_((9, 9, 1) in cache and (0, 0, 1) not in cache)
+        eq_(set(key for keys in cache.buckets.values() for key in keys),
+            set(cache.fields))
+        self.m.set_occupied(9, 8, True)
+        ok_((9, 9, 1) not in cache)
+        ok_((9, 8, 1) not in cache and (9, 0, 1) in cache)
+        ok_(all((9, 9, 1) not in keys for keys in cache.buckets.values()))
+
+    def test_legal_moves_avoid_units(self):
+        b = t.Battle(self.m)
+        u1 = t.Unit()
+        u1.move_speed = 1
+        u1.join_battle(b, 1, 1)
+        u2 = t.Unit()
+        u2.join_battle(b, 2, 2)
+        moves = u1.legal_moves()
+        eq_(len(moves), 7)
+        ok_(self.m.get_node(2, 2) not in moves)
+        u2.move(self.m.get_node(7, 7))
+        eq_(len(u1.legal_moves()), 8)
+
 
 class TestTurn(object):
     def setup(self):
@@ -72,6 +366,28 @@ class TestTurn(object):
         self.b.active_unit.turn(self.dummy_input_end_turn)
         eq_(self.fast.ct, 0)
 
+    def test_turn_steps(self):
+        grid = self.b.grid
+        self.fast.join_battle(self.b, 0, 0)
+        self.slow.join_battle(self.b, 1, 1)
+        steps = self.b.turn_steps()
+        eq_(next(steps), None)
+        eq_(steps.send("Action"), None)
+        menu = steps.send("Move")
+        ok_(grid.get_node(2, 0) in menu.options)
+        eq_(steps.send("99"), menu)
+        eq_(steps.send(str(menu.options.index(grid.get_node(2, 0)))), None)
+        eq_(self.fast.location, grid.get_node(2, 0))
+        ok_(self.fast.moved)
+        assert_raises(StopIteration, steps.send, "End Turn")
+        eq_(self.fast.ct, 0)
+        ok_(not self.b.active_unit)
+        steps = self.b.turn_steps()
+        next(steps)
+        steps.send("Move")
+        assert_raises(StopIteration, steps.send, None)
+        eq_(self.b.units[0].location, grid.get_node(1, 1))
+
     def test_next_turn(self):
         self.b.next_turn(self.dummy_input_end_turn)
         ok_(not self.b.active_unit)
@@ -83,6 +399,157 @@ class TestTurn(object):
         eq_(self.slow.ct, 40)
 
 
+class TestScheduler(object):
+    def legacy_turns(self, speeds, turns):
+        """
+        The original tick-by-tick turn order: (index, cts) per turn
+        """
+        cts = [0] * len(speeds)
+        result = []
+        for _ in range(turns):
+            active = None
+            while active is None:
+                for i, speed in enumerate(speeds):
+                    cts[i] += speed
+                    if cts[i] >= 100:
+                        active = i
+            result.append((active, tuple(cts)))
+            cts[active] = 0
+        return result
+
+    def test_matches_tick_order(self):
+        rng = random.Random(4)
+        speeds = [rng.randint(1, 12) for _ in range(25)]
+        b = t.Battle(t.Grid(10, 10))
+        for speed in speeds:
+            u = t.Unit()
+            u.speed = speed
+            b.units.append(u)
+        turns = []
+        for _ in range(300):
+            b.advance()
+            turns.append((b.units.index(b.active_unit),
+                          tuple(u.ct for u in b.units)))
+            b.active_unit.ct = 0
+            b.active_unit = False
+        eq_(turns, self.legacy_turns(speeds, 300))
+
+    def test_speed_change(self):
+        b = t.Battle(t.Grid(10, 10))
+        u1 = t.Unit()
+        u2 = t.Unit()
+        b.units = [u1, u2]
+        b.tick()
+        u1.speed = 50
+        eq_(u1.ct, 5)
+        b.advance()
+        eq_(b.active_unit, u1)
+        eq_(u1.ct, 105)
+        eq_(u2.ct, 15)
+
+    def test_never_ready(self):
+        b = t.Battle(t.Grid(10, 10))
+        u = t.Unit()
+        u.speed = 0
+        b.units.append(u)
+        assert_raises(ValueError, b.advance)
+
+    def battle(self, speeds):
+        b = t.Battle(t.Grid(10, 10))
+        for speed in speeds:
+            u = t.Unit()
+            u.speed = speed
+            b.units.append(u)
+        return b
+
+    def play(self, b, turns):
+        order = []
+        for _ in range(turns):
+            b.advance()
+            order.append(b.active_unit)
+            b.active_unit.ct = 0
+            b.active_unit = False
+        return order
+
+    def test_forecast(self):
+        rng = random.Random(4)
+        speeds = [rng.randint(1, 12) for _ in range(25)]
+        b = self.battle(speeds)
+        forecast = b.forecast(300)
+        eq_([b.units.index(u) for u in forecast],
+            [i for i, _ in self.legacy_turns(speeds, 300)])
+        eq_(b.scheduler.clock, 0)
+        eq_(self.play(b, 300), forecast)
+
+    def test_forecast_active(self):
+        b = self.battle([3, 5, 7, 7])
+        self.play(b, 5)
+        b.advance()
+        forecast = b.forecast(20)
+        eq_(forecast[0], b.active_unit)
+        b.active_unit.ct = 0
+        b.active_unit = False
+        eq_(self.play(b, 19), forecast[1:])
+
+    def test_forecast_updates(self):
+        b = self.battle([3, 5, 7, 7])
+        self.play(b, 3)
+        before = b.forecast(10)
+        b.units[0].speed = 20
+        forecast = b.forecast(10)
+        ok_(forecast.count(b.units[0]) > before.count(b.units[0]))
+        b.units[1].die()
+        forecast = b.forecast(10)
+        ok_(b.units[1] not in forecast)
+        u = t.Unit()
+        u.speed = 50
+        b.units.append(u)
+        forecast = b.forecast(10)
+        ok_(forecast.count(u) >= 3)
+        clone = b.clone()
+        eq_([clone.units[b.units.index(v)] for v in forecast],
+            self.play(clone, 10))
+        eq_(self.play(b, 10), forecast)
+
+    def test_membership_changes(self):
+        b = self.battle([3, 5, 7, 7])
+        self.play(b, 4)
+        replaced = b.units[1]
+        u = t.Unit()
+        u.speed = 9
+        b.units[1] = u
+        moved = b.units.pop(0)
+        b.units.append(moved)
+        clone = b.clone()
+        order = self.play(b, 20)
+        eq_([clone.units[b.units.index(v)] for v in order],
+            self.play(clone, 20))
+        ok_(replaced not in order and u in order)
+        ok_(not replaced.scheduler)
+
+    def test_unit_list(self):
+        b = self.battle([3, 5, 7])
+        ok_(isinstance(b.units, t.UnitList))
+        units = b.units
+        units.append(t.Unit())
+        units += [t.Unit()]
+        eq_((units.version, units.rewrites), (5, 0))
+        self.play(b, 3)
+        units.sort(key=lambda u: -u.speed)
+        del units[0]
+        eq_((units.version, units.rewrites), (7, 2))
+        clone = b.clone()
+        eq_([clone.units[b.units.index(v)] for v in self.play(b, 10)],
+            self.play(clone, 10))
+
+    def test_dead_units_skipped(self):
+        b = self.battle([5, 5])
+        b.units[1].die()
+        eq_(self.play(b, 3), [b.units[0]] * 3)
+        eq_(b.forecast(3), [b.units[0]] * 3)
+        eq_(self.battle([0]).forecast(3), [])
+
+
 class TestMove(object):
     def setup(self):
         grid = t.Grid(10, 10)
@@ -104,6 +571,55 @@ class TestMove(object):
         ok_("End Turn" in m)
 
 
+class TestOccupancy(object):
+    def setup(self):
+        self.b = t.Battle(t.Grid(40, 40))
+        self.red = t.Team()
+        self.blue = t.Team()
+        self.units = {}
+        for x, y, team in [(1, 1, self.red), (2, 2, self.blue), (5, 1, self.blue),
+                           (20, 20, self.red), (35, 30, self.blue)]:
+            u = t.Unit()
+            team.add_unit(u)
+            u.join_battle(self.b, x, y)
+            self.units[(x, y)] = u
+
+    def test_unit_at(self):
+        u = self.units[(1, 1)]
+        eq_(self.b.unit_at(1, 1), u)
+        u.move(self.b.grid.get_node(1, 3))
+        eq_(self.b.unit_at(1, 1), None)
+        eq_(self.b.unit_at(1, 3), u)
+        u.die()
+        eq_(self.b.unit_at(1, 3), None)
+        ok_(not self.b.grid.get_node(1, 3).occupied)
+
+    def test_units_within(self):
+        center = self.b.grid.get_node(2, 2)
+        eq_(len(self.b.units_within(center, 1)), 2)
+        eq_(len(self.b.units_within(center, 3)), 3)
+        eq_(len(self.b.units_within(center, 3, t.MANHATTAN)), 2)
+        eq_(len(self.b.units_within(center, 40)), 5)
+
+    def test_units_in(self):
+        eq_(self.b.units_in(1, 1, 3, 3),
+            [self.units[(1, 1)], self.units[(2, 2)]])
+        eq_(self.b.units_in(2, 1, 6, 2), [self.units[(5, 1)]])
+        eq_(len(self.b.units_in(0, 0, 40, 40)), 5)
+        eq_(self.b.units_in(21, 0, 21, 40), [])
+        self.units[(35, 30)].die()
+        eq_(len(self.b.occupancy.in_rect(-100, -100, 1000, 1000)), 4)
+
+    def test_enemies(self):
+        u = self.units[(1, 1)]
+        eq_(u.enemies_within(1), [self.units[(2, 2)]])
+        eq_(u.nearest_enemy(), self.units[(2, 2)])
+        self.units[(2, 2)].die()
+        eq_(u.enemies_within(1), [])
+        eq_(u.nearest_enemy(), self.units[(5, 1)])
+        eq_(self.units[(20, 20)].nearest_enemy(), self.units[(35, 30)])
+
+
 class TestHealth(object):
     def setup(self):
         self.u = t.Unit()
@@ -145,6 +661,215 @@ class TestMelee(object):
         eq_(self.u2.current_hp, 90)
 
 
+class TestBatchedMelee(object):
+    def make_targets(self):
+        team = t.Team()
+        targets = []
+        for hp in [5, 15, 25, 100, 0, 40, 12]:
+            u = t.Unit()
+            team.add_unit(u)
+            u.current_hp = hp
+            if hp == 0:
+                u.die()
+            targets.append(u)
+        # Repeat some targets so they are struck more than once
+        return team, targets + targets[1:4] + targets[2:3]
+
+    def state(self, team, units, attacker):
+        return ([(u.current_hp, u.alive) for u in units],
+                len(team.live_units), attacker.damage_dealt)
+
+    def test_matches_loop(self):
+        def dmg(target):
+            return 10 + target.max_hp // 50
+        for seed in range(5):
+            team1, loop_targets = self.make_targets()
+            a1 = t.Unit()
+            roll = t.HitRoll(0.6, np.random.RandomState(seed))
+            for target in loop_targets:
+                a1.melee_atk(target, roll, dmg)
+
+            team2, batch_targets = self.make_targets()
+            a2 = t.Unit()
+            roll = t.HitRoll(0.6, np.random.RandomState(seed))
+            a2.melee_atk_many(batch_targets, roll.many,
+                              lambda targets: [dmg(u) for u in targets])
+            eq_(self.state(team1, loop_targets[:7], a1),
+                self.state(team2, batch_targets[:7], a2))
+
+    def test_shared_stream_matches_loop(self):
+        class Log(object):
+            def __init__(self, units):
+                self.units = units
+                self.recorder = self
+                self.events = []
+
+            def record(self, kind, unit, first=0, second=0):
+                self.events.append((kind, self.units.index(unit), first))
+
+        for seed in range(5):
+            results = []
+            for batched in [False, True]:
+                team, targets = self.make_targets()
+                attacker = t.Unit()
+                log = Log([attacker] + targets[:7])
+                for u in log.units:
+                    u.battle = log
+                rng = np.random.RandomState(seed)
+                hit = t.HitRoll(0.6, rng)
+                dmg = t.DamageRoll(3, 14, rng)
+                if batched:
+                    attacker.melee_atk_many(targets, hit, dmg)
+                else:
+                    for target in targets:
+                        attacker.melee_atk(target, hit, dmg)
+                results.append((self.state(team, targets[:7], attacker),
+                                log.events, rng.random_sample()))
+            eq_(results[0], results[1])
+            ok_(t.EVENT_DIE in [event[0] for event in results[0][1]])
+
+    def test_damage_roll(self):
+        roll = t.DamageRoll(2, 5, np.random.RandomState(3))
+        amounts = roll.many(range(1000))
+        eq_((amounts.min(), amounts.max()), (2, 5))
+        roll = t.DamageRoll(2, 5, np.random.RandomState(3))
+        eq_([roll(None) for _ in range(20)], amounts[:20].tolist())
+
+    def test_area_attack(self):
+        b = t.Battle(t.Grid(10, 10))
+        red = t.Team()
+        blue = t.Team()
+        attacker = t.Unit()
+        red.add_unit(attacker)
+        attacker.join_battle(b, 5, 5)
+        for x, y in [(4, 4), (6, 5), (5, 7), (9, 9)]:
+            u = t.Unit()
+            u.current_hp = 10
+            blue.add_unit(u)
+            u.join_battle(b, x, y)
+        hits, damage = attacker.area_attack(2)
+        eq_(len(hits), 3)
+        eq_(len(blue.live_units), 1)
+        eq_(b.unit_at(4, 4), None)
+        eq_(attacker.damage_dealt, 30)
+
+
+class TestActionCache(object):
+    def setup(self):
+        self.b = t.Battle(t.ArrayGrid(10, 10))
+        self.b.teams = [t.Team(), t.Team()]
+        self.units = []
+        for team, (x, y) in zip([0, 1, 1], [(1, 1), (3, 1), (8, 8)]):
+            u = t.Unit()
+            u.move_speed = 2
+            self.b.teams[team].add_unit(u)
+            u.join_battle(self.b, x, y)
+            self.units.append(u)
+        self.cache = self.b.actions
+
+    def test_moves(self):
+        a, b, c = self.units
+        moves = a.legal_moves()
+        ok_(a.legal_moves() is moves)
+        eq_(self.cache.stats()["moves"]["hits"], 1)
+        c.move(self.b.grid.get_node(8, 7))
+        ok_(a.legal_moves() is moves)
+        b.move(self.b.grid.get_node(2, 3))
+        ok_(a.legal_moves() is not moves)
+        ok_(self.b.grid.get_node(2, 3) not in a.legal_moves())
+        a.move_speed = 1
+        eq_(len(a.legal_moves()), 8)
+        eq_(self.cache.stats()["moves"]["misses"], 3)
+
+    def test_targets(self):
+        a, b, c = self.units
+        eq_(a.adjacent_enemies(), [])
+        eq_(a.adjacent_enemies(), [])
+        eq_(self.cache.hits["targets"], 1)
+        b.move(self.b.grid.get_node(2, 2))
+        eq_(a.adjacent_enemies(), [b])
+        eq_(b.adjacent_enemies(), [a])
+        c.move(self.b.grid.get_node(8, 7))
+        eq_(self.cache.hits["targets"], 1)
+        eq_(a.adjacent_enemies(), [b])
+        eq_(self.cache.hits["targets"], 2)
+        b.die()
+        eq_(a.adjacent_enemies(), [])
+
+    def test_actions(self):
+        a = self.units[0]
+        a.moved = a.acted = False
+        ok_(a.possible_actions() is a.possible_actions())
+        a.moved = True
+        eq_(a.possible_actions(), ["Action", "End Turn"])
+        stats = self.cache.stats()["actions"]
+        eq_((stats["hits"], stats["misses"]), (1, 2))
+        eq_(stats["hit_rate"], 1 / 3.0)
+
+    def test_matches_uncached(self):
+        spec = t.BattleSpec(12, 12, [
+            {"team": i % 2, "x": i % 12, "y": i * 5 % 12, "move_speed": 3}
+            for i in range(16)], [t.random_policy, t.aggressive_policy])
+        battle = spec.build()
+        rng = random.Random(3)
+        policies = dict(zip(battle.teams, spec.policies))
+        for _ in range(30):
+            battle.policy_turn(policies, rng)
+            for unit in battle.units:
+                if unit.alive:
+                    field = battle.grid._flood(unit.location, unit.move_speed)
+                    eq_([(n.x, n.y) for n in unit.legal_moves()],
+                        [tuple(cell) for cell in field.destinations().tolist()])
+                    eq_(unit.adjacent_enemies(), unit.enemies_within(1))
+        ok_(battle.actions.hits["moves"] > 0)
+
+
+class TestUnitTable(object):
+    def setup(self):
+        self.b = t.Battle(t.Grid(10, 10), use_table=True)
+        self.team = t.Team()
+        self.units = []
+        for i in range(100):
+            u = self.b.new_unit()
+            u.speed = 1 + i % 9
+            self.team.add_unit(u)
+            self.units.append(u)
+
+    def test_slots(self):
+        u = t.Unit()
+        ok_(not hasattr(u, "__dict__"))
+        assert_raises(AttributeError, setattr, u, "mana", 10)
+
+    def test_handles(self):
+        u = self.units[42]
+        ok_(isinstance(u, t.TableUnit))
+        eq_(self.b.table.size, 100)
+        eq_(u.speed, 1 + 42 % 9)
+        u.update_hp(-30)
+        eq_(u.current_hp, 70)
+        eq_(self.b.table.column("current_hp")[42], 70)
+        u.die()
+        ok_(not u.alive)
+        ok_(u in self.team.dead_units)
+
+    def test_scheduling(self):
+        self.b.units = list(self.units)
+        self.b.advance()
+        eq_(self.b.active_unit, self.units[98])
+        eq_(list(self.b.table.ct(self.b.scheduler.clock)),
+            [u.ct for u in self.units])
+
+    def test_batched_melee(self):
+        for u in self.units[:10]:
+            u.current_hp = 15
+        attacker = t.Unit()
+        attacker.melee_atk_many(self.units[:20] + self.units[:5])
+        eq_([u.current_hp for u in self.units[:6]], [0] * 5 + [5])
+        eq_(self.units[15].current_hp, 90)
+        eq_(len(self.team.live_units), 95)
+        eq_(attacker.damage_dealt, 250)
+
+
 class TestTeam(object):
     def setup(self):
         self.t = t.Team()
@@ -166,6 +891,665 @@ class TestTeam(object):
             unit.die()
         ok_(self.t.is_defeated())
 
+    def test_incremental(self):
+        eq_(len(self.t.live_units), 5)
+        self.t.all_units[2].die()
+        self.t.all_units[2].die()
+        eq_(len(self.t.live_units), 4)
+        eq_(len(self.t.dead_units), 1)
+        ok_(self.t.all_units[2] in self.t.dead_units)
+        ok_(self.t.all_units[2] not in self.t.live_units)
+
+    def test_unit_set(self):
+        u = t.Unit()
+        s = t.UnitSet([u, u])
+        eq_(len(s), 1)
+        ok_(u in s)
+        ok_(t.Unit() not in s)
+        eq_(s[0], u)
+        s.remove(u)
+        eq_(len(s), 0)
+        assert_raises(ValueError, s.remove, u)
+
+
+class TestHeadless(object):
+    def setup(self):
+        units = []
+        for i in range(3):
+            units.append({"team": 0, "x": 0, "y": i * 3, "speed": 4 + i})
+            units.append({"team": 1, "x": 9, "y": i * 3, "speed": 6 - i,
+                          "max_hp": 50})
+        self.spec = t.BattleSpec(10, 10, units,
+                                 [t.aggressive_policy, t.random_policy],
+                                 max_turns=400)
+
+    def test_build(self):
+        b = self.spec.build()
+        eq_(len(b.units), 6)
+        eq_(len(b.teams), 2)
+        eq_(b.units[1].team, b.teams[1])
+        eq_(b.units[1].current_hp, 50)
+
+    def test_unknown_unit_key(self):
+        units = [{"team": 0, "x": 0, "y": 0, "speed": 4, "armor": 2}]
+        assert_raises(ValueError, t.BattleSpec, 10, 10, units,
+                      [t.random_policy])
+
+    def test_simulate_deterministic(self):
+        r1 = t.simulate(self.spec, 7)
+        r2 = t.simulate(self.spec, 7)
+        eq_(r1, r2)
+        ok_(r1["winner"] in (0, 1))
+        ok_(r1["damage"][r1["winner"]] > 0)
+
+    def test_unit_table(self):
+        r1 = t.simulate(self.spec, 3)
+        self.spec.use_table = True
+        eq_(t.simulate(self.spec, 3), r1)
+
+    def test_batch(self):
+        serial = t.run_batch(self.spec, 6, processes=1)
+        parallel = t.run_batch(self.spec, 6, processes=2)
+        eq_(serial.results, parallel.results)
+        eq_(sum(serial.wins) + serial.draws, 6)
+        ok_("6 battles" in str(serial))
+
+
+class TestSimulation(object):
+    def setup(self):
+        self.spec = t.demo_spec()
+
+    def finish(self, simulation):
+        frame = simulation.frames.wait(10)
+        while not frame.finished:
+            frame = simulation.frames.wait(10)
+        simulation.worker.join(10)
+        return frame
+
+    def test_frame_queue(self):
+        frames = t.FrameQueue(3, threads=True)
+        eq_(frames.latest(), None)
+        for turn in range(10):
+            frames.publish(t.Frame(turn, False, ""))
+        eq_(frames.dropped, 7)
+        eq_(frames.latest().turn, 9)
+        eq_(frames.skipped, 2)
+        eq_(frames.latest(), None)
+        frames.publish(t.Frame(10, True, ""))
+        eq_(frames.wait(1).turn, 10)
+        assert_raises(t.Queue.Empty, frames.wait, 0.01)
+
+    def test_frame_queue_lagging(self):
+        class Lagging(t.Queue.Queue):
+            # Full, yet nothing readable without blocking, like a
+            # multiprocessing.Queue whose feeder thread is behind
+            def get_nowait(self):
+                raise t.Queue.Empty
+        frames = t.FrameQueue(2, threads=True)
+        frames.queue = Lagging(2)
+        for turn in range(4):
+            frames.publish(t.Frame(turn, False, ""))
+        eq_(frames.dropped, 2)
+        eq_(frames.queue.get().turn, 2)
+
+    def test_thread(self):
+        simulation = t.Simulation(self.spec, 3, threads=True).start()
+        frame = self.finish(simulation)
+        result = t.simulate(self.spec, 3)
+        eq_(frame.turn, result["turns"])
+        battle = t.BattleSnapshot(frame.snapshot).restore()
+        ok_(battle.defeat_check())
+        eq_([len(team.live_units) for team in battle.teams],
+            result["survivors"])
+        ok_(not simulation.running())
+
+    def test_interval(self):
+        frames = t.FrameQueue(10, threads=True)
+        turns = t.run_simulation(self.spec, 3, frames, interval=60)
+        eq_(frames.queue.qsize(), 2)
+        frame = frames.latest()
+        eq_((frame.turn, frame.finished), (turns, True))
+
+    def test_process(self):
+        simulation = t.Simulation(self.spec, 3, queue_size=1).start()
+        frame = self.finish(simulation)
+        eq_(frame.turn, t.simulate(self.spec, 3)["turns"])
+        eq_(simulation.worker.exitcode, 0)
+
+    def test_stop(self):
+        import time
+        simulation = t.Simulation(self.spec, 0, delay=10).start()
+        ok_(simulation.frames.wait(10).turn <= 1)
+        start = time.time()
+        simulation.stop()
+        ok_(not simulation.running())
+        ok_(time.time() - start < 5)
+
+    def test_visualizer(self):
+        simulation = t.Simulation(self.spec, 3, threads=True).start()
+        frame = self.finish(simulation)
+        v = t.Visualizer(self.spec.build())
+        v.FPS = 0
+        frames = t.FrameQueue(2, threads=True)
+        frames.publish(frame)
+        v.run(max_frames=1, frames=frames)
+        eq_([u.current_hp for u in v.battle.units],
+            [u.current_hp for u in
+             t.BattleSnapshot(frame.snapshot).restore().units])
+
+
+    def test_frames_applied_in_place(self):
+        battle = self.spec.build()
+        policies = dict(zip(battle.teams, self.spec.policies))
+        rng = random.Random(4)
+        v = t.Visualizer(self.spec.build(),
+                         screen=t.pygame.Surface((400, 400), 0, 32))
+        full = t.Visualizer(self.spec.build(),
+                            screen=t.pygame.Surface((400, 400), 0, 32))
+        for turn in range(40):
+            frame = t.Frame(turn, False, battle.snapshot())
+            dirty = v.show_frame(frame)
+            if turn:
+                ok_(v.battle is shown)
+                ok_(len(dirty) < 20)
+            shown = v.battle
+            full.show(t.BattleSnapshot(frame.snapshot).restore())
+            eq_(t.pygame.image.tostring(v.screen, "RGB"),
+                t.pygame.image.tostring(full.screen, "RGB"))
+            eq_([(u.current_hp, u.alive, u.ct) for u in v.battle.units],
+                [(u.current_hp, u.alive, u.ct) for u in full.battle.units])
+            if battle.defeat_check():
+                break
+            battle.policy_turn(policies, rng)
+        ok_(any(not unit.alive for unit in v.battle.units))
+        battle.teams.append(t.Team())
+        v.show_frame(t.Frame(turn, True, battle.snapshot()))
+        ok_(v.battle is not shown)
+
+class TestSnapshot(object):
+    def setup(self):
+        units = []
+        for i in range(3):
+            units.append({"team": 0, "x": 0, "y": i * 3, "speed": 4 + i})
+            units.append({"team": 1, "x": 9, "y": i * 3, "speed": 6 - i})
+        self.spec = t.BattleSpec(10, 10, units,
+                                 [t.aggressive_policy, t.aggressive_policy])
+        self.battle = self.spec.build()
+        self.battle.grid.set_terrain(4, 4, t.WALL)
+        self.battle.grid.set_height(5, 5, 3)
+        self.battle.units[0].name = "Alice"
+        rng = random.Random(1)
+        policies = dict(zip(self.battle.teams, self.spec.policies))
+        for _ in range(25):
+            self.battle.policy_turn(policies, rng)
+
+    def state(self, battle):
+        return [(u.name, u.ct, u.speed, u.current_hp, u.alive,
+                 u.damage_dealt, battle.teams.index(u.team),
+                 (u.location.x, u.location.y)) for u in battle.units]
+
+    def play(self, battle, turns=40):
+        rng = random.Random(2)
+        policies = dict(zip(battle.teams, self.spec.policies))
+        for _ in range(turns):
+            if battle.defeat_check():
+                break
+            battle.policy_turn(policies, rng)
+        return self.state(battle)
+
+    def check_copy(self, copy):
+        eq_(self.state(copy), self.state(self.battle))
+        eq_(copy.grid.terrain_at(4, 4), t.WALL)
+        eq_(copy.grid.height_at(5, 5), 3)
+        for unit in copy.units:
+            if unit.alive:
+                eq_(copy.unit_at(unit.location.x, unit.location.y), unit)
+                ok_(copy.grid.is_occupied(unit.location.x, unit.location.y))
+        eq_(self.play(copy), self.play(self.battle))
+
+    def test_round_trip(self):
+        data = self.battle.snapshot()
+        snap = t.BattleSnapshot(data)
+        eq_(snap.unit_count, 6)
+        eq_(snap.units["x"][1], self.battle.units[1].location.x)
+        eq_(snap.unit_name(0), "Alice")
+        self.check_copy(snap.restore())
+
+    def test_save_load(self):
+        import os
+        import tempfile
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            self.battle.save(path)
+            self.check_copy(t.Battle.load(path))
+        finally:
+            os.remove(path)
+
+    def test_active_unit(self):
+        self.battle.advance()
+        index = self.battle.units.index(self.battle.active_unit)
+        copy = t.BattleSnapshot(self.battle.snapshot()).restore()
+        eq_(copy.units.index(copy.active_unit), index)
+
+    def test_list_grid(self):
+        self.spec.grid_class = t.Grid
+        battle = self.spec.build()
+        battle.grid.set_terrain(2, 2, t.ROUGH)
+        copy = t.BattleSnapshot(battle.snapshot()).restore()
+        ok_(type(copy.grid) is t.Grid)
+        eq_(copy.grid.terrain_at(2, 2), t.ROUGH)
+        ok_(copy.grid.is_occupied(0, 0))
+
+    def test_bad_header(self):
+        data = self.battle.snapshot()
+        assert_raises(ValueError, t.BattleSnapshot, "XXXX" + data[4:])
+        assert_raises(ValueError, t.BattleSnapshot, data[:4] + "\x09" + data[5:])
+        assert_raises(ValueError, t.BattleSnapshot, data[:10])
+
+    def test_clone(self):
+        self.check_copy(self.battle.clone())
+
+    def test_clone_independent(self):
+        copy = self.battle.clone()
+        unit = copy.units[0]
+        hp = self.battle.units[0].current_hp
+        unit.current_hp = 1
+        copy.grid.set_terrain(7, 7, t.WATER)
+        eq_(self.battle.units[0].current_hp, hp)
+        eq_(self.battle.grid.terrain_at(7, 7), t.PLAIN)
+        ok_(unit.team is copy.teams[0])
+        ok_(unit.team is not self.battle.teams[0])
+
+    def test_clone_table(self):
+        self.spec.use_table = True
+        battle = self.spec.build()
+        copy = battle.clone()
+        ok_(copy.table is not None)
+        ok_(copy.table is not battle.table)
+        eq_(self.state(copy), self.state(battle))
+
+
+class TestThreatMap(object):
+    def setup(self):
+        self.b = t.Battle(t.ArrayGrid(12, 10))
+        self.b.teams = [t.Team(), t.Team()]
+        self.a = t.Unit()
+        self.e = t.Unit()
+        self.b.teams[0].add_unit(self.a)
+        self.b.teams[1].add_unit(self.e)
+        self.a.join_battle(self.b, 1, 1)
+        self.e.join_battle(self.b, 8, 5)
+        self.m = self.b.threat_map()
+
+    def test_footprint(self):
+        count = self.m.count[self.b.teams[1]]
+        # Move 2 plus melee reach 1 around (8, 5), clipped by the grid
+        eq_(count.sum(), 7 * 7)
+        eq_(count[5, 11], 1)
+        eq_(count[5, 4], 0)
+        eq_(self.m.damage[self.b.teams[1]][2, 5], 10)
+        eq_(self.m.danger_at(self.a, 5, 2), 10)
+        eq_(self.m.danger_at(self.e, 5, 2), 0)
+        ok_((self.m.enemy_count(self.b.teams[0]) ==
+             self.m.count[self.b.teams[1]]).all())
+
+    def test_incremental_matches_rebuild(self):
+        rng = random.Random(4)
+        for i in range(10):
+            unit = t.Unit()
+            self.b.teams[i % 2].add_unit(unit)
+            while True:
+                x, y = rng.randrange(12), rng.randrange(10)
+                if self.b.unit_at(x, y) is None:
+                    break
+            unit.join_battle(self.b, x, y)
+        listeners = list(self.b.listeners)
+        for step in range(40):
+            unit = rng.choice([u for u in self.b.units if u.alive])
+            if step % 9 == 8:
+                unit.die()
+            else:
+                moves = unit.legal_moves()
+                if moves:
+                    unit.move(rng.choice(moves))
+            fresh = t.ThreatMap(self.b)
+            eq_(self.m.total_count.tolist(), fresh.total_count.tolist())
+            eq_(self.m.total_damage.tolist(), fresh.total_damage.tolist())
+            for team in self.b.teams:
+                eq_(self.m.count[team].tolist(), fresh.count[team].tolist())
+            fresh.close()
+        eq_(self.b.listeners, listeners)
+        self.m.close()
+        ok_(self.m not in self.b.listeners)
+        ok_(self.b.threat_map() is not self.m)
+
+    def test_blocking(self):
+        # A wall with a single gap: plugging the gap shrinks the enemy's reach
+        for y in range(10):
+            if y != 5:
+                self.b.grid.set_terrain(6, y, t.WALL)
+                self.m.cell_changed(6, y)
+        before = self.m.count[self.b.teams[1]][5, 5]
+        eq_(before, 1)
+        self.a.move(self.b.grid.get_node(6, 5))
+        eq_(self.m.count[self.b.teams[1]][5, 5], 0)
+        fresh = t.ThreatMap(self.b)
+        ok_((self.m.total_count == fresh.total_count).all())
+        fresh.close()
+
+    def test_safest_cell(self):
+        self.a.move(self.b.grid.get_node(6, 4))
+        eq_(self.m.danger_at(self.a, 6, 4), 10)
+        safest = self.m.safest_cell(self.a)
+        eq_(self.m.danger_at(self.a, safest.x, safest.y), 0)
+        ok_(safest in self.a.legal_moves())
+        eq_((safest.x, safest.y), (4, 2))
+        self.e.die()
+        eq_(self.m.total_count.sum(), self.m.count[self.b.teams[0]].sum())
+        eq_(self.m.safest_cell(self.a), self.a.location)
+
+
+class TestVisibility(object):
+    def setup(self):
+        self.g = t.ArrayGrid(11, 11)
+        for y in range(3, 8):
+            self.g.set_terrain(7, y, t.WALL)
+
+    def test_open_field(self):
+        g = t.Grid(11, 11)
+        fov = g.field_of_view(5, 5, 3)
+        disc = set((5 + dx, 5 + dy) for dx in range(-3, 4)
+                   for dy in range(-3, 4) if dx * dx + dy * dy <= 9)
+        eq_(fov.visible, disc)
+        eq_(len(fov.cells()), len(disc))
+
+    def test_walls_block(self):
+        fov = self.g.field_of_view(5, 5, 5)
+        ok_((7, 5) in fov)
+        ok_((8, 5) not in fov)
+        ok_((9, 5) not in fov)
+        ok_((6, 1) in fov)
+        eq_(t.Grid(11, 11).field_of_view(0, 0, 2).visible,
+            set([(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (2, 0)]))
+
+    def test_line_of_sight(self):
+        ok_(not self.g.line_of_sight(5, 5, 9, 5))
+        ok_(self.g.line_of_sight(5, 5, 7, 5))
+        ok_(not self.g.line_of_sight(5, 5, 9, 1))
+        ok_(self.g.line_of_sight(5, 1, 9, 1))
+        ok_(self.g.line_of_sight(2, 2, 3, 3))
+        ok_(self.g.line_of_sight(4, 4, 4, 4))
+
+    def test_cache(self):
+        fov = self.g.field_of_view(2, 5, 3)
+        ok_(self.g.field_of_view(2, 5, 3) is fov)
+        self.g.set_occupied(3, 5, True)
+        self.g.set_terrain(2, 6, t.ROUGH)
+        self.g.set_terrain(9, 9, t.WALL)
+        ok_(self.g.field_of_view(2, 5, 3) is fov)
+        self.g.set_terrain(3, 5, t.WALL)
+        fov2 = self.g.field_of_view(2, 5, 3)
+        ok_(fov2 is not fov)
+        ok_((4, 5) not in fov2)
+
+    def test_cache_shadow_and_bound(self):
+        fov = self.g.field_of_view(5, 5, 5)
+        ok_((9, 5) not in fov)
+        self.g.set_terrain(9, 5, t.WALL)
+        ok_(self.g.field_of_view(5, 5, 5) is fov)
+        self.g.set_terrain(7, 5, t.PLAIN)
+        ok_(self.g.field_of_view(5, 5, 5) is not fov)
+        cache = self.g.fov_cache
+        cache.size = 10
+        for x in range(11):
+            for y in range(11):
+                self.g.field_of_view(x, y, 2)
+        ok_(len(cache) <= 10)
+        ok_((10, 10, 2) in cache)
+
+    def test_sight_matrix(self):
+        b = t.Battle(self.g)
+        b.teams = [t.Team(), t.Team()]
+        units = []
+        for team, x, y in ((0, 5, 5), (1, 9, 5), (1, 5, 8), (0, 0, 0)):
+            unit = t.Unit()
+            b.teams[team].add_unit(unit)
+            unit.join_battle(b, x, y)
+            units.append(unit)
+        seen = b.sight_matrix(5)
+        eq_(seen.shape, (4, 4))
+        ok_(not seen[0, 1] and not seen[1, 0])
+        ok_(seen[0, 2] and seen[2, 0])
+        ok_(not seen[0, 0])
+        ok_(not seen[3, 0])
+        ok_(units[0].can_see(units[2], 5))
+        units[2].die()
+        ok_(not b.sight_matrix(5)[0, 2])
+        mask = b.visible_mask(b.teams[0], 5)
+        ok_(mask[5, 5] and mask[0, 0])
+        ok_(not mask[5, 9])
+        eq_(b.visible_mask(b.teams[0], 5, (3, 2, 10, 7)).tolist(),
+            mask[2:7, 3:10].tolist())
+
+
+class TestReplay(object):
+    def setup(self):
+        units = []
+        for i in range(4):
+            units.append({"team": 0, "x": 0, "y": i * 2, "speed": 4 + i})
+            units.append({"team": 1, "x": 9, "y": i * 2, "speed": 7 - i})
+        self.spec = t.BattleSpec(10, 10, units,
+                                 [t.aggressive_policy, t.random_policy])
+
+    def state(self, battle):
+        return [(u.ct, u.current_hp, u.alive, u.damage_dealt, u.moved,
+                 u.acted, (u.location.x, u.location.y)) for u in battle.units]
+
+    def record(self, turns=60, interval=10):
+        from StringIO import StringIO
+        battle = self.spec.build()
+        log = StringIO()
+        battle.record(log, interval)
+        rng = random.Random(5)
+        policies = dict(zip(battle.teams, self.spec.policies))
+        states = [self.state(battle)]
+        for turn in range(turns):
+            if battle.defeat_check():
+                break
+            battle.policy_turn(policies, rng)
+            if turn == 20:
+                battle.units[0].melee_atk_many(battle.units[1::2])
+            states.append(self.state(battle))
+        battle.stop_recording()
+        return log.getvalue(), states
+
+    def test_seek(self):
+        data, states = self.record()
+        replay = t.Replay(data)
+        eq_(replay.turns, len(states) - 1)
+        eq_(replay.keyframe_turns[:3], [0, 10, 20])
+        for turn in (0, 1, 9, 10, 11, 21, 22, 37, replay.turns):
+            eq_(self.state(replay.battle_at(turn)), states[turn])
+        assert_raises(IndexError, replay.battle_at, replay.turns + 1)
+
+    def test_player(self):
+        data, states = self.record()
+        player = t.ReplayPlayer(t.Replay(data))
+        battle = player.battle
+        for turn in range(1, 15):
+            player.step()
+            eq_(player.turn, turn)
+            eq_(self.state(player.battle), states[turn])
+        ok_(player.battle is battle)
+        player.step(-3)
+        eq_(self.state(player.battle), states[11])
+        player.seek(1000)
+        eq_(self.state(player.battle), states[-1])
+
+    def test_unclosed(self):
+        data, states = self.record()
+        replay = t.Replay(data[:len(data) - 200])
+        ok_(replay.turns < len(states) - 1)
+        eq_(self.state(replay.battle_at(replay.turns)), states[replay.turns])
+
+    def test_bad_header(self):
+        data, _ = self.record(5)
+        assert_raises(ValueError, t.Replay, "XXXX" + data[4:])
+        assert_raises(ValueError, t.Replay, "TR")
+
+    def test_batch(self):
+        import os
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            result = t.run_batch(self.spec, 2, processes=1, seed=3,
+                                 replay_dir=directory)
+            replay = t.Replay.open(t.replay_path(directory, 4))
+            eq_(replay.turns, result.results[1]["turns"])
+            battle = replay.battle_at(replay.turns)
+            eq_([len(team.live_units) for team in battle.teams],
+                result.results[1]["survivors"])
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestMCTS(object):
+    def setup(self):
+        self.b = t.Battle(t.ArrayGrid(10, 10))
+        self.b.teams = [t.Team(), t.Team()]
+        self.hero = t.Unit()
+        self.hero.speed = 10
+        self.weak = t.Unit()
+        self.weak.current_hp = 10
+        self.strong = t.Unit()
+        self.teams_units = [(self.hero, 0, 2, 2), (self.weak, 1, 4, 2),
+                            (self.strong, 1, 1, 2)]
+        for unit, team, x, y in self.teams_units:
+            self.b.teams[team].add_unit(unit)
+            unit.join_battle(self.b, x, y)
+
+    def test_macro_actions(self):
+        actions = t.macro_actions(self.hero)
+        # The weakest enemy in reach comes first
+        eq_(actions[0][1], 1)
+        ok_((None, 2) in actions)
+        ok_((None, 1) not in actions)
+        ok_(all(dest is None or max(abs(dest[0] - 2), abs(dest[1] - 2)) <= 2
+                for dest, _ in actions))
+        eq_(len(t.macro_actions(self.hero, 3)), 3)
+
+    def test_search_leaves_battle_alone(self):
+        self.b.advance()
+        stats = t.mcts_search(self.b, iterations=30, rng=random.Random(0))
+        eq_(sum(visits for visits, _ in stats.values()), 30)
+        eq_(self.weak.current_hp, 10)
+        eq_(self.hero.location, self.b.grid.get_node(2, 2))
+        eq_(self.b.active_unit, self.hero)
+
+    def test_needs_budget(self):
+        self.b.advance()
+        assert_raises(ValueError, t.mcts_search, self.b)
+
+    def test_controller_turn(self):
+        ai = t.MCTSController(self.b, iterations=60)
+        self.b.next_turn(ai)
+        ok_(not self.weak.alive)
+        ok_(self.hero.acted)
+        eq_(self.hero.ct, 0)
+
+    def test_deterministic(self):
+        self.b.advance()
+        first = t.MCTSController(self.b, iterations=40, seed=3).decide()
+        eq_(t.MCTSController(self.b, iterations=40, seed=3).decide(), first)
+
+    def test_time_limit(self):
+        import time
+        spec = t.BattleSpec(80, 80, [
+            {"team": i % 2, "x": (i * 7) % 80, "y": (i * 13) % 80}
+            for i in range(40)], [t.aggressive_policy] * 2)
+        battle = spec.build()
+        ai = t.MCTSController(battle, iterations=None, time_limit=0.1)
+        battle.advance()
+        start = time.time()
+        dest, target = ai.decide()
+        ok_(time.time() - start < 0.5)
+        ok_(dest is None or battle.grid.get_node(*dest)
+            in battle.active_unit.legal_moves())
+
+    def test_root_parallel(self):
+        self.b.advance()
+        ai = t.MCTSController(self.b, iterations=40, processes=2)
+        try:
+            eq_(ai.decide()[1], 1)
+        finally:
+            ai.close()
+
+
+class TestProfiler(object):
+    def setup(self):
+        units = [{"team": 0, "x": 0, "y": 0, "speed": 5},
+                 {"team": 1, "x": 5, "y": 5, "speed": 7}]
+        self.spec = t.BattleSpec(8, 8, units, [t.aggressive_policy] * 2,
+                                 max_turns=12)
+
+    def test_restores_methods(self):
+        original = t.Battle.__dict__["advance"]
+        search = t.mcts_search
+        with t.Profiler():
+            ok_(t.Battle.__dict__["advance"] is not original)
+            ok_(t.mcts_search is not search)
+        ok_(t.Battle.__dict__["advance"] is original)
+        ok_(t.mcts_search is search)
+        profiler = t.Profiler()
+        profiler.enable()
+        try:
+            raise_in = t.Battle(t.Grid(2, 2))
+            assert_raises(ValueError, raise_in.advance)
+        finally:
+            profiler.disable()
+        ok_(t.Battle.__dict__["advance"] is original)
+        eq_(profiler.stats["battle.advance"][0], 1)
+
+    def test_counts(self):
+        with t.Profiler() as profiler:
+            result = t.simulate(self.spec, 1)
+        turns = result["turns"]
+        eq_(profiler.stats["battle.policy_turn"][0], turns)
+        eq_(profiler.counters["turns"], turns)
+        ok_(profiler.counters["ticks"] > 0)
+        eq_(profiler.counters["floods"], profiler.stats["grid.flood"][0])
+        for calls, total, own, longest in profiler.stats.values():
+            ok_(0 <= own <= total + 1e-9)
+            ok_(longest <= total + 1e-9)
+        ok_("ticks per turn" in profiler.summary())
+        ok_("battle.policy_turn;unit.legal_moves;grid.flood"
+            in profiler.collapsed_stacks())
+
+    def test_trace(self):
+        import json
+        import os
+        import tempfile
+        with t.Profiler() as profiler:
+            t.simulate(self.spec, 1)
+        events = profiler.trace_events()
+        eq_(len([e for e in events if e["ph"] == "X"]), len(profiler.spans))
+        eq_(events[-1]["ph"], "C")
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            profiler.write_trace(path)
+            with open(path) as trace:
+                eq_(len(json.load(trace)["traceEvents"]), len(events))
+        finally:
+            os.remove(path)
+        profiler = t.Profiler(max_spans=5)
+        with profiler:
+            t.simulate(self.spec, 1)
+        eq_(len(profiler.spans), 5)
+        ok_(profiler.dropped > 0)
+
 
 class TestMenu(object):
     def setup(self):
@@ -209,6 +1593,123 @@ class TestMenu(object):
         eq_(r, "Moe")
         eq_(self.fail_count, 2)
 
+    def test_pull(self):
+        eq_(self.m.pull("2"), "Curly")
+        eq_(self.m.pull(" 0 "), "Larry")
+        eq_(self.m.pull("-1"), False)
+        eq_(self.m.pull("3"), False)
+        eq_(self.m.pull(None), False)
+
+
+class TestCommands(object):
+    def setup(self):
+        spec = t.BattleSpec(6, 6, [
+            {"name": "A", "team": 0, "x": 0, "y": 0, "speed": 5},
+            {"name": "B", "team": 0, "x": 0, "y": 5, "speed": 7},
+            {"name": "C", "team": 1, "x": 5, "y": 0, "speed": 6},
+            {"name": "D", "team": 1, "x": 5, "y": 5, "speed": 4},
+        ], [t.aggressive_policy] * 2)
+        self.battles = [spec.build(), spec.build()]
+
+    def driver(self):
+        """
+        Moves to the first destination, attacks the first target, ends
+        the turn
+        """
+        cycle = ["Move", "0", "Action", "0", "End Turn"]
+        commands = (cycle[i % len(cycle)] for i in xrange(10 ** 6))
+        return t.CommandSource(commands)
+
+    def state(self, battle):
+        return [(u.current_hp, u.location.x, u.location.y, u.ct)
+                for u in battle.units]
+
+    def test_source(self):
+        source = t.CommandSource(["Move\n", "1\r\n"])
+        source.push("End Turn")
+        eq_([source(), source(), source()], ["End Turn", "Move", "1"])
+        eq_(source.count, 3)
+        assert_raises(EOFError, source)
+        ok_(source.quiet)
+
+    def test_quiet(self):
+        import sys
+        from StringIO import StringIO
+        unit = self.battles[0].units[0]
+        out, sys.stdout = sys.stdout, StringIO()
+        try:
+            unit.action_parse("Move", t.CommandSource(["x", "0"]))
+            unit.action_parse("Action", t.CommandSource())
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = out
+        eq_(printed, "")
+        ok_(unit.moved)
+
+    def test_record_and_replay(self):
+        import os
+        import tempfile
+        from StringIO import StringIO
+        log = StringIO()
+        first, second = self.battles
+        turns = first.run_commands(t.CommandRecorder(self.driver(), log))
+        ok_(first.defeat_check())
+        handle, path = tempfile.mkstemp()
+        os.write(handle, "# scripted regression\n\n" + log.getvalue())
+        os.close(handle)
+        try:
+            source = t.CommandSource.from_file(path)
+        finally:
+            os.remove(path)
+        eq_(second.run_commands(source), turns)
+        eq_(self.state(second), self.state(first))
+        assert_raises(EOFError, source)
+
+    def test_nowhere_to_move(self):
+        battle = t.Battle(t.Grid(1, 1))
+        unit = t.Unit()
+        unit.join_battle(battle, 0, 0)
+        unit.moved = False
+        unit.action_parse("Move", t.CommandSource())
+        ok_(not unit.moved)
+
+    def test_out_of_commands(self):
+        source = t.CommandSource(["Move", "0"])
+        eq_(self.battles[0].run_commands(source), 0)
+        eq_(self.battles[0].run_commands(self.driver(), max_turns=3), 3)
+
+
+class TestCamera(object):
+    def setup(self):
+        self.c = t.Camera(1000, 500, (800, 600))
+
+    def test_fit(self):
+        eq_(t.Camera(10, 10, (800, 800)).cell_size, 80)
+        eq_(t.Camera(20, 10, (800, 800)).cell_size, 40)
+        eq_(self.c.cell_size, t.Camera.DEFAULT_CELL)
+        eq_(self.c.view(), (0, 0, 50, 38))
+
+    def test_pan(self):
+        self.c.pan(10, 3)
+        eq_(self.c.view(), (10, 3, 60, 41))
+        eq_(self.c.cell_rect(10, 3), t.pygame.Rect(0, 0, 16, 16))
+        eq_(self.c.cell_at(17, 40), (11, 5))
+        self.c.pan(-100, 10000)
+        eq_((self.c.x, self.c.y), (0, 500 - 600 // 16))
+        self.c.center_on(999, 0)
+        eq_(self.c.view()[2], 1000)
+
+    def test_zoom(self):
+        self.c.center_on(500, 250)
+        center = self.c.cell_at(400, 300)
+        self.c.zoom(2)
+        eq_(self.c.cell_size, 32)
+        eq_(self.c.cell_at(400, 300), center)
+        self.c.zoom(0.01, (0, 0))
+        eq_(self.c.cell_size, t.Camera.MIN_CELL)
+        self.c.zoom(1000)
+        eq_(self.c.cell_size, t.Camera.MAX_CELL)
+
 
 class TestVis(object):
     def setup(self):
@@ -221,7 +1722,189 @@ class TestVis(object):
             new_unit = t.Unit()
             new_unit.join_battle(b, start[0], start[1])
 
+        self.b = b
         self.v = t.Visualizer(b)
 
     def test_draw_grid(self):
         self.v.draw()
+
+    def test_draw_grid_lines(self):
+        screen = self.v.screen
+        screen.fill(self.v.BLACK)
+        self.v.draw_grid()
+        size = self.v.camera.cell_size
+        eq_(screen.get_at_mapped((size, size + 1)),
+            screen.map_rgb(self.v.DK_GREY))
+        eq_(screen.get_at_mapped((size + 1, size + 1)),
+            screen.map_rgb(self.v.TERRAIN_COLORS[t.PLAIN]))
+
+    def test_draw_dirty(self):
+        self.v.draw()
+        eq_(self.v.draw_dirty(), [])
+        unit = self.b.units[0]
+        unit.move(self.b.grid.get_node(1, 0))
+        eq_(len(self.v.draw_dirty()), 2)
+        eq_(self.v.draw_dirty(), [])
+        unit.update_hp(-10)
+        eq_(self.v.draw_dirty(), [self.v.cell_rect(unit.location)])
+
+    def test_frame_stats(self):
+        self.v.FPS = 0
+        self.v.run(max_frames=5)
+        eq_(self.v.frame_stats()["frames"], 5)
+
+    def test_fog(self):
+        self.b.teams = [t.Team(), t.Team()]
+        for team, unit in zip(self.b.teams, self.b.units):
+            team.add_unit(unit)
+        self.v.fog_team = self.b.teams[0]
+        self.v.draw()
+        ok_(self.v.fog[0, 0])
+        ok_(not self.v.fog[9, 9])
+        ok_(not self.v.shows(self.b.units[1]))
+        self.b.units[0].move(self.b.grid.get_node(5, 5))
+        dirty = self.v.draw_dirty()
+        ok_(self.v.fog[9, 9])
+        ok_(self.v.shows(self.b.units[1]))
+        ok_(self.v.cell_rect(self.b.grid.get_node(9, 9)) in dirty)
+        eq_(self.v.draw_dirty(), [])
+
+    def test_scrub(self):
+        from StringIO import StringIO
+        battle = t.demo_spec().build()
+        log = StringIO()
+        battle.record(log, 5)
+        policies = dict(zip(battle.teams, [t.aggressive_policy] * 2))
+        rng = random.Random(0)
+        for _ in range(12):
+            battle.policy_turn(policies, rng)
+        battle.stop_recording()
+        player = t.ReplayPlayer(t.Replay(log.getvalue()))
+        v = t.Visualizer(None, player)
+        v.draw()
+        ok_(v.scrub(t.pygame.K_RIGHT) is not None)
+        eq_(player.turn, 1)
+        eq_(v.scrub(t.pygame.K_END), [v.screen.get_rect()])
+        eq_(player.turn, 12)
+        ok_(v.battle is player.battle)
+        v.scrub(t.pygame.K_PAGEDOWN)
+        eq_(player.turn, 2)
+        eq_(v.scrub(t.pygame.K_a), None)
+
+    def test_offscreen(self):
+        surface = t.pygame.Surface((t.Visualizer.WINDOWWIDTH,
+                                    t.Visualizer.WINDOWHEIGHT), 0, 32)
+        v = t.Visualizer(self.b, screen=surface)
+        ok_(v.screen is surface)
+        v.draw()
+        eq_(surface.get_at((2, 2))[:3], t.Visualizer.WHITE)
+
+    def test_draw_array_grid(self):
+        b = t.Battle(t.ArrayGrid(10, 10))
+        t.Unit().join_battle(b, 5, 5)
+        t.Visualizer(b).draw()
+
+    def test_large_grid(self):
+        b = t.Battle(t.ArrayGrid(2000, 2000))
+        for x, y in [(1, 1), (40, 40), (60, 1), (1500, 1500)]:
+            t.Unit().join_battle(b, x, y)
+        b.grid.set_terrain(2, 2, t.WALL)
+        surface = t.pygame.Surface((800, 800), 0, 32)
+        v = t.Visualizer(b, screen=surface)
+        eq_(v.camera.view(), (0, 0, 50, 49))
+        v.draw()
+        eq_(sorted(v.drawn), sorted(b.units[:2]))
+        eq_(surface.get_at((40, 40))[:3], t.Visualizer.DK_GREY)
+        v.camera.center_on(1500, 1500)
+        eq_(v.draw_dirty(), [surface.get_rect()])
+        eq_(v.drawn.keys(), [b.units[3]])
+        v.steer(t.pygame.K_EQUALS)
+        eq_(sorted(v.sprites), [16, 32])
+        eq_(v.steer(t.pygame.K_q), None)
+
+    def test_large_grid_fog(self):
+        b = t.Battle(t.ArrayGrid(2000, 2000))
+        b.teams = [t.Team(), t.Team()]
+        for team, x, y in [(0, 1005, 1005), (1, 1010, 1005), (1, 1030, 1005)]:
+            u = t.Unit()
+            b.teams[team].add_unit(u)
+            u.join_battle(b, x, y)
+        surface = t.pygame.Surface((800, 800), 0, 32)
+        v = t.Visualizer(b, screen=surface)
+        v.fog_team = b.teams[0]
+        v.camera.center_on(1005, 1005)
+        v.draw()
+        x0, y0, x1, y1 = v.camera.view()
+        eq_(v.fog.shape, (y1 - y0, x1 - x0))
+        ok_(v.fog[1005 - y0, 1005 - x0])
+        ok_(v.shows(b.units[1]))
+        ok_(not v.shows(b.units[2]))
+        b.units[0].move(b.grid.get_node(1006, 1005))
+        dirty = v.draw_dirty()
+        ok_(v.camera.cell_rect(1014, 1005) in dirty)
+
+    def test_timeline(self):
+        surface = t.pygame.Surface((800, 800), 0, 32)
+        v = t.Visualizer(self.b, screen=surface)
+        eq_(v.timeline_rect, t.pygame.Rect(0, 776, 800, 24))
+        v.draw()
+        eq_(v.turns, self.b.forecast(v.TIMELINE_LENGTH))
+        eq_(surface.get_at((2, 790))[:3], t.Visualizer.DK_GREY)
+        eq_(v.draw_dirty(), [])
+        self.b.units[0].speed = 50
+        eq_(v.draw_dirty(), [v.timeline_rect])
+        eq_(v.turns[0], self.b.units[0])
+        calls = []
+        forecast = self.b.forecast
+        self.b.forecast = lambda count: calls.append(count) or forecast(count)
+        eq_(v.draw_dirty(), [])
+        eq_(calls, [])
+        self.b.units[1].speed = 40
+        v.draw_dirty()
+        eq_(calls, [v.TIMELINE_LENGTH])
+        del self.b.forecast
+        hidden = t.Visualizer(self.b, screen=surface, timeline=0)
+        eq_(hidden.camera.viewport, (800, 800))
+        hidden.draw()
+        eq_(hidden.turns, [])
+
+    def test_unit_atlas(self):
+        surface = t.pygame.Surface((100, 124), 0, 32)
+        v = t.Visualizer(self.b, screen=surface)
+        unit = self.b.units[0]
+        unit.update_hp(-70)
+        v.draw()
+        eq_(surface.get_at((5, 5))[:3], t.Visualizer.BLACK)
+        eq_(surface.get_at((1, 7))[:3], t.Visualizer.GREEN)
+        eq_(surface.get_at((4, 7))[:3], t.Visualizer.RED)
+        eq_(surface.get_at((0, 0))[:3], t.Visualizer.DK_GREY)
+        eq_(surface.get_at((1, 1))[:3], t.Visualizer.WHITE)
+        eq_(sorted(v.sprites[10]), ["units"])
+
+    def test_overlays(self):
+        self.b.teams = [t.Team(), t.Team()]
+        for team, unit in zip(self.b.teams, self.b.units):
+            team.add_unit(unit)
+        surface = t.pygame.Surface((800, 824), 0, 32)
+        v = t.Visualizer(self.b, screen=surface)
+        v.draw()
+        v.set_overlays([v.threat_overlay(self.b.teams[0])])
+        eq_(v.draw_dirty(), [surface.get_rect()])
+        threatened = v.camera.cell_rect(8, 8).center
+        alpha = t.Visualizer.OVERLAY_ALPHA
+        tinted = (np.array(t.Visualizer.WHITE) * (1 - alpha) +
+                  np.array(t.Visualizer.RED) * alpha).astype(np.uint8)
+        eq_(surface.get_at(threatened)[:3], tuple(tinted))
+        eq_(surface.get_at(v.camera.cell_rect(2, 2).center)[:3],
+            t.Visualizer.WHITE)
+
+    def test_corpses(self):
+        unit = self.b.units[1]
+        unit.die()
+        self.v.draw()
+        ok_(unit in self.v.drawn)
+        v = t.Visualizer(self.b)
+        eq_(v.corpses.in_rect(0, 0, 10, 10), [unit])
+        v.show(t.Battle(t.Grid(10, 10)))
+        ok_(v not in self.b.listeners)
+        eq_(v.drawn, {})
@@ -0,0 +1,196 @@
+"""
+Tests for the battle server, played through real sockets on localhost.
+"""
+from nose.tools import *
+import asyncore
+import socket
+import threading
+import time
+import tactics as t
+import tactics_server as ts
+
+
+class LineClient(object):
+    def __init__(self, address):
+        self.sock = socket.create_connection(address, timeout=5)
+        self.file = self.sock.makefile()
+
+    def send(self, line):
+        self.sock.sendall(line + "\n")
+
+    def read(self):
+        return self.file.readline().rstrip("\n")
+
+    def read_until(self, word):
+        while True:
+            line = self.read()
+            if not line or line.split()[0] == word:
+                return line
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class TestServer(object):
+    def setup(self):
+        self.start(t.demo_spec())
+
+    def start(self, spec, turn_timeout=None):
+        self.server = ts.Server(spec, workers=2, turn_timeout=turn_timeout)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.daemon = True
+        self.thread.start()
+        self.clients = []
+
+    def teardown(self):
+        for client in self.clients:
+            client.close()
+        self.server.stop()
+        self.thread.join(5)
+        self.server.close()
+
+    def connect(self):
+        client = LineClient(self.server.address)
+        self.clients.append(client)
+        return client
+
+    def test_turn(self):
+        c = self.connect()
+        c.send("PLAY")
+        eq_(c.read(), "GAME 1 0")
+        eq_(c.read(), "START 1")
+        ok_(c.read().startswith("TURN A "))
+        eq_(c.read(), "ACTIONS Move,Action,End Turn")
+        c.send("Move")
+        menu = c.read().split()
+        eq_(menu[0], "MENU")
+        eq_(menu[2:], ["Move", "to"])
+        options = [c.read() for _ in range(int(menu[1]))]
+        eq_(options[0].split()[:2], ["OPTION", "0"])
+        c.send("nonsense")
+        eq_(c.read(), "INVALID")
+        eq_(c.read(), " ".join(menu))
+        for _ in options:
+            c.read()
+        c.send("0")
+        eq_(c.read(), "ACTIONS Action,End Turn")
+        c.send("Fly")
+        eq_(c.read(), "INVALID")
+        eq_(c.read(), "ACTIONS Action,End Turn")
+        c.send("End Turn")
+        ok_(c.read().startswith("TURN A "))
+
+    def test_play_to_the_end(self):
+        c = self.connect()
+        c.send("PLAY")
+        c.read_until("START")
+        result = None
+        while result is None:
+            line = c.read()
+            if line.startswith("ACTIONS"):
+                c.send("End Turn")
+            elif line.startswith("OVER"):
+                result = line
+        eq_(result, "OVER 1")
+        c.send("PLAY")
+        eq_(c.read(), "GAME 2 0")
+
+    def test_join(self):
+        self.teardown()
+        spec = t.demo_spec()
+        self.start(spec)
+        a = self.connect()
+        a.send("PLAY 2")
+        eq_(a.read(), "GAME 1 0")
+        b = self.connect()
+        b.send("JOIN 1")
+        eq_(b.read(), "GAME 1 1")
+        eq_(a.read(), "START 1")
+        eq_(b.read(), "START 1")
+        ok_(b.read().startswith("TURN B "))
+        a.send("End Turn")
+        eq_(a.read(), "WAIT")
+        c = self.connect()
+        c.send("JOIN 1")
+        eq_(c.read(), "ERROR no free seat in game 1")
+        c.send("PLAY")
+        eq_(c.read(), "GAME 2 0")
+
+    def test_rejoin(self):
+        self.teardown()
+        self.start(t.demo_spec())
+        a = self.connect()
+        a.send("PLAY 2")
+        b = self.connect()
+        b.send("JOIN 1")
+        a.read_until("START")
+        b.read_until("TURN")
+        eq_(b.read(), "ACTIONS Move,Action,End Turn")
+        b.send("Move")
+        menu = b.read().split()
+        for _ in range(int(menu[1])):
+            b.read()
+        b.send("0")
+        eq_(b.read(), "ACTIONS Action,End Turn")
+        a.send("QUIT")
+        eq_(a.read(), "")
+        c = self.connect()
+        c.send("JOIN 1")
+        eq_(c.read(), "GAME 1 0")
+        eq_(c.read(), "START 1")
+        game = self.server.games[1]
+        turns = game.turns
+        b.send("End Turn")
+        line = b.read()
+        ok_(line.startswith("TURN ") or line.startswith("OVER"), line)
+        ok_(game.turns > turns)
+        ok_(game.seats[0] is not None)
+
+    def test_errors(self):
+        c = self.connect()
+        for line in ("HELLO", "PLAY 3", "PLAY x", "JOIN 7"):
+            c.send(line)
+            ok_(c.read().startswith("ERROR"))
+
+    def test_timeout(self):
+        self.teardown()
+        self.start(t.demo_spec(), turn_timeout=0.05)
+        c = self.connect()
+        c.send("PLAY")
+        c.read_until("TURN")
+        c.read()
+        eq_(c.read(), "TIMEOUT")
+        ok_(c.read().startswith("TURN A "))
+        c.read()
+        c.send("Move")
+        c.read_until("TIMEOUT")
+        ok_(c.read().startswith("TURN A "))
+
+    def test_leave(self):
+        c = self.connect()
+        c.send("PLAY")
+        c.read_until("ACTIONS")
+        c.close()
+        self.clients = []
+        for _ in range(100):
+            if not self.server.games:
+                break
+            time.sleep(0.01)
+        eq_(self.server.games, {})
+        eq_(self.server.finished, 1)
+
+    def test_bots(self):
+        socket_map = {}
+        bots = [ts.Bot(self.server.address, 3, socket_map) for _ in range(5)]
+        deadline = time.time() + 20
+        while socket_map and time.time() < deadline:
+            asyncore.loop(0.05, map=socket_map, count=1)
+        for bot in bots:
+            eq_(len(bot.winners), 3)
+            ok_(bot.latencies)
+        for _ in range(100):
+            if self.server.finished == 15:
+                break
+            time.sleep(0.01)
+        eq_(self.server.finished, 15)